@@ -0,0 +1,430 @@
+# coding: utf-8
+"""
+File: benchmark.py
+
+Measurements of the parts of the scrapers package that decide how fast a crawl goes.
+
+    python benchmark.py parse [--repeat N] [--page kind=file.html ...]
+    python benchmark.py scale [--extractor lxml] [--pages N] [--workers 1,2,4] [--page kind=file.html ...]
+    python benchmark.py startup [--config config.yaml] [--runs N] [--top N] [--budget ms]
+    python benchmark.py crawl [--engine pipeline] [--pages N] [--image-size bytes] [--latency s] [--save file.json]
+                              [--baseline file.json]
+    python benchmark.py memory [--items N] [--config config.yaml]
+"""
+__author__ = 'Marko Čibej'
+
+
+import argparse
+import datetime
+import os
+import re
+import sys
+import gc
+import json
+import shutil
+import tempfile
+import threading
+import subprocess
+import time
+import resource
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, Tuple
+from extractors import EXTRACTORS, start_worker, run_extractor
+from standin import StandIn, page, ranking_body, detail_body, manga_detail_body, reader_body
+
+
+def sample_pages(blocks: int=60) -> Dict[str, bytes]:
+    """
+    :param blocks: the amount of filler on each page
+    :return: a page of each kind the spider parses, by the name of the extractor method that parses it
+    """
+    image = 'https://i.pximg.net/img-original/img/70000000_p{}.png'
+    return {'post_key': page('<form><input type="hidden" name="post_key" value="0123456789abcdef"></form>', blocks),
+            'ranking': page(ranking_body(range(70000000, 70000050)) +
+                            '<input type="hidden" name="tt" value="fedcba9876543210">', blocks),
+            'original_image': page(detail_body(image.format(0)), blocks),
+            'reader_link': page(manga_detail_body(70000000), blocks),
+            'manga_images': page(reader_body(image.format(i) for i in range(30)), blocks)}
+
+
+def measure(function: Callable, repeat: int) -> Tuple[float, int]:
+    """
+    :param function: the call to measure
+    :param repeat: how many times to call it
+    :return: the mean time of a call and the peak of Python memory allocated during one call
+    """
+    function()  # warm up
+    gc.collect()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    elapsed = (time.perf_counter() - started) / repeat
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def parse_one(name: str, pages: Dict[str, bytes], repeat: int, results: multiprocessing.Queue):
+    """
+    Measure one extractor on every page, in a process of its own so that its peak resident memory is its own.
+    """
+    extractor = EXTRACTORS[name]()
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rows = []
+    for kind, content in pages.items():
+        elapsed, peak = measure(lambda: getattr(extractor, kind)(content), repeat)
+        rows.append((kind, elapsed, peak))
+    results.put((name, rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+
+
+def load_pages(args: argparse.Namespace) -> Dict[str, bytes]:
+    """
+    :return: the sample pages, with the ones given on the command line in place of their kind
+    """
+    pages = sample_pages()
+    for page in args.page or ():
+        kind, file_name = page.split('=', 1)
+        with open(file_name, 'rb') as f:
+            pages[kind] = f.read()
+    return pages
+
+
+def parse_benchmark(args: argparse.Namespace):
+    """
+    Compare the extractors page by page: the time to parse, the Python memory allocated (which does not include
+    the trees libxml2 builds in C) and how much the peak resident memory of the process grew.
+    """
+    pages = load_pages(args)
+    print('{:<16}{:>10}{:>12}{:>14}{:>14}'.format('page', 'size kB', 'extractor', 'ms per page', 'alloc kB'))
+    results = multiprocessing.Queue()
+    for name in EXTRACTORS:
+        process = multiprocessing.Process(target=parse_one, args=(name, pages, args.repeat, results))
+        process.start()
+        name, rows, rss = results.get()
+        process.join()
+        for kind, elapsed, peak in rows:
+            print('{:<16}{:>10.1f}{:>12}{:>14.2f}{:>14.1f}'.format(kind, len(pages[kind]) / 1024, name,
+                                                                   elapsed * 1000, peak / 1024))
+        print('{:<16}{:>10}{:>12}{:>28}'.format('', '', name, 'peak RSS grew {} kB'.format(rss)))
+
+
+def scale_benchmark(args: argparse.Namespace):
+    """
+    Parse a batch of pages in parse processes, as the spider does with parse-workers, with a growing number of
+    processes. All the pages are submitted at once, like the many requests in flight of the concurrent engines.
+    """
+    pages = load_pages(args)
+    kinds = list(pages)
+    batch = [(kinds[i % len(kinds)], pages[kinds[i % len(kinds)]]) for i in range(args.pages)]
+    started = time.perf_counter()
+    extractor = EXTRACTORS[args.extractor]()
+    for kind, content in batch:
+        getattr(extractor, kind)(content)
+    single = len(batch) / (time.perf_counter() - started)
+    print('{} cores, {} pages of {} kinds, {} extractor'.format(os.cpu_count(), len(batch), len(pages),
+                                                              args.extractor))
+    print('{:<12}{:>12}{:>10}'.format('workers', 'pages/s', 'speedup'))
+    print('{:<12}{:>12.1f}{:>10.2f}'.format('in process', single, 1))
+    workers = [int(n) for n in args.workers.split(',')] if args.workers else \
+        sorted({2 ** i for i in range(os.cpu_count().bit_length())} | {os.cpu_count()})
+    for count in workers:
+        with ProcessPoolExecutor(count, initializer=start_worker, initargs=(args.extractor,)) as pool:
+            list(pool.map(int, range(count)))  # start the processes before the clock
+            started = time.perf_counter()
+            for _ in pool.map(run_extractor, *zip(*batch), chunksize=4):
+                pass
+            rate = len(batch) / (time.perf_counter() - started)
+        print('{:<12}{:>12.1f}{:>10.2f}'.format(count, rate, rate / single))
+
+
+STARTUP = '''
+import time
+started = time.perf_counter()
+import main, spiders
+imported = time.perf_counter()
+from config import Configuration
+Configuration({!r})
+print('timing', imported - started, time.perf_counter() - imported)
+'''
+
+
+def startup_benchmark(args: argparse.Namespace):
+    """
+    Start fresh interpreters that import what a crawl imports and load the configuration, as __main__.py does
+    before it gets to work, with -X importtime. The first run reads the YAML, the others the configuration cache.
+    Exits with an error if the median time is over the budget, so that it can guard the startup time.
+    """
+    cache_file_name = args.config + '.cache'
+    if os.path.exists(cache_file_name):
+        os.unlink(cache_file_name)
+    here = os.path.dirname(os.path.abspath(__file__))
+    totals, modules = [], {}
+    for run in range(args.runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP.format(args.config)],
+                                cwd=os.getcwd(), env=dict(os.environ, PYTHONPATH=here),
+                                capture_output=True, text=True, check=True)
+        imports, config = (float(t) for t in re.search(r'timing (\S+) (\S+)', result.stdout).groups())
+        print('run {}: imports {:.1f} ms, configuration {:.1f} ms{}'.format(
+            run + 1, imports * 1000, config * 1000, ' (no cache)' if run == 0 else ''))
+        totals.append(imports + config)
+        # import time: self [us] | cumulative | imported package, indented by nesting
+        for line in result.stderr.splitlines():
+            match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)', line)
+            if match is not None and len(match.group(2)) <= 3:
+                modules.setdefault(match.group(3), []).append(int(match.group(1)))
+    print('slowest imports, median cumulative ms:')
+    # a module a run didn't import counts as 0 for it, e.g. yaml once the configuration is cached
+    medians = sorted(((sorted(times + [0] * (args.runs - len(times)))[args.runs // 2] / 1000, name)
+                      for name, times in modules.items()), reverse=True)
+    for elapsed, name in medians[:args.top]:
+        print('  {:<30}{:>8.1f}'.format(name, elapsed))
+    median = sorted(totals)[len(totals) // 2] * 1000
+    print('median startup {:.1f} ms'.format(median))
+    if args.budget is not None and median > args.budget:
+        sys.exit('startup takes {:.1f} ms, over the budget of {} ms'.format(median, args.budget))
+
+
+class StageTimer:
+    """
+    Times every call of a spider's stage methods: the wall time, and the CPU time of the thread that made the call,
+    so that the stages can be told apart even when they run at the same time.
+    """
+    def __init__(self, spider):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, list] = {}
+        self.cpu: Dict[str, float] = {}
+        for method, stage in spider.STAGES.items():
+            setattr(spider, method, self.timed(stage, getattr(spider, method)))
+
+    def timed(self, stage: str, function: Callable) -> Callable:
+        def timed_function(*args, **kwargs):
+            started, cpu_started = time.perf_counter(), time.thread_time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed, cpu = time.perf_counter() - started, time.thread_time() - cpu_started
+                with self.lock:
+                    self.latencies.setdefault(stage, []).append(elapsed)
+                    self.cpu[stage] = self.cpu.get(stage, 0.0) + cpu
+        return timed_function
+
+
+def percentile(values: list, share: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def crawl_benchmark(args: argparse.Namespace):
+    """
+    Crawl a stand-in Pixiv end to end with the site definition from the configuration, in a temporary directory,
+    and report the throughput and what each stage cost. Throttling is left out unless asked for, as it would
+    measure the configured rates instead of the spider. The results can be saved, and compared with saved ones.
+    """
+    from config import Configuration
+    from spiders import PixivSpider
+    from engine import AsyncEngine
+
+    site_def = Configuration(args.config).get_site(args.site)
+    server = StandIn(args.pages, args.per_page, args.manga_every, args.manga_pages, args.image_size,
+                     args.latency).start()
+    directory = tempfile.mkdtemp(prefix='scrapers-benchmark-')
+    here = os.getcwd()
+    os.chdir(directory)
+    try:
+        site_def = server.site_def(site_def)
+        site_def.update({'engine': args.engine, 'frontier-file': 'frontier.sqlite', 'index-file': 'index.sqlite',
+                         'cookie-file': 'cookies', 'incremental': False})
+        if not args.throttle:
+            site_def.pop('throttle', None)
+        if site_def.get('cache'):
+            site_def['cache'] = dict(site_def['cache'], directory='cache')
+        if site_def.get('blob-store'):
+            site_def['blob-store'] = 'blobs'
+        multi = site_def.get('multi', False)
+
+        spider = PixivSpider(site_def)
+        timer = StageTimer(spider)
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        started = time.perf_counter()
+        if args.engine == 'async':
+            AsyncEngine(site_def).run(spider.main_async, multi)
+        elif args.engine == 'pipeline':
+            AsyncEngine(site_def).run(spider.main_pipeline, multi)
+        elif args.engine == 'threaded':
+            spider.main_threaded(multi)
+        else:
+            spider.main(multi)
+        elapsed = time.perf_counter() - started
+        spider.close()
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    finally:
+        os.chdir(here)
+        server.stop()
+        if not args.keep:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    pages = sum(count for kind, count in server.requests.items() if kind != 'image')
+    image_bytes = server.bytes.get('image', 0)
+    results = {'engine': args.engine, 'seconds': elapsed, 'pages': pages, 'pages/s': pages / elapsed,
+               'images': server.requests.get('image', 0), 'MB/s': image_bytes / elapsed / 1e6,
+               'cpu': after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime,
+               'cpu in parse processes': max(0.0, children.ru_utime + children.ru_stime -
+                                             children_before.ru_utime - children_before.ru_stime),
+               'peak RSS kB': after.ru_maxrss,
+               'stages': {stage: {'calls': len(latencies), 'p50 ms': percentile(latencies, 0.5) * 1000,
+                                  'p99 ms': percentile(latencies, 0.99) * 1000, 'cpu s': timer.cpu[stage]}
+                          for stage, latencies in timer.latencies.items()}}
+
+    print('{engine}: {pages} pages and {images} images in {seconds:.2f}s, {pages/s:.1f} pages/s, {MB/s:.1f} MB/s, '
+          '{cpu:.2f}s CPU and {cpu in parse processes:.2f}s in parse processes, peak RSS {peak RSS kB} kB'
+          .format(**results))
+    print('{:<12}{:>8}{:>10}{:>10}{:>10}'.format('stage', 'calls', 'p50 ms', 'p99 ms', 'cpu s'))
+    for stage, row in results['stages'].items():
+        print('{:<12}{calls:>8}{p50 ms:>10.1f}{p99 ms:>10.1f}{cpu s:>10.2f}'.format(stage, **row))
+    if args.keep:
+        print('files kept in {}'.format(directory))
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        worse = []
+        for key in ('pages/s', 'MB/s'):
+            change = results[key] / baseline[key] - 1 if baseline[key] else 0
+            print('{}: {:.1f} against {:.1f}, {:+.0%}'.format(key, results[key], baseline[key], change))
+            if change < -args.tolerance:
+                worse.append(key)
+        if worse:
+            sys.exit('slower than the baseline: {}'.format(', '.join(worse)))
+
+
+def fill_frontier(file_name: str, items: int, url_def: dict):
+    """
+    Queue the pictures of a long backfill in a frontier: items works spread over the days of a year, each with its
+    image url and its detail page as the referer, as a ranking crawl finds them.
+    """
+    from frontier import Frontier
+    frontier = Frontier(file_name, 'daily/20181101', 10000)
+    for number in range(items):
+        illust_id = 70000000 + number * 7
+        day = datetime.date(2018, 1, 1) + datetime.timedelta(days=number % 365)
+        frontier.discover('picture', 'https://i.pximg.net/img-original/img/{}/{:02}/{:02}/{}_p0.jpg'.format(
+            day.strftime('%Y/%m/%d'), number % 24, number % 60, illust_id),
+                          url_def['detail-url'] + str(illust_id))
+    frontier.close()
+
+
+def queue_one(file_name: str, url_def: dict, compact: bool, results: multiprocessing.Queue):
+    """
+    Read the queued pictures of a frontier into memory, as the spider does before downloading them, in a process
+    of its own so that its peak resident memory is its own: as the list of tuples of strings SQLite returns, or
+    compactly, as the frontier keeps them.
+    """
+    from frontier import Frontier
+    from compact import UrlCodec
+    frontier = Frontier(file_name, 'daily/20181101', codec=UrlCodec([url_def['detail-url'], url_def.get('manga-url')]))
+    gc.collect()
+    with open('/proc/self/statm') as f:  # the resident memory now, the peak so far can be from the imports
+        before = int(f.read().split()[1]) * resource.getpagesize() // 1024
+    started = time.perf_counter()
+    if compact:
+        queued = frontier.pending('picture')
+    else:
+        queued = frontier.db.execute('SELECT url, referer FROM work WHERE target = ? AND kind = ? AND state = ?'
+                                     ' ORDER BY rowid', (frontier.target, 'picture', Frontier.DISCOVERED)).fetchall()
+    elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    for url, referer in queued:
+        pass
+    results.put((len(queued), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before, elapsed,
+                 time.perf_counter() - started))
+
+
+def memory_benchmark(args: argparse.Namespace):
+    """
+    Measure the memory of the queued work of a large crawl: how much the peak resident memory grows when the
+    pending pictures of a frontier are read, as plain tuples of strings and as compact url pairs.
+    """
+    from config import Configuration
+    url_def = Configuration(args.config).get_site(args.site)['url']
+    directory = tempfile.mkdtemp(prefix='scrapers-benchmark-')
+    try:
+        file_name = os.path.join(directory, 'frontier.sqlite')
+        started = time.perf_counter()
+        fill_frontier(file_name, args.items, url_def)
+        print('queued {} pictures in {:.1f}s'.format(args.items, time.perf_counter() - started))
+        # spawned, not forked, so that each starts from a small process
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        grown = {}
+        print('{:<10}{:>12}{:>16}{:>14}{:>14}'.format('queue', 'items', 'peak RSS MB', 'bytes/item', 'read s'))
+        for name, compact in (('tuples', False), ('compact', True)):
+            process = context.Process(target=queue_one, args=(file_name, url_def, compact, results))
+            process.start()
+            items, rss, elapsed, iterated = results.get()
+            process.join()
+            grown[name] = rss * 1024  # ru_maxrss is in kB on Linux
+            print('{:<10}{:>12}{:>16.1f}{:>14.0f}{:>14.2f}'.format(name, items, grown[name] / 1e6,
+                                                                   grown[name] / max(items, 1), elapsed + iterated))
+        print('compact queue: {:.1f}x less memory'.format(grown['tuples'] / max(grown['compact'], 1)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Benchmark parts of the scrapers package')
+    commands = parser.add_subparsers(dest='command', required=True)
+    parse = commands.add_parser('parse', help='compare the page extractors')
+    parse.add_argument('-n', '--repeat', help='parses of each page to average', type=int, default=20)
+    parse.add_argument('-p', '--page', action='append',
+                       help='use a saved page instead of the sample one, as kind=file, e.g. ranking=ranking.html')
+    parse.set_defaults(run=parse_benchmark)
+    scale = commands.add_parser('scale', help='measure how parsing in worker processes scales with their number')
+    scale.add_argument('-e', '--extractor', help='the extractor to use', choices=EXTRACTORS, default='lxml')
+    scale.add_argument('-n', '--pages', help='the number of pages to parse', type=int, default=2000)
+    scale.add_argument('-w', '--workers', help='the numbers of worker processes to try, e.g. 1,2,4,8,16')
+    scale.add_argument('-p', '--page', action='append',
+                       help='use a saved page instead of the sample one, as kind=file, e.g. ranking=ranking.html')
+    scale.set_defaults(run=scale_benchmark)
+    startup = commands.add_parser('startup', help='measure the imports and configuration loading at startup')
+    startup.add_argument('-c', '--config', help='the configuration file to load', default='config.yaml')
+    startup.add_argument('-n', '--runs', help='the number of interpreters to start', type=int, default=5)
+    startup.add_argument('-t', '--top', help='the number of slowest imports to show', type=int, default=10)
+    startup.add_argument('-b', '--budget', help='fail if the median startup takes longer, in ms', type=float)
+    startup.set_defaults(run=startup_benchmark)
+    crawl = commands.add_parser('crawl', help='crawl a local stand-in for Pixiv and measure the stages')
+    crawl.add_argument('-c', '--config', help='the configuration file', default='config.yaml')
+    crawl.add_argument('-s', '--site', help='the Pixiv site in the configuration', default='pixiv')
+    crawl.add_argument('-e', '--engine', choices=('sequential', 'threaded', 'async', 'pipeline'), default='pipeline')
+    crawl.add_argument('-n', '--pages', help='ranking pages', type=int, default=3)
+    crawl.add_argument('--per-page', help='works on a ranking page', type=int, default=50)
+    crawl.add_argument('--manga-every', help='every n-th work is a manga, 0 for none', type=int, default=4)
+    crawl.add_argument('--manga-pages', help='pages of each manga', type=int, default=3)
+    crawl.add_argument('-i', '--image-size', help='bytes in each image', type=int, default=200000)
+    crawl.add_argument('-l', '--latency', help='seconds before each response', type=float, default=0.02)
+    crawl.add_argument('--throttle', help="keep the site's throttle settings", action='store_true')
+    crawl.add_argument('-k', '--keep', help='keep the downloaded files', action='store_true')
+    crawl.add_argument('--save', help='save the results to a json file')
+    crawl.add_argument('--baseline', help='compare with results saved earlier, and fail if slower')
+    crawl.add_argument('--tolerance', help='how much slower than the baseline is still fine', type=float,
+                       default=0.1)
+    crawl.set_defaults(run=crawl_benchmark)
+    memory = commands.add_parser('memory', help='measure the memory of the queued work of a large crawl')
+    memory.add_argument('-n', '--items', help='the pictures to queue', type=int, default=1000000)
+    memory.add_argument('-c', '--config', help='the configuration file, for the url templates', default='config.yaml')
+    memory.add_argument('-s', '--site', help='the Pixiv site in the configuration', default='pixiv')
+    memory.set_defaults(run=memory_benchmark)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    arguments.run(arguments)
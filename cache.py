@@ -0,0 +1,217 @@
+# coding: utf-8
+"""
+File: cache.py
+
+HTTP response cache for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import logging
+from http import HTTPStatus
+from typing import Optional, List, Tuple
+from requests import Response, PreparedRequest
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+
+logger = logging.getLogger('scr')
+
+
+class HTTPCache:
+    """
+    Response bodies on disk, one file per url, with an SQLite index that holds the validators, the time each entry
+    was stored and last used, and its size. Only urls that belong to one of the configured url classes are cached;
+    each class has its own time to live. When the cache grows beyond its size, the least recently used entries
+    are dropped.
+    """
+    KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+    def __init__(self, directory: str, max_size: int, url_classes: List[Tuple[str, str, int]]):
+        """
+        :param directory: where the bodies and the index are kept
+        :param max_size: the most bytes of bodies to keep
+        :param url_classes: (name, regular expression, time to live in seconds), the first one that matches an url
+            applies to it
+        """
+        self.directory, self.max_size = directory, max_size
+        self.url_classes = [(name, re.compile(pattern), ttl) for name, pattern, ttl in url_classes]
+        self.lock = threading.Lock()
+        self.hits = self.revalidated = self.misses = self.evicted = 0
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS entry (
+                               url TEXT PRIMARY KEY,
+                               headers TEXT NOT NULL,
+                               size INTEGER NOT NULL,
+                               stored REAL NOT NULL,
+                               accessed REAL NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entry_accessed ON entry (accessed)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM entry').fetchone()[0]
+
+    @classmethod
+    def from_definition(cls, cache_def: dict) -> 'HTTPCache':
+        """
+        Create a cache from the cache section of a site definition.
+        :param cache_def: the section
+        :return: the cache
+        """
+        return cls(cache_def['directory'], cache_def.get('max-size', 256 * 1024 * 1024),
+                   [(name, pattern, ttl) for name, (pattern, ttl) in cache_def.get('ttl', {}).items()])
+
+    def url_class(self, url: str) -> Optional[Tuple[str, int]]:
+        """
+        :param url: the url
+        :return: the name and time to live of the class the url belongs to, or None if it is not cached
+        """
+        for name, pattern, ttl in self.url_classes:
+            if pattern.search(url):
+                return name, ttl
+        return None
+
+    def body_name(self, url: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(url.encode()).hexdigest())
+
+    def get(self, url: str) -> Optional[Tuple[dict, float, bytes]]:
+        """
+        :param url: the url
+        :return: the stored headers, the time they were stored and the body, or None if the url is not in the cache
+        """
+        with self.lock:
+            row = self.db.execute('SELECT headers, stored FROM entry WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self.body_name(url), 'rb') as f:
+                return json.loads(row[0]), row[1], f.read()
+        except OSError:
+            return None  # evicted in the meantime
+
+    def put(self, url: str, response: Response):
+        """
+        Store a complete 200 response, then make room if the cache has grown too big.
+        :param url: the url
+        :param response: the response, with its content already read
+        """
+        headers = {k: response.headers[k] for k in self.KEPT_HEADERS if k in response.headers}
+        body_name = self.body_name(url)
+        temp_name = '{}.{}.tmp'.format(body_name, threading.get_ident())
+        with open(temp_name, 'wb') as f:
+            f.write(response.content)
+        os.replace(temp_name, body_name)
+        now = time.time()
+        with self.lock, self.db:
+            previous = self.db.execute('SELECT size FROM entry WHERE url = ?', (url,)).fetchone()
+            self.db.execute('INSERT OR REPLACE INTO entry (url, headers, size, stored, accessed)'
+                            ' VALUES (?, ?, ?, ?, ?)', (url, json.dumps(headers), len(response.content), now, now))
+            self.size += len(response.content) - (previous[0] if previous else 0)
+            self.evict()
+
+    def touch(self, url: str, response: Response=None):
+        """
+        Mark an entry as used. If the server has just confirmed it, it also counts as stored now, and any new
+        validators are kept.
+        :param url: the url
+        :param response: the 304 response, if the entry was revalidated
+        """
+        now = time.time()
+        with self.lock, self.db:
+            if response is None:
+                self.db.execute('UPDATE entry SET accessed = ? WHERE url = ?', (now, url))
+                return
+            row = self.db.execute('SELECT headers FROM entry WHERE url = ?', (url,)).fetchone()
+            headers = json.loads(row[0]) if row is not None else {}
+            headers.update({k: response.headers[k] for k in ('ETag', 'Last-Modified') if k in response.headers})
+            self.db.execute('UPDATE entry SET headers = ?, stored = ?, accessed = ? WHERE url = ?',
+                            (json.dumps(headers), now, now, url))
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the cache fits its size. Called with the lock held.
+        """
+        while self.size > self.max_size:
+            rows = self.db.execute('SELECT url, size FROM entry ORDER BY accessed LIMIT 100').fetchall()
+            if not rows:
+                break
+            for url, size in rows:
+                if self.size <= self.max_size:
+                    break
+                self.db.execute('DELETE FROM entry WHERE url = ?', (url,))
+                if os.path.exists(self.body_name(url)):
+                    os.unlink(self.body_name(url))
+                self.size -= size
+                self.evicted += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'hits': self.hits, 'revalidated': self.revalidated, 'misses': self.misses,
+                    'evicted': self.evicted, 'size': self.size}
+
+
+class CachingAdapter(HTTPAdapter):
+    """
+    A transport adapter that answers GET requests from an HTTPCache. A fresh entry is returned without asking the
+    server; a stale one is revalidated with If-None-Match and If-Modified-Since, and a 304 answer returns the
+    stored body. Streamed requests, such as downloads, and urls outside the cached classes go straight through.
+    """
+    def __init__(self, cache: HTTPCache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    def send(self, request: PreparedRequest, stream=False, **kwargs) -> Response:
+        url_class = self.cache.url_class(request.url)
+        if request.method != 'GET' or stream or url_class is None or 'Range' in request.headers:
+            return super().send(request, stream=stream, **kwargs)
+
+        entry = self.cache.get(request.url)
+        if entry is not None:
+            headers, stored, body = entry
+            if time.time() - stored < url_class[1]:
+                self.cache.touch(request.url)
+                with self.cache.lock:
+                    self.cache.hits += 1
+                return self.cached_response(request, headers, body)
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        response = super().send(request, stream=False, **kwargs)
+        if entry is not None and response.status_code == HTTPStatus.NOT_MODIFIED:
+            self.cache.touch(request.url, response)
+            with self.cache.lock:
+                self.cache.revalidated += 1
+            return self.cached_response(request, headers, body)
+
+        with self.cache.lock:
+            self.cache.misses += 1
+        if response.status_code == HTTPStatus.OK:
+            self.cache.put(request.url, response)
+        return response
+
+    def cached_response(self, request: PreparedRequest, headers: dict, body: bytes) -> Response:
+        """
+        Build a 200 response from a cache entry.
+        :param request: the request being answered
+        :param headers: the stored headers
+        :param body: the stored body
+        :return: the response
+        """
+        response = Response()
+        response.status_code, response.reason = HTTPStatus.OK, 'OK'
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = body
+        response.url, response.request, response.connection = request.url, request, self
+        response.from_cache = True
+        return response
@@ -0,0 +1,145 @@
+# coding: utf-8
+"""
+File: compact.py
+
+Compact in-memory lists of urls, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import re
+import threading
+from array import array
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+
+NONE = 0xFFFFFFFF  # the prefix id of a missing url, e.g. a referer that was not recorded
+# the scheme, host and up to three leading directories without digits
+DIRECTORIES = re.compile(r'[a-z][a-z0-9+.-]*://[^/?#]*/?(?:[^/?#0-9]*/){0,3}', re.IGNORECASE)
+
+
+class UrlCodec:
+    """
+    Turns urls into small parts that fit in arrays, and back. An url that is one of the templates followed by a
+    number, e.g. a detail page and its illust id, is kept as the template and the number. Any other url is split
+    into its prefix, the scheme, the host and up to three leading directories without digits, which many urls of a
+    host have in common, e.g. https://i.pximg.net/img-original/img/, and the rest. The templates and the prefixes
+    are kept once, each with an id.
+    """
+    def __init__(self, templates: Iterable[str]=()):
+        """
+        :param templates: the urls that are followed by a number, e.g. the detail-url of the site definition
+        """
+        self.templates = [template for template in templates if template]
+        self.prefixes: List[str] = list(self.templates)
+        self.prefix_ids = {}
+        self.lock = threading.Lock()
+
+    def prefix_id(self, prefix: str) -> int:
+        found = self.prefix_ids.get(prefix)
+        if found is None:
+            with self.lock:
+                found = self.prefix_ids.get(prefix)
+                if found is None:
+                    found = self.prefix_ids[prefix] = len(self.prefixes)
+                    self.prefixes.append(prefix)
+        return found
+
+    def encode(self, url: str) -> Tuple[int, Optional[int], str]:
+        """
+        :param url: the url
+        :return: its prefix id, and either the number after its template or None and the rest after the prefix
+        """
+        for template_id, template in enumerate(self.templates):
+            if url.startswith(template):
+                number = url[len(template):]
+                if number.isdigit() and number[0] != '0' and len(number) < 19:
+                    return template_id, int(number), ''
+        prefix = DIRECTORIES.match(url)
+        prefix = prefix.group() if prefix is not None else ''
+        return self.prefix_id(prefix), None, url[len(prefix):]
+
+
+class UrlPairs:
+    """
+    A list of (url, referer) pairs, such as the pending work of a frontier, at a fraction of the memory of the
+    tuples and strings: a few bytes for each url besides the part of it that is not in the codec. Each url is its
+    prefix id in an array of 32 bit integers and a value in an array of 64 bit integers, which is either the number
+    after its template or where its rest starts in a bytearray that holds the rests of all the urls, each after its
+    length. The urls are rebuilt as the pairs are read.
+
+    Pairs are only appended; reading and appending from different threads at once is not safe.
+    """
+    __slots__ = ('codec', 'prefixes', 'values', 'rests')
+
+    def __init__(self, codec: UrlCodec, pairs: Iterable[Tuple[str, Optional[str]]]=()):
+        """
+        :param codec: the codec, shared by the lists of a frontier
+        :param pairs: the pairs to start with, e.g. a database cursor, read one at a time
+        """
+        self.codec = codec
+        self.prefixes = array('I')
+        self.values = array('q')
+        self.rests = bytearray()
+        for url, referer in pairs:
+            self.append(url, referer)
+
+    def add(self, url: Optional[str]):
+        if url is None:
+            self.prefixes.append(NONE)
+            self.values.append(0)
+            return
+        prefix_id, number, rest = self.codec.encode(url)
+        self.prefixes.append(prefix_id)
+        if number is not None:
+            self.values.append(number)
+            return
+        self.values.append(len(self.rests))
+        rest = rest.encode()
+        length = len(rest)
+        while length >= 0x80:  # the length as a varint, one byte for the rests shorter than 128 bytes
+            self.rests.append(length & 0x7F | 0x80)
+            length >>= 7
+        self.rests.append(length)
+        self.rests += rest
+
+    def append(self, url: str, referer: Optional[str]=None):
+        self.add(url)
+        self.add(referer)
+
+    def url(self, index: int) -> Optional[str]:
+        prefix_id = self.prefixes[index]
+        if prefix_id == NONE:
+            return None
+        if prefix_id < len(self.codec.templates):
+            return self.codec.prefixes[prefix_id] + str(self.values[index])
+        start, length, shift = self.values[index], 0, 0
+        while True:
+            byte = self.rests[start]
+            start += 1
+            length |= (byte & 0x7F) << shift
+            shift += 7
+            if byte < 0x80:
+                break
+        return self.codec.prefixes[prefix_id] + self.rests[start:start + length].decode()
+
+    def __len__(self) -> int:
+        return len(self.prefixes) // 2
+
+    def __getitem__(self, index: int) -> Tuple[str, Optional[str]]:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('pair index out of range')
+        return self.url(2 * index), self.url(2 * index + 1)
+
+    def __iter__(self) -> Iterator[Tuple[str, Optional[str]]]:
+        for index in range(len(self)):
+            yield self.url(2 * index), self.url(2 * index + 1)
+
+    def nbytes(self) -> int:
+        """
+        :return: the bytes held by the arrays, the codec's prefixes not counted
+        """
+        return (len(self.prefixes) * self.prefixes.itemsize + len(self.values) * self.values.itemsize +
+                len(self.rests))
@@ -7,10 +7,12 @@ Configuration handler for the scrapers package.
 """
 __author__ = 'Marko Čibej'
 
-import pkg_resources
+import os
+import marshal
+import hashlib
 import logging
-import yaml
-from typing import Union, List, Any
+import tempfile
+from typing import Union, List, Any, Optional
 from helper import ScraperException
 
 
@@ -19,7 +21,10 @@ logger = logging.getLogger('scr')
 
 class Configuration:
     """
-    Contains the current configuration parameters.
+    Contains the current configuration parameters. Parsing YAML is slow, so the merged configuration is also kept
+    in a cache file next to the config file, which is used for as long as none of the files it was made from has
+    changed. The cache holds plain data in the marshal format, which unlike pickle cannot run code when it is read,
+    and it is only read if it belongs to the user and nobody else can write it.
     """
 
     def __init__(self, config_file_name: str):
@@ -29,6 +34,7 @@ class Configuration:
         :param config_file_name: the name of the initial config file
         """
         self.config_file_name = config_file_name
+        self.cache_file_name = config_file_name + '.cache'
         self.maps: dict = None
         self.load_config()
 
@@ -37,23 +43,78 @@ class Configuration:
         Open and load the config file. Do some top-level validation to make sure it's a valid YAML and
         that the expected top elements are present. Also initializes the GLOBAL branch
         """
-        self.maps = self.load_yaml(self.config_file_name)
-
-        # process includes, if any
-        if 'include' in self.maps:
-            for k, v in self.maps['include'].items():
-                if k in self.maps:
-                    raise ScraperException('Configuration.load', 'duplicate section name {}, on include'.format(k))
-                else:
-                    self.maps[k] = self.load_yaml(v)
+        self.maps = self.load_cache()
+        if self.maps is None:
+            self.maps = self.load_yaml(self.config_file_name)
+            sources = [self.config_file_name]
+
+            # process includes, if any, relative to the main file
+            if 'include' in self.maps:
+                for k, v in self.maps['include'].items():
+                    if k in self.maps:
+                        raise ScraperException('Configuration.load', 'duplicate section name {}, on include'.format(k))
+                    else:
+                        sources.append(os.path.join(os.path.dirname(self.config_file_name), v))
+                        self.maps[k] = self.load_yaml(sources[-1])
+            self.store_cache(sources)
 
         if 'sites' not in self.maps or not isinstance(self.maps['sites'], dict):
             logger.error('"sites" section of the configuration is missing or is not a map')
             raise ScraperException('Configuration.load', 'missing sites section, or section is not a map')
 
-        if 'GLOBAL' not in self.maps:
+        if not self.maps.get('GLOBAL'):
             self.maps['GLOBAL'] = {}
 
+    @staticmethod
+    def file_digest(file_name: str) -> str:
+        with open(file_name, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def load_cache(self) -> Optional[dict]:
+        """
+        Read the merged configuration from the cache file. It is out of date if any of the files it was made from
+        has changed: a different modification time is enough to look at the contents, but a file touched without
+        being changed doesn't invalidate it.
+        :return: the configuration, or None if there is no cache or it is out of date
+        """
+        try:
+            with open(self.cache_file_name, 'rb') as f:
+                status = os.fstat(f.fileno())
+                if hasattr(os, 'getuid') and (status.st_uid != os.getuid() or status.st_mode & 0o022):
+                    logger.debug('Ignoring configuration cache {}, which others can write.'.format(
+                        self.cache_file_name))
+                    return None
+                sources, maps = marshal.load(f)
+            if not isinstance(maps, dict):
+                return None
+            for file_name, mtime, size, digest in sources:
+                status = os.stat(file_name)
+                if status.st_size != size or (status.st_mtime_ns != mtime and self.file_digest(file_name) != digest):
+                    return None
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        logger.debug('Loaded configuration from cache {}.'.format(self.cache_file_name))
+        return maps
+
+    def store_cache(self, sources: List[str]):
+        """
+        Write the merged configuration to the cache file. Not being able to is not an error, only slower next time.
+        :param sources: the files the configuration was read from
+        """
+        temp_name = None
+        try:
+            states = [(file_name, os.stat(file_name).st_mtime_ns, os.stat(file_name).st_size,
+                       self.file_digest(file_name)) for file_name in sources]
+            handle, temp_name = tempfile.mkstemp(prefix=os.path.basename(self.cache_file_name) + '.', suffix='.tmp',
+                                                 dir=os.path.dirname(self.cache_file_name) or None)
+            with open(handle, 'wb') as f:
+                marshal.dump((states, self.maps), f)
+            os.replace(temp_name, self.cache_file_name)
+        except (OSError, ValueError) as e:  # ValueError: a value marshal cannot write, e.g. a YAML timestamp
+            logger.debug('Could not write configuration cache {}: {}'.format(self.cache_file_name, e))
+            if temp_name is not None and os.path.exists(temp_name):
+                os.unlink(temp_name)
+
     @staticmethod
     def load_yaml(filename: str):
         """
@@ -62,12 +123,15 @@ class Configuration:
         :param filename: the filename, including the 'yaml' extension
         :return: the parsed dictionary
         """
-#            raise ScraperException('Configuration.load_yaml', 'file {} not found'.format(full_path))
+        import yaml
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)  # the libyaml one is much faster, if it's there
 
         # get the file contents and run them through yaml
         try:
-            yaml_string = pkg_resources.resource_string(__name__, 'assets/' + filename).decode('utf-8')
-            the_map = yaml.load(yaml_string)
+            with open(filename, encoding='utf-8') as f:
+                the_map = yaml.load(f, Loader=loader)
+        except OSError:
+            raise ScraperException('Configuration.load_yaml', 'file {} not found'.format(filename))
         except yaml.YAMLError as ye:
             raise ScraperException('Configuration.load_yaml', ye)
 
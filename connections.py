@@ -0,0 +1,92 @@
+# coding: utf-8
+"""
+File: connections.py
+
+Connection pools that count the connections they open, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class CountingConnection:
+    """
+    Tells its pool whenever it connects. That includes reconnecting after the server closed the connection, which
+    the pool's own num_connections misses, and which costs a handshake just the same.
+    """
+    pool: 'CountingPool' = None
+
+    def connect(self):
+        super().connect()
+        if self.pool is not None:
+            self.pool.connected()
+
+
+class CountingHTTPConnection(CountingConnection, HTTPConnection):
+    pass
+
+
+class CountingHTTPSConnection(CountingConnection, HTTPSConnection):
+    pass
+
+
+class CountingPool:
+    """
+    Counts the connections made by its connections.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connects = 0
+        self.connects_lock = threading.Lock()
+
+    def _new_conn(self):
+        connection = super()._new_conn()
+        connection.pool = self
+        return connection
+
+    def connected(self):
+        with self.connects_lock:
+            self.connects += 1
+
+
+class CountingHTTPConnectionPool(CountingPool, HTTPConnectionPool):
+    ConnectionCls = CountingHTTPConnection
+
+
+class CountingHTTPSConnectionPool(CountingPool, HTTPSConnectionPool):
+    ConnectionCls = CountingHTTPSConnection
+
+
+def count_connections(adapter: HTTPAdapter) -> HTTPAdapter:
+    """
+    Make the pools an adapter creates from now on count their connections.
+    :param adapter: the adapter
+    :return: the same adapter
+    """
+    adapter.poolmanager.pool_classes_by_scheme = {'http': CountingHTTPConnectionPool,
+                                                  'https': CountingHTTPSConnectionPool}
+    return adapter
+
+
+def connection_stats(adapters) -> dict:
+    """
+    Count the connections made and the requests sent, by host. Many requests per connection mean the TCP and TLS
+    handshakes were saved; the same numbers mean every request paid for them. The pools an adapter has dropped
+    because it had more hosts than pool_connections are not counted.
+    :param adapters: the adapters of a session
+    :return: {host: {'connections': made, 'requests': sent}}
+    """
+    stats = {}
+    for adapter in set(adapters):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                host = stats.setdefault(pool.host, {'connections': 0, 'requests': 0})
+                host['connections'] += getattr(pool, 'connects', pool.num_connections)
+                host['requests'] += pool.num_requests
+    return stats
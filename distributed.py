@@ -0,0 +1,336 @@
+# coding: utf-8
+"""
+File: distributed.py
+
+A crawl shared by a coordinator and worker processes on one or more hosts, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import time
+import socket
+import bisect
+import hmac
+import hashlib
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from xmlrpc.client import ServerProxy
+from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+from typing import List, Optional, Tuple
+
+
+logger = logging.getLogger('scr')
+
+
+def hash_key(key: str) -> int:
+    """
+    :return: a hash of the key that is the same in every process, unlike hash()
+    """
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hashing of keys onto nodes: each node has many points on a ring, and a key belongs to the node of the
+    first point after the key's hash. Adding or removing a node moves only the keys next to its points.
+    """
+    def __init__(self, nodes: int, replicas: int=64):
+        """
+        :param nodes: the nodes, numbered from 0
+        :param replicas: the points of each node
+        """
+        points = sorted((hash_key('{}-{}'.format(node, replica)), node)
+                        for node in range(nodes) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.nodes = [node for _, node in points]
+
+    def node(self, key) -> int:
+        """
+        :param key: e.g. an illust id
+        :return: the node it belongs to
+        """
+        return self.nodes[bisect.bisect(self.hashes, hash_key(str(key))) % len(self.hashes)]
+
+
+class ShardQueue:
+    """
+    The work of a distributed crawl: the detail pages found by the coordinator, in shards by the consistent hash of
+    their illust ids. A worker leases a whole shard, and must renew the lease before it runs out; a shard whose
+    lease has run out, e.g. because its worker died, goes to the next worker that asks, with whatever of it was not
+    done. The lease is checked whenever a worker reports an item, so a worker that lost its shard stops.
+
+    The queue is an SQLite file, which the processes of one host can share. The coordinator can also serve it to
+    workers on other hosts, see serve_queue().
+    """
+    PENDING, DONE, FAILED = 'pending', 'done', 'failed'
+
+    def __init__(self, file_name: str, shards: int=64, lease: float=60):
+        """
+        Open or create the queue file.
+        :param file_name: the SQLite file
+        :param shards: the number of shards
+        :param lease: the seconds a worker holds a shard without renewing its lease
+        """
+        self.file_name, self.lease_time = file_name, lease
+        self.ring = HashRing(shards)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.transaction():
+            self.db.execute('''CREATE TABLE IF NOT EXISTS shard (
+                                   id INTEGER PRIMARY KEY,
+                                   owner TEXT,
+                                   expires REAL NOT NULL DEFAULT 0)''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS item (
+                                   target TEXT NOT NULL,
+                                   illust INTEGER NOT NULL,
+                                   shard INTEGER NOT NULL,
+                                   url TEXT NOT NULL,
+                                   state TEXT NOT NULL,
+                                   worker TEXT,
+                                   updated REAL NOT NULL,
+                                   PRIMARY KEY (target, illust))''')
+            self.db.execute('CREATE INDEX IF NOT EXISTS item_shard ON item (shard, state)')
+            self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS item_url ON item (target, url)')  # for finish()
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.executemany('INSERT OR IGNORE INTO shard (id) VALUES (?)', ((shard,) for shard in range(shards)))
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold the lock and a write transaction, taken at once, so that two processes cannot both read a shard as
+        free and then both take it.
+        """
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+
+    def set_state(self, state: str):
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('state', ?)", (state,))
+
+    def open(self):
+        """
+        Tell the workers that the coordinator is finding work; they wait for it instead of stopping.
+        """
+        self.set_state('enumerating')
+
+    def close(self):
+        """
+        Tell the workers that all the work is queued; they stop once it is done.
+        """
+        self.set_state('enumerated')
+
+    def put(self, items: List[Tuple[str, int, str]]) -> int:
+        """
+        Queue detail pages. The ones already queued, e.g. by an earlier run, are left as they are.
+        :param items: (target, illust id, url) triples
+        :return: how many were new
+        """
+        now = time.time()
+        with self.transaction():
+            before = self.db.total_changes
+            self.db.executemany('INSERT OR IGNORE INTO item (target, illust, shard, url, state, updated)'
+                                ' VALUES (?, ?, ?, ?, ?, ?)',
+                                ((target, int(illust_id), self.ring.node(illust_id), url, self.PENDING, now)
+                                 for target, illust_id, url in items))
+            return self.db.total_changes - before
+
+    def lease(self, worker: str) -> Optional[int]:
+        """
+        Lease a shard with pending items: one the worker holds already, one that nobody holds, or one whose lease
+        has run out.
+        :param worker: the worker
+        :return: the shard, or None if there is nothing to do right now
+        """
+        now = time.time()
+        with self.transaction():
+            found = self.db.execute('SELECT id, owner FROM shard WHERE (owner IS NULL OR owner = ? OR expires < ?)'
+                                    ' AND EXISTS (SELECT 1 FROM item WHERE item.shard = shard.id AND state = ?)'
+                                    ' ORDER BY owner IS NOT ?, id LIMIT 1',
+                                    (worker, now, self.PENDING, worker)).fetchone()
+            if found is None:
+                return None
+            shard, owner = found
+            self.db.execute('UPDATE shard SET owner = ?, expires = ? WHERE id = ?',
+                            (worker, now + self.lease_time, shard))
+        if owner is not None and owner != worker:
+            logger.info('{} takes over shard {} from {}'.format(worker, shard, owner))
+        return shard
+
+    def renew(self, shard: int, worker: str) -> bool:
+        """
+        Extend a lease.
+        :return: False if the worker no longer holds the shard
+        """
+        with self.transaction():
+            return self.db.execute('UPDATE shard SET expires = ? WHERE id = ? AND owner = ? AND expires >= ?',
+                                   (time.time() + self.lease_time, shard, worker, time.time())).rowcount == 1
+
+    def release(self, shard: int, worker: str):
+        """
+        Give a shard back, e.g. when its pending items are done.
+        """
+        with self.transaction():
+            self.db.execute('UPDATE shard SET owner = NULL, expires = 0 WHERE id = ? AND owner = ?', (shard, worker))
+
+    def items(self, shard: int) -> List[Tuple[str, str]]:
+        """
+        :return: the pending items of a shard, as (target, url) pairs
+        """
+        with self.lock:
+            return [list(item) for item in self.db.execute(
+                'SELECT target, url FROM item WHERE shard = ? AND state = ? ORDER BY target, illust',
+                (shard, self.PENDING)).fetchall()]
+
+    def finish(self, shard: int, worker: str, target: str, url: str, succeeded: bool) -> bool:
+        """
+        Record an item as done or failed, and extend the lease, if the worker still holds the shard.
+        :return: False if it does not, and the item was left for the new holder
+        """
+        now = time.time()
+        with self.transaction():
+            if self.db.execute('UPDATE shard SET expires = ? WHERE id = ? AND owner = ? AND expires >= ?',
+                               (now + self.lease_time, shard, worker, now)).rowcount != 1:
+                return False
+            self.db.execute('UPDATE item SET state = ?, worker = ?, updated = ? WHERE target = ? AND url = ?',
+                            (self.DONE if succeeded else self.FAILED, worker, now, target, url))
+            return True
+
+    def finished(self) -> bool:
+        """
+        :return: whether all the work has been queued and none of it is pending
+        """
+        with self.lock:
+            state = self.db.execute("SELECT value FROM meta WHERE key = 'state'").fetchone()
+            pending = self.db.execute('SELECT 1 FROM item WHERE state = ? LIMIT 1', (self.PENDING,)).fetchone()
+        return state is not None and state[0] == 'enumerated' and pending is None
+
+    def retry_failed(self) -> int:
+        """
+        Queue the failed items again.
+        :return: how many
+        """
+        with self.transaction():
+            return self.db.execute('UPDATE item SET state = ? WHERE state = ?', (self.PENDING, self.FAILED)).rowcount
+
+    def counts(self) -> dict:
+        """
+        :return: the number of items by state, and of shards leased
+        """
+        with self.lock:
+            counts = dict(self.db.execute('SELECT state, COUNT(*) FROM item GROUP BY state').fetchall())
+            counts['leased'] = self.db.execute('SELECT COUNT(*) FROM shard WHERE owner IS NOT NULL AND expires >= ?',
+                                               (time.time(),)).fetchone()[0]
+        return counts
+
+
+TOKEN_HEADER = 'X-Queue-Token'
+
+
+class TokenRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    Refuses the calls that do not carry the server's token, if it has one.
+    """
+    token: Optional[str] = None
+
+    def do_POST(self):
+        if self.token is not None and not hmac.compare_digest(self.headers.get(TOKEN_HEADER, ''), self.token):
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        super().do_POST()
+
+
+def serve_queue(queue: ShardQueue, address: str, token: str=None) -> SimpleXMLRPCServer:
+    """
+    Serve a queue to the workers of other hosts with XML-RPC, from a thread. The calls are handled one at a time.
+
+    Whoever can call the queue can take over shards and mark their works done, so it listens on 127.0.0.1 unless
+    the address names a host, e.g. 0.0.0.0 for all the interfaces, and it should then have a token that the
+    workers send with every call. The token is sent in the clear, so it keeps out strangers, not eavesdroppers;
+    beyond a trusted network the queue belongs behind a tunnel or a TLS proxy.
+    :param queue: the queue
+    :param address: [host:]port to listen on
+    :param token: the secret the workers share with the coordinator, if any
+    :return: the server, to shut down when the crawl is done
+    """
+    host, _, port = str(address).rpartition(':')
+    host = host or '127.0.0.1'
+    handler = type('QueueRequestHandler', (TokenRequestHandler,), {'token': token})
+    server = SimpleXMLRPCServer((host, int(port)), handler, allow_none=True, logRequests=False)
+    if token is None and host not in ('127.0.0.1', 'localhost', '::1'):
+        logger.warning('the work queue is served on {} without a token, anyone who reaches it can change it'
+                       .format(host))
+    for method in ('lease', 'renew', 'release', 'items', 'finish', 'finished', 'counts'):
+        server.register_function(getattr(queue, method), method)
+    threading.Thread(target=server.serve_forever, name='queue', daemon=True).start()
+    logger.info('serving the work queue on {}:{}'.format(*server.server_address[:2]))
+    return server
+
+
+def open_queue(distributed_def: dict):
+    """
+    Open the queue of a worker: the coordinator's, if the distributed section gives its queue-url, or else the
+    queue file shared with it.
+    :param distributed_def: the distributed section of the site definition
+    :return: the queue, or a proxy for it with the same methods
+    """
+    if distributed_def.get('queue-url'):
+        token = distributed_def.get('token')
+        return ServerProxy(distributed_def['queue-url'], allow_none=True,
+                           headers=[(TOKEN_HEADER, token)] if token is not None else ())
+    return ShardQueue(distributed_def['queue-file'], distributed_def.get('shards', 64),
+                      distributed_def.get('lease', 60))
+
+
+def worker_name() -> str:
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def worker_site_def(site_def: dict, worker: str) -> dict:
+    """
+    :return: the site definition for a worker process on the coordinator's host: the urls it has to remember are
+        in the queue, so its frontier is kept in memory, and its metrics, if any, are only written to a file of its
+        own, as the endpoint's port is the coordinator's
+    """
+    site_def = dict(site_def, **{'frontier-file': ':memory:'})
+    if site_def.get('metrics'):
+        snapshot = site_def['metrics'].get('snapshot')
+        if snapshot:
+            root, extension = os.path.splitext(snapshot)
+            snapshot = '{}-{}{}'.format(root, worker, extension)
+        site_def['metrics'] = dict(site_def['metrics'], port=None, snapshot=snapshot)
+    return site_def
+
+
+def run_worker(site_def: dict, multi: bool, log_level: int):
+    """
+    The body of a worker process started by the coordinator: crawl what it leases until the queue is finished. The
+    cookies of the coordinator's login are read from the cookie file.
+    :param site_def: the site definition
+    :param multi: whether to follow manga as well
+    :param log_level: the level of the coordinator's log
+    """
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('{levelname}:{processName}:{funcName} {message}', style='{'))
+    logger.addHandler(handler)
+    logger.setLevel(log_level)
+
+    from spiders import PixivSpider
+    worker = worker_name()
+    spider = PixivSpider(worker_site_def(site_def, worker))
+    try:
+        spider.work(open_queue(site_def['distributed']), worker, multi)
+    finally:
+        spider.close()
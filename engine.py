@@ -0,0 +1,85 @@
+# coding: utf-8
+"""
+File: engine.py
+
+Concurrent execution of spider stages for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import asyncio
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Any, List
+from urllib.parse import urlsplit
+
+
+logger = logging.getLogger('scr')
+
+
+class AsyncEngine:
+    """
+    Runs the blocking stages of a spider concurrently. Each call is handed to a worker thread, so the spider keeps
+    using its requests session, while asyncio decides how many calls may be in flight at the same time, overall and
+    towards any one host.
+    """
+    def __init__(self, site_def: dict):
+        """
+        Read the limits from the concurrency section of the site definition.
+        :param site_def: the site definition
+        """
+        concurrency = site_def.get('concurrency', {})
+        self.global_limit = concurrency.get('global', 8)
+        self.host_limit = concurrency.get('per-host', 4)
+        self.executor: ThreadPoolExecutor = None
+        self.everything: asyncio.Semaphore = None
+        self.hosts: defaultdict = None
+
+    def run(self, coroutine_function: Callable, *args) -> Any:
+        """
+        Run a coroutine function to completion with a fresh event loop and worker pool.
+        :param coroutine_function: typically a spider's main_async()
+        :param args: the arguments; the engine itself is passed as the first one
+        :return: whatever the coroutine returns
+        """
+        return asyncio.run(self._run(coroutine_function, *args))
+
+    def run_all(self, coroutine_functions: List[Callable], at_once: int, *args) -> List[Any]:
+        """
+        Run several coroutine functions, e.g. the main_async() of a spider for each target of a batch, sharing
+        one event loop, worker pool and set of limits.
+        :param coroutine_functions: the coroutine functions
+        :param at_once: the most of them that run at the same time
+        :param args: the arguments, passed to each after the engine
+        :return: what each coroutine returns
+        """
+        async def all_of_them(engine: AsyncEngine, *args) -> List[Any]:
+            limit = asyncio.Semaphore(at_once)
+
+            async def one(coroutine_function: Callable) -> Any:
+                async with limit:
+                    return await coroutine_function(engine, *args)
+
+            return await asyncio.gather(*(one(coroutine_function) for coroutine_function in coroutine_functions))
+
+        return self.run(all_of_them, *args)
+
+    async def _run(self, coroutine_function: Callable, *args) -> Any:
+        self.everything = asyncio.Semaphore(self.global_limit)
+        self.hosts = defaultdict(lambda: asyncio.Semaphore(self.host_limit))
+        with ThreadPoolExecutor(self.global_limit, thread_name_prefix='engine') as self.executor:
+            logger.debug('engine started, {} calls in flight, {} per host'.format(self.global_limit, self.host_limit))
+            return await coroutine_function(self, *args)
+
+    async def call(self, url: str, function: Callable, *args) -> Any:
+        """
+        Run a blocking function on a worker thread once both the global and the host limits allow it.
+        :param url: the url the function is going to fetch, used to pick the host limit
+        :param function: the blocking function
+        :param args: its arguments
+        :return: the return value of the function
+        """
+        # the host slot first, so that a call waiting on a busy host doesn't sit on a global slot
+        async with self.hosts[urlsplit(url).netloc], self.everything:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
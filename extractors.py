@@ -0,0 +1,258 @@
+# coding: utf-8
+"""
+File: extractors.py
+
+Extraction of the few values the spiders need from a page, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+from helper import ScraperException
+
+# bs4 and lxml take a while to import, so they are imported by the extractors that use them, when they are created
+
+
+class SoupExtractor:
+    """
+    Parses the whole page into a BeautifulSoup tree and searches it. The slowest way, but the most forgiving.
+    """
+    def __init__(self):
+        from bs4 import BeautifulSoup, SoupStrainer
+        self.BeautifulSoup, self.SoupStrainer = BeautifulSoup, SoupStrainer
+
+    def soup(self, content: bytes, *tags: str):
+        return self.BeautifulSoup(content, 'lxml')
+
+    @staticmethod
+    def attribute(tag, name: str, what: str) -> str:
+        if tag is None or tag.get(name) is None:
+            raise ScraperException('SoupExtractor', '{} not found'.format(what))
+        return tag[name]
+
+    def post_key(self, content: bytes) -> str:
+        """
+        :param content: the login page
+        :return: the value of the first input, the post key
+        """
+        return self.attribute(self.soup(content, 'input').find('input'), 'value', 'post key')
+
+    def ranking(self, content: bytes) -> Tuple[List[str], Optional[str]]:
+        """
+        :param content: the first page of a ranking
+        :return: the links to the detail pages and the tt key needed for the json pages, or no links and None if
+            the page has neither, e.g. an empty page
+        """
+        soup = self.soup(content, 'a', 'input')
+        links = [a['href'] for a in soup.find_all('a', 'title')]
+        tt = soup.find('input', attrs={'name': 'tt'})
+        if tt is None and not links:
+            return [], None
+        return links, self.attribute(tt, 'value', 'tt key')
+
+    def original_image(self, content: bytes) -> Optional[str]:
+        """
+        :param content: a detail page
+        :return: the url of the original image, or None if the page is a manga
+        """
+        img = self.soup(content, 'img').find('img', 'original-image')
+        return img['data-src'] if img is not None else None
+
+    def reader_link(self, content: bytes) -> str:
+        """
+        :param content: the detail page of a manga
+        :return: the link to the manga reader
+        """
+        return self.attribute(self.soup(content, 'a').find('a', 'read-more js-click-trackable'), 'href',
+                              'manga reader link')
+
+    def manga_images(self, content: bytes) -> List[str]:
+        """
+        :param content: a manga reader page
+        :return: the urls of the images of all the pages
+        """
+        return [img['data-src'] for img in self.soup(content, 'img').find_all('img', 'image')]
+
+
+class StrainerExtractor(SoupExtractor):
+    """
+    Builds a BeautifulSoup tree of only the tags that are searched, which saves most of the tree building.
+    """
+    def soup(self, content: bytes, *tags: str):
+        return self.BeautifulSoup(content, 'lxml', parse_only=self.SoupStrainer(tags))
+
+
+def has_class(name: str) -> str:
+    return 'contains(concat(" ", normalize-space(@class), " "), " {} ")'.format(name)
+
+
+class LxmlExtractor:
+    """
+    Parses with lxml alone and reads the values with XPath expressions compiled once.
+    """
+    def __init__(self):
+        from lxml import etree
+        self.etree = etree
+        self.post_key_path = etree.XPath('(//input)[1]/@value')
+        self.links_path = etree.XPath('//a[{}]/@href'.format(has_class('title')))
+        self.tt_path = etree.XPath('(//input[@name="tt"])[1]/@value')
+        self.original_path = etree.XPath('(//img[{}])[1]/@data-src'.format(has_class('original-image')))
+        self.reader_path = etree.XPath('(//a[@class="read-more js-click-trackable"])[1]/@href')
+        self.manga_path = etree.XPath('//img[{}]/@data-src'.format(has_class('image')))
+
+    def tree(self, content: bytes):
+        """
+        :param content: a page
+        :return: its tree, an empty one if the page is empty, as lxml has no tree for it, so that nothing is found
+        """
+        tree = self.etree.fromstring(content, self.etree.HTMLParser())
+        return tree if tree is not None else self.etree.Element('html')
+
+    @staticmethod
+    def first(path, tree, what: str) -> str:
+        found = path(tree)
+        if not found:
+            raise ScraperException('LxmlExtractor', '{} not found'.format(what))
+        return str(found[0])
+
+    def post_key(self, content: bytes) -> str:
+        return self.first(self.post_key_path, self.tree(content), 'post key')
+
+    def ranking(self, content: bytes) -> Tuple[List[str], Optional[str]]:
+        tree = self.tree(content)
+        links = [str(href) for href in self.links_path(tree)]
+        if not links and not self.tt_path(tree):
+            return [], None  # e.g. an empty page, with neither links nor the key to the pages that follow
+        return links, self.first(self.tt_path, tree, 'tt key')
+
+    def original_image(self, content: bytes) -> Optional[str]:
+        found = self.original_path(self.tree(content))
+        return str(found[0]) if found else None
+
+    def reader_link(self, content: bytes) -> str:
+        return self.first(self.reader_path, self.tree(content), 'manga reader link')
+
+    def manga_images(self, content: bytes) -> List[str]:
+        return [str(src) for src in self.manga_path(self.tree(content))]
+
+
+@lru_cache(maxsize=None)
+def compile_selector(selector: str):
+    """
+    Compile a selector of a site's rules, once however many rules use it.
+    :param selector: an XPath expression, or a CSS selector prefixed with css:, which can end in ::attr(name) or
+        ::text to select an attribute or the text of the elements; CSS needs cssselect
+    :return: the compiled XPath
+    """
+    from lxml import etree
+    expression = selector
+    if selector.startswith('css:'):
+        try:
+            from cssselect import GenericTranslator, SelectorError
+        except ImportError:
+            raise ScraperException('compile_selector', 'CSS selectors need cssselect: {}'.format(selector))
+        css, _, wanted = selector[4:].partition('::')
+        try:
+            expression = GenericTranslator().css_to_xpath(css.strip())
+        except SelectorError as e:
+            raise ScraperException('compile_selector', 'bad selector {}: {}'.format(selector, e))
+        if wanted.startswith('attr(') and wanted.endswith(')'):
+            expression += '/@' + wanted[5:-1]
+        elif wanted == 'text':
+            expression += '/text()'
+        elif wanted:
+            raise ScraperException('compile_selector', 'bad selector {}: use ::attr(name) or ::text'.format(selector))
+    try:
+        return etree.XPath(expression)
+    except etree.XPathSyntaxError as e:
+        raise ScraperException('compile_selector', 'bad selector {}: {}'.format(selector, e))
+
+
+class RuleExtractor:
+    """
+    Reads the pages of a site by the rules of its site definition instead of code. The rules are given for each
+    kind of page, e.g. listing or detail: the links to follow, by the kind of page they lead to, and the assets to
+    download. Each rule is a selector, or a list of them, see compile_selector(); all are compiled when the
+    extractor is created, and a page is parsed once for all the rules of its kind.
+    """
+    def __init__(self, pages_def: Dict[str, dict]):
+        """
+        :param pages_def: the pages section of the site definition, by kind, each with a follow section of
+            selectors by kind and an assets selector
+        """
+        from lxml import etree
+        self.etree = etree
+        self.follow = {kind: [(target, path) for target, selectors in page_def.get('follow', {}).items()
+                              for path in self.compile(selectors)]
+                       for kind, page_def in pages_def.items()}
+        self.assets = {kind: self.compile(page_def.get('assets')) for kind, page_def in pages_def.items()}
+        for kind, page_def in pages_def.items():
+            unknown = set(page_def.get('follow', {})) - set(pages_def)
+            if unknown:
+                raise ScraperException('RuleExtractor', 'the {} pages follow links to {}, which have no rules'.format(
+                    kind, ', '.join(sorted(unknown))))
+
+    @staticmethod
+    def compile(selectors) -> list:
+        if not selectors:
+            return []
+        return [compile_selector(selector) for selector in ([selectors] if isinstance(selectors, str) else selectors)]
+
+    @staticmethod
+    def values(found) -> List[str]:
+        return [value.strip() if isinstance(value, str) else ''.join(value.itertext()).strip()
+                for value in (found if isinstance(found, list) else [found])]
+
+    @property
+    def kinds(self) -> List[str]:
+        return list(self.follow)
+
+    def extract(self, kind: str, content: bytes) -> Tuple[Dict[str, List[str]], List[str]]:
+        """
+        :param kind: the kind of the page
+        :param content: the page
+        :return: the links found, by the kind of page they lead to, and the assets, as they are on the page
+        """
+        tree = self.etree.fromstring(content, self.etree.HTMLParser())
+        if tree is None:
+            return {}, []
+        links: Dict[str, List[str]] = {}
+        for target, path in self.follow[kind]:
+            links.setdefault(target, []).extend(value for value in self.values(path(tree)) if value)
+        return links, [value for path in self.assets[kind] for value in self.values(path(tree)) if value]
+
+
+EXTRACTORS = {'soup': SoupExtractor, 'strainer': StrainerExtractor, 'lxml': LxmlExtractor}
+
+
+def get_extractor(name: str):
+    """
+    :param name: the extractor named in the site definition
+    :return: an instance of the extractor
+    """
+    if name not in EXTRACTORS:
+        raise ScraperException('get_extractor', 'no extractor {}, choose one of {}'.format(name, ', '.join(EXTRACTORS)))
+    return EXTRACTORS[name]()
+
+
+worker_extractor = None
+
+
+def start_worker(name: str):
+    """
+    Set up a parse process: the extractor is created once per process, not once per page.
+    :param name: the extractor named in the site definition
+    """
+    global worker_extractor
+    worker_extractor = get_extractor(name)
+
+
+def run_extractor(method: str, content: bytes):
+    """
+    Called in a parse process: only the page goes in and only the extracted strings come back.
+    :param method: the extractor method, e.g. 'original_image'
+    :param content: the page
+    :return: what the method returns
+    """
+    return getattr(worker_extractor, method)(content)
@@ -0,0 +1,168 @@
+# coding: utf-8
+"""
+File: frontier.py
+
+Persistent record of the work a spider has discovered, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import copy
+import sqlite3
+import threading
+import time
+import logging
+from typing import List, Tuple, Optional
+from compact import UrlCodec, UrlPairs
+
+
+logger = logging.getLogger('scr')
+
+
+class Frontier:
+    """
+    The urls a spider has found and what has been done with them, kept in a single SQLite file so that an
+    interrupted crawl picks up where it stopped. Every url belongs to a target (e.g. a ranking and date) and has a
+    kind, which is the stage that handles it; its state moves from discovered to parsed, downloaded or failed.
+
+    Discoveries and state changes are buffered and written in batches. The frontier can be used from several
+    threads at once. The pending urls it hands out are kept compactly, see UrlPairs, as a crawl of many targets can
+    have millions of them.
+    """
+    DISCOVERED, PARSED, DOWNLOADED, FAILED = 'discovered', 'parsed', 'downloaded', 'failed'
+
+    def __init__(self, file_name: str, target: str, batch_size: int=500, codec: UrlCodec=None):
+        """
+        Open or create the frontier file.
+        :param file_name: the SQLite file
+        :param target: the target this frontier works on, all urls are recorded under it
+        :param batch_size: how many buffered changes trigger a write
+        :param codec: how the pending urls are kept in memory, e.g. with the site's url templates
+        """
+        self.file_name, self.target, self.batch_size = file_name, target, batch_size
+        self.codec = codec or UrlCodec()
+        self.lock = threading.RLock()
+        self.inserts: List[tuple] = []
+        self.updates: List[tuple] = []
+        self.db = sqlite3.connect(file_name, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS work (
+                               target TEXT NOT NULL,
+                               kind TEXT NOT NULL,
+                               url TEXT NOT NULL,
+                               referer TEXT,
+                               state TEXT NOT NULL,
+                               attempts INTEGER NOT NULL DEFAULT 0,
+                               discovered REAL NOT NULL,
+                               updated REAL NOT NULL,
+                               PRIMARY KEY (target, kind, url))''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS work_state ON work (target, kind, state)')
+        self.db.commit()
+
+    def discover(self, kind: str, url: str, referer: str=None):
+        """
+        Record a new url. Urls already known are left as they are.
+        :param kind: the stage that handles the url
+        :param url: the url
+        :param referer: the page the url was found on, if the stage needs it
+        """
+        now = time.time()
+        with self.lock:
+            self.inserts.append((self.target, kind, url, referer, self.DISCOVERED, now, now))
+            if len(self.inserts) >= self.batch_size:
+                self.flush()
+
+    def mark(self, kind: str, url: str, state: str):
+        """
+        Record the outcome of an attempt at an url.
+        :param kind: the stage that handled the url
+        :param url: the url
+        :param state: the new state
+        """
+        with self.lock:
+            self.updates.append((state, time.time(), self.target, kind, url))
+            if len(self.updates) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered discoveries and state changes in one transaction.
+        """
+        with self.lock:
+            if not self.inserts and not self.updates:
+                return
+            with self.db:
+                self.db.executemany('INSERT OR IGNORE INTO work'
+                                    ' (target, kind, url, referer, state, discovered, updated)'
+                                    ' VALUES (?, ?, ?, ?, ?, ?, ?)', self.inserts)
+                self.db.executemany('UPDATE work SET state = ?, attempts = attempts + 1, updated = ?'
+                                    ' WHERE target = ? AND kind = ? AND url = ?', self.updates)
+            logger.debug('frontier: wrote {} urls and {} updates'.format(len(self.inserts), len(self.updates)))
+            # emptied in place, the buffers may be shared with the frontiers of other targets
+            del self.inserts[:], self.updates[:]
+
+    def for_target(self, target: str) -> 'Frontier':
+        """
+        Get the frontier of another target in the same file. It shares this one's connection, buffers and lock, so
+        that the targets of a batch can be crawled at the same time without competing for the file.
+        :param target: the other target
+        :return: its frontier
+        """
+        frontier = copy.copy(self)
+        frontier.target = target
+        return frontier
+
+    def pending(self, kind: str) -> UrlPairs:
+        """
+        Get the urls of a kind that are still waiting to be handled.
+        :param kind: the stage
+        :return: the (url, referer) pairs, in the order they were discovered
+        """
+        with self.lock:
+            self.flush()
+            return UrlPairs(self.codec, self.db.execute('SELECT url, referer FROM work'
+                                                        ' WHERE target = ? AND kind = ? AND state = ? ORDER BY rowid',
+                                                        (self.target, kind, self.DISCOVERED)))
+
+    def counts(self) -> List[Tuple[str, str, str, int]]:
+        """
+        Count the urls of every target in the file by kind and state, as written: the buffered changes are left
+        for the next flush, so the numbers can be up to a batch behind.
+        :return: a list of (target, kind, state, count)
+        """
+        with self.lock:
+            return self.db.execute('SELECT target, kind, state, COUNT(*) FROM work'
+                                   ' GROUP BY target, kind, state').fetchall()
+
+    def state(self, kind: str, url: str) -> Optional[str]:
+        """
+        Get the state of a single url.
+        :param kind: the stage
+        :param url: the url
+        :return: the state, or None if the url is not known
+        """
+        with self.lock:
+            self.flush()
+            row = self.db.execute('SELECT state FROM work WHERE target = ? AND kind = ? AND url = ?',
+                                  (self.target, kind, url)).fetchone()
+            return row[0] if row is not None else None
+
+    def retry_failed(self) -> int:
+        """
+        Put the failed urls of the target back in the queue, for a retry pass.
+        :return: the number of urls requeued
+        """
+        with self.lock:
+            self.flush()
+            with self.db:
+                return self.db.execute('UPDATE work SET state = ?, updated = ? WHERE target = ? AND state = ?',
+                                       (self.DISCOVERED, time.time(), self.target, self.FAILED)).rowcount
+
+    def close(self):
+        """
+        Write whatever is buffered and close the file.
+        """
+        with self.lock:
+            self.flush()
+            self.db.close()
@@ -8,12 +8,16 @@ Helper classes and methods for the scrapers package.
 __author__ = 'Marko Čibej'
 
 
+import os
+import json
+import time
 import base64
-from typing import Optional
-from cryptography.fernet import Fernet, InvalidToken
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+import logging
+import tempfile
+from typing import Optional, Dict
+
+
+logger = logging.getLogger('scr')
 
 
 class ScraperException(Exception):
@@ -25,6 +29,7 @@ class ScraperException(Exception):
         :param raised_in: the method and class where the exception occurred
         :param description: the description of the error
         """
+        super().__init__(raised_in, description)  # so that it can be pickled, e.g. from a worker process
         self.raised_in, self.description = raised_in, description
 
     def __str__(self):
@@ -35,15 +40,26 @@ class SimpleCrypt:
     """
     Provide simple symmetric encryption and decryption for strings.
     """
-    def __init__(self, master_password: str):
+    def __init__(self, master_password: str=None, key: bytes=None):
         """
-        Create a key from the master password provided. The master password is not stored.
+        Create a key from the master password provided, or use a key created earlier. The master password is not
+        stored.
         :param master_password: what the name says
+        :param key: a key from an earlier SimpleCrypt, e.g. from a KeyCache
         """
-        kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=b'unsafe salt',
-                         iterations = 100000, backend=default_backend())
-        key_material = master_password.encode()
-        self.fernet = Fernet(base64.urlsafe_b64encode(kdf.derive(key_material)))
+        # cryptography is slow to import and only needed to log in, so it's imported here
+        from cryptography.fernet import Fernet
+        if key is None:
+            from cryptography.hazmat.backends import default_backend
+            from cryptography.hazmat.primitives import hashes
+            from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+            kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=b'unsafe salt',
+                             iterations = 100000, backend=default_backend())
+            key_material = master_password.encode()
+            key = base64.urlsafe_b64encode(kdf.derive(key_material))
+        self.key = key
+        self.fernet = Fernet(key)
+        self.decrypted: Dict[str, Optional[str]] = {}
 
     def encrypt(self, plaintext: str) -> bytes:
         """
@@ -56,11 +72,76 @@ class SimpleCrypt:
     def decrypt(self, token: bytes) -> Optional[str]:
         """
         The reverse of encrypt(). It traps the decryption exception and returns None if the decryption fails.
+        Each token is decrypted once, after that the plaintext is remembered.
         :param token: the base64 encrypted cyphertext
         :return: the decrypted plaintext
         """
+        from cryptography.fernet import InvalidToken
+        if token not in self.decrypted:
+            try:
+                self.decrypted[token] = self.fernet.decrypt(token).decode()
+            except InvalidToken:
+                self.decrypted[token] = None
+        return self.decrypted[token]
+
+
+class KeyCache:
+    """
+    Keeps the key of a SimpleCrypt in a file for ttl seconds, so that the runs started in that time neither ask for
+    the master password nor spend the time to derive the key again. The file is written readable by the user
+    only, and it is ignored unless it belongs to the user and nobody else can read it. By default it is kept in
+    the user's runtime directory, which is emptied when the user logs out.
+    """
+    def __init__(self, file_name: str, ttl: float):
+        """
+        :param file_name: the file holding the key
+        :param ttl: how long a stored key is used, in seconds
+        """
+        self.file_name, self.ttl = file_name, ttl
+
+    @staticmethod
+    def default_file() -> str:
+        directory = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+        return os.path.join(directory, 'scrapers-{}.key'.format(os.getuid() if hasattr(os, 'getuid') else 'key'))
+
+    def load(self) -> Optional[SimpleCrypt]:
+        """
+        :return: a SimpleCrypt with the stored key, or None if there is no usable key
+        """
         try:
-            b = self.fernet.decrypt(token)
-            return b.decode()
-        except InvalidToken:
+            with open(os.open(self.file_name, os.O_RDONLY | getattr(os, 'O_NOFOLLOW', 0)), encoding='utf-8') as f:
+                status = os.fstat(f.fileno())
+                if hasattr(os, 'getuid') and (status.st_uid != os.getuid() or status.st_mode & 0o077):
+                    return None
+                entry = json.load(f)
+            if entry['expires'] < time.time():
+                self.clear()
+                return None
+            return SimpleCrypt(key=entry['key'].encode())
+        except (OSError, ValueError, KeyError, TypeError):
             return None
+
+    def store(self, crypt: SimpleCrypt):
+        """
+        Keep the key of crypt for the next ttl seconds. Not being able to only means the password is asked for
+        again, so it is logged rather than raised.
+        :param crypt: the SimpleCrypt
+        """
+        temp_name = None
+        try:
+            # a name of its own, created readable by the user only
+            handle, temp_name = tempfile.mkstemp(prefix=os.path.basename(self.file_name) + '.', suffix='.tmp',
+                                                 dir=os.path.dirname(self.file_name) or None)
+            with open(handle, 'w', encoding='utf-8') as f:
+                json.dump({'key': crypt.key.decode(), 'expires': time.time() + self.ttl}, f)
+            os.replace(temp_name, self.file_name)
+        except OSError as e:
+            logger.warning('could not cache the key in {}: {}'.format(self.file_name, e))
+            if temp_name is not None and os.path.exists(temp_name):
+                os.unlink(temp_name)
+
+    def clear(self):
+        try:
+            os.unlink(self.file_name)
+        except OSError:
+            pass
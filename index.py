@@ -0,0 +1,94 @@
+# coding: utf-8
+"""
+File: index.py
+
+Persistent index of the works already downloaded, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import sqlite3
+import threading
+import time
+import re
+from typing import Optional
+
+
+class IllustIndex:
+    """
+    Remembers which illustrations and manga pages have been downloaded, and where to, across all targets. The ids
+    are the primary keys of SQLite tables, so a lookup is a single key search whose cost hardly grows with the
+    number of entries.
+    """
+    def __init__(self, file_name: str):
+        """
+        Open or create the index file.
+        :param file_name: the SQLite file
+        """
+        self.file_name = file_name
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, timeout=30, check_same_thread=False)  # the workers share it
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS illust (
+                               id INTEGER PRIMARY KEY,
+                               path TEXT,
+                               added REAL NOT NULL)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS manga_page (
+                               illust INTEGER NOT NULL,
+                               page INTEGER NOT NULL,
+                               path TEXT,
+                               added REAL NOT NULL,
+                               PRIMARY KEY (illust, page)) WITHOUT ROWID''')
+        self.db.commit()
+
+    @staticmethod
+    def page_key(page_id: str) -> tuple:
+        """
+        Split a manga page id, as found in the image urls, into the illustration id and the page number.
+        :param page_id: the page id, e.g. 12345678_p3
+        :return: the pair (12345678, 3)
+        """
+        match = re.match(r'(\d+)_\w(\d+)', page_id)
+        return int(match.group(1)), int(match.group(2))
+
+    def has(self, illust_id: int) -> bool:
+        """
+        :param illust_id: the illustration id
+        :return: True if the illustration, or all the pages of the manga, have been downloaded
+        """
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM illust WHERE id = ?', (int(illust_id),)).fetchone() is not None
+
+    def has_page(self, page_id: str) -> bool:
+        """
+        :param page_id: the manga page id, e.g. 12345678_p3
+        :return: True if the page has been downloaded
+        """
+        with self.lock:
+            return self.db.execute('SELECT 1 FROM manga_page WHERE illust = ? AND page = ?',
+                                   self.page_key(page_id)).fetchone() is not None
+
+    def add(self, illust_id: int, path: Optional[str]=None):
+        """
+        Record a downloaded illustration, or a manga with all its pages.
+        :param illust_id: the illustration id
+        :param path: the file it was saved to; None for manga
+        """
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO illust (id, path, added) VALUES (?, ?, ?)',
+                            (int(illust_id), path, time.time()))
+
+    def add_page(self, page_id: str, path: str):
+        """
+        Record a downloaded manga page.
+        :param page_id: the manga page id, e.g. 12345678_p3
+        :param path: the file it was saved to
+        """
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO manga_page (illust, page, path, added) VALUES (?, ?, ?, ?)',
+                            self.page_key(page_id) + (path, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -10,11 +10,11 @@ __author__ = 'Marko Čibej'
 
 import argparse
 import os
+import getpass
 import logging
 import time
 from config import Configuration
-from spiders import PixivSpider
-from helper import SimpleCrypt
+from helper import SimpleCrypt, KeyCache, ScraperException
 
 
 logger = logging.getLogger('scr')
@@ -33,6 +33,15 @@ def parse_args():
     parser.add_argument('-g', '--log-verbosity', help='increase verbosity of file log', action='count', default=1)
     parser.add_argument('-w', '--working-dir', help='the path to the working directory', default=os.getcwd())
     parser.add_argument('-s', '--site', help='the site to crawl')
+    parser.add_argument('-r', '--retry-failed', help='try again what failed in earlier runs', action='store_true')
+    parser.add_argument('-e', '--engine', choices=('sequential', 'threaded', 'async', 'pipeline'),
+                        help="how to run the crawl, instead of the site's engine setting")
+    parser.add_argument('-t', '--targets', nargs='+', metavar='RANKS:DATES',
+                        help='crawl a batch of targets, e.g. daily,weekly:20181101-20181130 monthly:20181130')
+    parser.add_argument('--role', choices=('coordinator', 'worker'),
+                        help='share the crawl: the coordinator queues the works, the workers crawl them')
+    parser.add_argument('-p', '--profile', action='store_true',
+                        help='profile each stage and write its pstats file and allocations to the working directory')
     return parser.parse_args()
 
 
@@ -49,7 +58,8 @@ def set_logging(working_dir, args: argparse.Namespace):
 
     # we always write at least WARNINGs to file; console output by default is ERROR
     # edits records are always INFO
-    max_verbosity = min(max(args.verbosity, args.log_verbosity, 4 if args.edits is not None else 0), len(log_levels))
+    edits = 4 if getattr(args, 'edits', None) is not None else 0
+    max_verbosity = min(max(args.verbosity, args.log_verbosity, edits), len(log_levels))
     logger.setLevel(log_levels[max_verbosity-1])
 
     # set up the file output
@@ -65,55 +75,156 @@ def set_logging(working_dir, args: argparse.Namespace):
     logger.addHandler(lc)
 
 
+def get_crypt(config: Configuration, token: str) -> SimpleCrypt:
+    """
+    Get the decryptor for the account credentials. If the key cache is enabled and holds a key that decrypts
+    the token, it is used; otherwise the master password is asked for, and the key derived from it is cached.
+
+    :param config: the configuration
+    :param token: an encrypted value from the configuration, to tell a right key from a wrong one
+    :return: the decryptor
+    """
+    ttl = config.get_global('key-cache-ttl', 0)
+    key_cache = KeyCache(config.get_global('key-cache-file', KeyCache.default_file()), ttl)
+    if ttl:
+        crypt = key_cache.load()
+        if crypt is not None and crypt.decrypt(token) is not None:
+            logger.debug('using the cached key')
+            return crypt
+
+    crypt = SimpleCrypt(getpass.getpass('Enter master password: '))
+    if crypt.decrypt(token) is None:
+        raise ScraperException('get_crypt', 'wrong master password')
+    if ttl:
+        key_cache.store(crypt)
+    return crypt
+
+
+def crawl_distributed(args: argparse.Namespace, site_def: dict, spider, spiders: list, multi: bool):
+    """
+    Run this process's part of a distributed crawl, as set in the distributed section of the site definition.
+
+    The coordinator queues the works of every target and starts the local worker processes, if any, then waits
+    until the queue is done. A worker crawls what it leases from the queue until the coordinator is done queueing
+    and nothing is left; the workers of other hosts reach the coordinator's queue through its queue-url.
+
+    :param args: the arguments from the command line
+    :param site_def: the site definition
+    :param spider: the spider
+    :param spiders: its spiders for the targets of the batch
+    :param multi: whether to follow manga as well
+    """
+    import multiprocessing
+    from distributed import ShardQueue, serve_queue, open_queue, run_worker, worker_name
+    distributed_def = site_def.get('distributed', {})
+    if args.role == 'worker':
+        spider.work(open_queue(distributed_def), worker_name(), multi)
+        return
+
+    queue = ShardQueue(distributed_def['queue-file'], distributed_def.get('shards', 64),
+                       distributed_def.get('lease', 60))
+    if args.retry_failed:
+        logger.info('retrying {} failed works'.format(queue.retry_failed()))
+    server = serve_queue(queue, distributed_def['serve'], distributed_def.get('token')) \
+        if distributed_def.get('serve') else None
+    queue.open()
+    # spawned rather than forked, so that they start without the threads and connections of this process
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=run_worker, args=(site_def, multi, logger.getEffectiveLevel()),
+                               name='worker-{}'.format(i)) for i in range(distributed_def.get('local-workers', 0))]
+    for worker in workers:
+        worker.start()
+    for target_spider in spiders:
+        target_spider.enumerate_work(queue)
+    queue.close()
+
+    while not queue.finished():
+        if workers and server is None and not any(worker.is_alive() for worker in workers):
+            logger.error('the workers stopped with work left: {}'.format(queue.counts()))
+            break
+        time.sleep(distributed_def.get('poll', 2))
+    for worker in workers:
+        worker.join()
+    if server is not None:
+        server.shutdown()
+    logger.info('distributed crawl done: {}'.format(queue.counts()))
+
+
 def start():
     """
     This function is the starting point of the package. Start by setting up the environment,
     initialize the appropriate spider and target, then download a set of resources.
     """
     args = parse_args()
+    # the spiders pull in requests and the parsers, so they are imported only once the arguments are known to be good
+    from spiders import get_spider
     set_logging(os.getcwd(), args)
     config = Configuration(args.config)
     config.set_global('working-dir', args.working_dir)
     start_time = time.time()
 
-    spider = PixivSpider(config.get_site(args.site))
-
-    if not spider.check_login():
-        master_password = input('Enter master password\n')
-        spider.login(SimpleCrypt(master_password))
-    else:
-        logger.info('already logged into site {}'.format(args.site))
+    site_def = config.get_site(args.site)
+    profiler = None
+    if args.profile:
+        from profiler import StageProfiler
+        profiler = StageProfiler(args.working_dir)
+        if site_def.get('parse-workers'):
+            # the parse processes would be profiled as time spent waiting for them
+            logger.info('parsing in the crawling process while profiling')
+            site_def['parse-workers'] = 0
+        profiler.start()
+    if site_def.get('parse-workers') and args.role is None and \
+            (args.engine or site_def.get('engine', 'sequential')) == 'sequential':
+        # one page at a time is parsed no faster elsewhere, only sent there and back
+        logger.info('parsing in the crawling process with the sequential engine')
+        site_def['parse-workers'] = 0
+    spider = get_spider(config, args.site)
+
+    try:
+        login, login_crypt = spider.login, get_crypt
+        if profiler is not None:
+            login, login_crypt = profiler.wrap('login', login, type(spider).login), profiler.wrap('login', get_crypt)
+        if not spider.check_login():
+            if not login(login_crypt(config, site_def['account']['username'])):
+                raise ScraperException('start', 'could not log into site {}'.format(args.site))
+        else:
+            logger.info('already logged into site {}'.format(args.site))
+
+        if profiler is not None:
+            spider.instrument(profiler)  # and with it the spiders of the targets, and those of a worker's work
+        # a batch of targets shares the spider's session, index and pools
+        targets = args.targets or site_def.get('targets')
+        spiders = spider.for_targets(targets) if targets else [spider]
+        if len(spiders) > 1:
+            logger.info('crawling {} targets'.format(len(spiders)))
+
+        if args.retry_failed:
+            for target_spider in spiders:
+                logger.info('retrying {} failed urls of {}'.format(target_spider.frontier.retry_failed(),
+                                                                    target_spider.frontier.target))
+
+        multi = site_def.get('multi', False)
+        engine = args.engine or site_def.get('engine', 'sequential')
+        if engine in ('async', 'pipeline') and not hasattr(spider, 'main_async'):
+            logger.warning('the {} spider has no {} engine, crawling threaded'.format(args.site, engine))
+            engine = 'threaded'
+        if args.role is not None:
+            crawl_distributed(args, site_def, spider, spiders, multi)
+        elif engine in ('async', 'pipeline'):
+            from engine import AsyncEngine
+            mains = [target_spider.main_async if engine == 'async' else target_spider.main_pipeline
+                     for target_spider in spiders]
+            AsyncEngine(site_def).run_all(mains, site_def.get('targets-at-once', 4), multi)
+        elif engine == 'threaded':
+            for target_spider in spiders:
+                target_spider.main_threaded(multi)
+        else:
+            for target_spider in spiders:
+                target_spider.main(multi)
+    finally:
+        # the parse processes are stopped, and the manifest and the metrics written, even if the crawl failed
+        spider.close()
+        if profiler is not None:
+            profiler.stop()
 
     logger.info(time.strftime('finished in %H:%M:%S', time.gmtime(time.time() - start_time)))
-
-    count = 0
-    multi_count = 0
-
-    spider.start_spider()
-
-    for next_page in spider.next_pages_url:
-        spider.parse_json(next_page)
-
-    for url in spider.prepare_url:
-        spider.on_spider(url)
-
-    for downloadUrl, pageUrl in spider.origin_url.items():
-        count += 1
-        spider.download_pic(downloadUrl, pageUrl)
-        print(f'downloading {count} pictures')
-
-    if multi:
-        for multiUrl in Pixiv.multipic_url:
-            spider.parse_multipic(multiUrl)
-
-        for page_url, multipic_urlList in Pixiv.really_multipic_url.items():
-            for multipicUrl in multipic_urlList:
-                multi_count += 1
-                spider.download_multipic(multipicUrl, page_url)
-                print(f'downloading {multi_count} manga')
-
-    print(f'downloaded {count} pictures,{multi_count} manga')
-
-
-
-
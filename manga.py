@@ -0,0 +1,82 @@
+# coding: utf-8
+"""
+File: manga.py
+
+Concurrent downloads of the pages of a manga, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import logging
+import threading
+from concurrent.futures import Executor, Future
+from typing import Callable, List, Optional
+
+
+logger = logging.getLogger('scr')
+
+
+class MangaWork:
+    """
+    The pages of one manga, downloaded on a shared pool of threads. The pages are handed to the pool in order, and
+    at most window of them at a time, so that many manga can share the pool without one of them taking all of it,
+    and the first pages are done first. Each finished page lets the next one in.
+
+    The work keeps track of how many pages have been downloaded in order from the first, which are the ones that can
+    be read even if a later page failed, and resolves its done future once all the pages are finished, with whether
+    all succeeded.
+    """
+    def __init__(self, reader_url: str, page_urls: List[str], download: Callable[[str, str], bool],
+                 executor: Executor, window: int=4):
+        """
+        :param reader_url: the reader page, the referer of the pages
+        :param page_urls: the image urls of the pages, in order
+        :param download: the function that downloads a page, given its url and the reader url
+        :param executor: the pool of threads
+        :param window: the most pages of this manga downloaded at the same time
+        """
+        self.reader_url, self.page_urls, self.download = reader_url, page_urls, download
+        self.executor, self.window = executor, max(1, window)
+        self.lock = threading.Lock()
+        self.results: List[Optional[bool]] = [None] * len(page_urls)
+        self.submitted = self.finished_pages = 0
+        self.in_order = 0  # the pages downloaded in order from the first
+        self.done: Future = Future()
+
+    def start(self) -> Future:
+        """
+        Start the first window of pages.
+        :return: the done future
+        """
+        if not self.page_urls:
+            self.done.set_result(True)
+            return self.done
+        with self.lock:
+            first = self.submitted
+            self.submitted = min(self.window, len(self.page_urls))
+        for index in range(first, self.submitted):
+            self.submit(index)
+        return self.done
+
+    def submit(self, index: int):
+        future = self.executor.submit(self.download, self.page_urls[index], self.reader_url)
+        future.add_done_callback(lambda future: self.finished(index, future))
+
+    def finished(self, index: int, future: Future):
+        succeeded = future.exception() is None and bool(future.result())
+        with self.lock:
+            self.results[index] = succeeded
+            self.finished_pages += 1
+            while self.in_order < len(self.results) and self.results[self.in_order]:
+                self.in_order += 1
+            following = self.submitted if self.submitted < len(self.page_urls) else None
+            if following is not None:
+                self.submitted += 1
+            complete = self.finished_pages == len(self.results)
+        if following is not None:
+            self.submit(following)
+        if complete:
+            if self.in_order < len(self.results):
+                logger.warning('{}: only the first {} of {} pages can be read'.format(
+                    self.reader_url, self.in_order, len(self.results)))
+            self.done.set_result(self.in_order == len(self.results))
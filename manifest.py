@@ -0,0 +1,264 @@
+# coding: utf-8
+"""
+File: manifest.py
+
+A record of every download of a crawl, one json line each, and an index to find them, for the scrapers package.
+
+    python manifest.py --index manifests/manifest-index.sqlite [--id ILLUST_ID] [--date YYYYMMDD] [--rank RANK]
+    python manifest.py --manifest manifests/pixiv-20181111-101500-4242.jsonl.gz [--id ...] [--date ...] [--rank ...]
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import sys
+import gzip
+import json
+import time
+import queue
+import sqlite3
+import logging
+import argparse
+import threading
+from typing import Iterator, List
+from helper import ScraperException
+
+
+logger = logging.getLogger('scr')
+
+
+class ManifestIndex:
+    """
+    The sidecar of the manifests: where in which manifest the record of each download is, by illust id and by date
+    and rank, so that a lookup reads a few lines instead of all the manifests. It is an SQLite file shared by the
+    manifests of all the runs in a directory.
+    """
+    def __init__(self, file_name: str):
+        """
+        Open or create the index file.
+        :param file_name: the SQLite file
+        """
+        self.file_name = file_name
+        self.directory = os.path.dirname(file_name)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file_name, timeout=30, check_same_thread=False)  # the workers share it
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS record (
+                               illust INTEGER,
+                               date TEXT,
+                               rank TEXT,
+                               manifest TEXT NOT NULL,
+                               offset INTEGER NOT NULL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS record_illust ON record (illust)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS record_date ON record (date, rank)')
+        self.db.commit()
+
+    def add(self, manifest: str, records: List[tuple]):
+        """
+        Index the records just written to a manifest, in one transaction.
+        :param manifest: the manifest, relative to the index's directory
+        :param records: (record, offset) pairs, the offset of the record's line in the uncompressed manifest
+        """
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO record (illust, date, rank, manifest, offset) VALUES (?, ?, ?, ?, ?)',
+                                ((record.get('illust'), record.get('date'), record.get('rank'), manifest, offset)
+                                 for record, offset in records))
+
+    def find(self, illust_id: int=None, date: str=None, rank: str=None) -> List[dict]:
+        """
+        Find the records of the downloads of an illust, or of a date and possibly a rank, or of all three.
+        :param illust_id: the illust id
+        :param date: the date of the ranking, YYYYMMDD
+        :param rank: the rank, e.g. 'daily'
+        :return: the records, read from their manifests, in the order they were written
+        """
+        conditions = [(column, value) for column, value in (('illust', illust_id), ('date', date), ('rank', rank))
+                      if value is not None]
+        if not conditions:
+            raise ScraperException('ManifestIndex.find', 'give an illust id, a date or a rank')
+        with self.lock:
+            found = self.db.execute('SELECT manifest, offset FROM record WHERE {} ORDER BY rowid'.format(
+                ' AND '.join('{} = ?'.format(column) for column, _ in conditions)),
+                [value for _, value in conditions]).fetchall()
+        by_manifest = {}
+        for manifest, offset in found:
+            by_manifest.setdefault(manifest, []).append(offset)
+        records = {}
+        for manifest, offsets in by_manifest.items():
+            # one pass over each manifest, forward only, as a compressed one can only be sought by reading it
+            with open_manifest(os.path.join(self.directory, manifest), 'rb') as f:
+                for offset in sorted(offsets):
+                    f.seek(offset)
+                    records[manifest, offset] = json.loads(f.readline())
+        return [records[key] for key in found]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_manifest(file_name: str, mode: str):
+    return gzip.open(file_name, mode) if file_name.endswith('.gz') else open(file_name, mode)
+
+
+def read_manifest(file_name: str) -> Iterator[dict]:
+    """
+    Read the records of a manifest, including one that a run left unfinished.
+    :param file_name: the manifest
+    :return: the records
+    """
+    with open_manifest(file_name, 'rb') as f:
+        try:
+            for line in f:
+                if line.endswith(b'\n'):
+                    yield json.loads(line)
+        except EOFError:
+            pass  # a compressed manifest of a run that was stopped has no end, but the lines before it are whole
+
+
+class Manifest:
+    """
+    Writes a record of every download of a run to a manifest of its own, one json line each, e.g. the illust id,
+    rank and date, the url, the file, its size and digest, and how long it took. Optionally the manifest is
+    compressed with gzip.
+
+    The downloads only hand their records over; a thread writes them in batches, flushes each batch so that the
+    manifest can be read while the run goes on, and adds it to the index. The file is created with the manifest,
+    so that a manifest that cannot be written is found out before the crawl; the thread is started with the first
+    record, so that the parse processes are forked before there are threads to fork.
+    """
+    def __init__(self, directory: str, name: str, compress: bool=False, index_file: str=None, batch_size: int=1000):
+        """
+        Start a manifest.
+        :param directory: where the manifests are kept
+        :param name: the name of the run's manifest, without the extension
+        :param compress: whether to compress it
+        :param index_file: the index, shared by all the manifests in the directory, by default manifest-index.sqlite
+            in it
+        :param batch_size: the most records written at once
+        """
+        os.makedirs(directory, exist_ok=True)
+        extension, taken = '.jsonl.gz' if compress else '.jsonl', 0
+        while True:
+            self.name = (name if not taken else '{}-{}'.format(name, taken)) + extension
+            self.file_name = os.path.join(directory, self.name)
+            try:
+                self.file = open_manifest(self.file_name, 'xb')
+                break
+            except FileExistsError:
+                taken += 1  # another run of the same second and pid, e.g. in a container
+        self.batch_size = batch_size
+        self.index = ManifestIndex(index_file or os.path.join(directory, 'manifest-index.sqlite'))
+        self.indexed_name = os.path.relpath(self.file_name, self.index.directory or '.')
+        self.offset = 0
+        self.written = 0
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.writer: threading.Thread = None
+
+    @classmethod
+    def from_definition(cls, manifest_def: dict, slug: str) -> 'Manifest':
+        """
+        Create the manifest of a run from the manifest section of a site definition. The manifest is named by the
+        site, the time and the process, so that the runs, and the worker processes of a run, have one each.
+        :param manifest_def: the section
+        :param slug: the site
+        :return: the manifest
+        """
+        directory = manifest_def.get('directory', 'manifests')
+        name = '{}-{}-{}'.format(slug, time.strftime('%Y%m%d-%H%M%S'), os.getpid())
+        return cls(directory, name, manifest_def.get('compress', False), manifest_def.get('index-file'),
+                   manifest_def.get('batch', 1000))
+
+    def record(self, **fields):
+        """
+        Hand a record to the writer, without waiting for it. Not being able to is not the download's failure, so
+        it is only logged.
+        :param fields: the fields of the record; those that are None are left out
+        """
+        try:
+            if self.writer is None:
+                with self.lock:
+                    if self.writer is None:
+                        self.writer = threading.Thread(target=self.write_records, name='manifest', daemon=True)
+                        self.writer.start()
+            self.queue.put({key: value for key, value in fields.items() if value is not None})
+        except Exception as e:
+            logger.warning('could not record {} in {}: {}'.format(fields.get('url'), self.file_name, e))
+
+    def write_records(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                stopping = True
+                batch.pop()
+            if not batch:
+                continue
+            try:
+                indexed = []
+                for record in batch:
+                    try:
+                        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode() + b'\n'
+                    except (TypeError, ValueError) as e:
+                        logger.warning('could not record {}: {}'.format(record.get('url'), e))
+                        continue
+                    self.file.write(line)
+                    indexed.append((record, self.offset))
+                    self.offset += len(line)
+                self.file.flush()
+                self.index.add(self.indexed_name, indexed)
+                self.written += len(indexed)
+            except (OSError, sqlite3.Error) as e:
+                logger.warning('could not write {} records to {}: {}'.format(len(batch), self.file_name, e))
+
+    def close(self):
+        """
+        Write the records still waiting and close the manifest.
+        """
+        with self.lock:
+            if self.writer is not None:
+                self.queue.put(None)
+                self.writer.join()
+            self.file.close()
+        logger.info('{} downloads recorded in {}'.format(self.written, self.file_name))
+        self.index.close()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Find downloads in the manifests of the crawls')
+    parser.add_argument('-x', '--index', help='the index of the manifests', default='manifests/manifest-index.sqlite')
+    parser.add_argument('-m', '--manifest', action='append',
+                        help='read these manifests instead of looking in the index, e.g. one without an index')
+    parser.add_argument('-i', '--id', help='the illust id', type=int)
+    parser.add_argument('-d', '--date', help='the date of the ranking, YYYYMMDD')
+    parser.add_argument('-r', '--rank', help="the rank, e.g. 'daily'")
+    return parser.parse_args()
+
+
+def matches(record: dict, arguments: argparse.Namespace) -> bool:
+    return all(wanted is None or record.get(field) == wanted
+               for field, wanted in (('illust', arguments.id), ('date', arguments.date), ('rank', arguments.rank)))
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.manifest:
+        # all the records of the manifests, or the ones asked for
+        for manifest_name in arguments.manifest:
+            for found in read_manifest(manifest_name):
+                if matches(found, arguments):
+                    print(json.dumps(found, ensure_ascii=False))
+        sys.exit()
+    if not os.path.exists(arguments.index):
+        sys.exit('no index {}'.format(arguments.index))
+    if arguments.id is None and arguments.date is None and arguments.rank is None:
+        sys.exit('give an illust id, a date or a rank')
+    for found in ManifestIndex(arguments.index).find(arguments.id, arguments.date, arguments.rank):
+        print(json.dumps(found, ensure_ascii=False))
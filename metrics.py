@@ -0,0 +1,283 @@
+# coding: utf-8
+"""
+File: metrics.py
+
+Counters, latency histograms and their export, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+logger = logging.getLogger('scr')
+
+
+class Histogram:
+    """
+    Counts observations into buckets by their upper bounds, the way Prometheus expects them.
+    """
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        :return: (upper bound, observations up to it) pairs, ending with +Inf
+        """
+        total, buckets = 0, []
+        for bound, count in zip([str(bound) for bound in self.bounds] + ['+Inf'], self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+
+class Metrics:
+    """
+    The counters and histograms of a crawl, safe to update from any thread. A metric is a name and a set of labels,
+    e.g. scrapers_stage_seconds{stage="detail"}. Values kept elsewhere, such as the cache statistics, are read
+    through collectors only when the metrics are exported, so they cost nothing while the crawl runs.
+
+    Nothing here is called unless a spider has metrics: the spiders check for None first.
+    """
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, buckets: Tuple[float, ...]=BUCKETS):
+        """
+        :param buckets: the upper bounds of the histogram buckets, in seconds
+        """
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self.collectors: List[Callable] = []
+
+    def count(self, name: str, value: float=1, **labels):
+        """
+        Add to a counter.
+        :param name: the counter, ending in _total
+        :param value: how much to add
+        :param labels: its labels
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        """
+        Add an observation to a histogram.
+        :param name: the histogram, e.g. scrapers_stage_seconds
+        :param value: the observation, in seconds
+        :param labels: its labels
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+
+    def collect(self, collector: Callable[[], Iterable[Tuple[str, dict, float]]]) -> Callable:
+        """
+        Add a collector, a function that is called on every export and returns (name, labels, value) triples.
+        The names ending in _total are exported as counters, the others as gauges.
+        :param collector: the function
+        :return: the same function, to forget() it later
+        """
+        with self.lock:
+            self.collectors.append(collector)
+        return collector
+
+    def forget(self, collector: Callable):
+        """
+        Remove a collector, e.g. one that reads a queue that is about to go away.
+        :param collector: the function collect() was given
+        """
+        with self.lock:
+            if collector in self.collectors:
+                self.collectors.remove(collector)
+
+    def timed(self, stage: str, function: Callable) -> Callable:
+        """
+        Wrap a stage function so that each call is counted, by outcome, and its duration observed. A call fails if
+        it raises, or returns False as the download stages do.
+        :param stage: the stage, e.g. 'detail'
+        :param function: the function
+        :return: the wrapped function
+        """
+        def timed_function(*args, **kwargs):
+            started, outcome = time.perf_counter(), 'failed'
+            try:
+                result = function(*args, **kwargs)
+                if result is not False:
+                    outcome = 'ok'
+                return result
+            finally:
+                self.observe('scrapers_stage_seconds', time.perf_counter() - started, stage=stage)
+                self.count('scrapers_stage_calls_total', stage=stage, outcome=outcome)
+        return timed_function
+
+    def instrument(self, obj, stages: Dict[str, str]):
+        """
+        Time the stage methods of an object. The methods are taken from its class, so that an object copied from
+        an instrumented one is not timed twice, or on behalf of the original.
+        :param obj: e.g. a spider
+        :param stages: the stage of each method, by method name
+        """
+        for method, stage in stages.items():
+            setattr(obj, method, self.timed(stage, getattr(type(obj), method).__get__(obj)))
+
+    def samples(self) -> Tuple[list, list]:
+        """
+        :return: the (name, labels, value) samples of the counters and of the collectors, and the (name, labels,
+            histogram) samples of the histograms, with the labels as sorted (label, value) tuples
+        """
+        with self.lock:
+            values = [(name, labels, value) for (name, labels), value in self.counters.items()]
+            histograms = [(name, labels, histogram.cumulative(), histogram.sum, histogram.count)
+                          for (name, labels), histogram in self.histograms.items()]
+            collectors = list(self.collectors)
+        for collector in collectors:
+            try:
+                values.extend((name, tuple(sorted(labels.items())), value) for name, labels, value in collector())
+            except Exception as e:
+                logger.debug('metrics collector {} failed: {}'.format(getattr(collector, '__name__', collector), e))
+        return sorted(values), sorted(histograms, key=lambda sample: sample[:2])
+
+    def snapshot(self) -> dict:
+        """
+        :return: all the metrics, as a dict that can be written as json
+        """
+        values, histograms = self.samples()
+        metrics = {}
+        for name, labels, value in values:
+            metrics.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        for name, labels, buckets, total, count in histograms:
+            metrics.setdefault(name, []).append({'labels': dict(labels), 'count': count, 'sum': total,
+                                                 'buckets': dict(buckets)})
+        return {'time': time.time(), 'metrics': metrics}
+
+    def prometheus(self) -> str:
+        """
+        :return: all the metrics in the Prometheus text format
+        """
+        values, histograms = self.samples()
+        lines, typed = [], set()
+        for name, labels, value in values:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} {}'.format(name, 'counter' if name.endswith('_total') else 'gauge'))
+            lines.append('{}{} {}'.format(name, label_text(labels), value))
+        for name, labels, buckets, total, count in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            for bound, cumulative in buckets:
+                lines.append('{}_bucket{} {}'.format(name, label_text(labels + (('le', bound),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, label_text(labels), total))
+            lines.append('{}_count{} {}'.format(name, label_text(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def label_text(labels: tuple) -> str:
+    """
+    :param labels: (label, value) pairs
+    :return: the labels as Prometheus writes them, e.g. {stage="detail"}, or nothing if there are none
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(label, str(value).replace('\\', r'\\').replace('"', r'\"')
+                                           .replace('\n', r'\n')) for label, value in labels) + '}'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    server: 'MetricsServer'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] == '/metrics':
+            body, content_type, code = self.server.metrics.prometheus().encode(), \
+                'text/plain; version=0.0.4; charset=utf-8', 200
+        else:
+            body, content_type, code = b'not found', 'text/plain', 404
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(ThreadingHTTPServer):
+    daemon_threads = True
+    metrics: Metrics = None
+
+
+class MetricsExporter:
+    """
+    Exports metrics as set in the metrics section of the site definition: on a /metrics endpoint for Prometheus to
+    scrape, if a port is given, and to a json snapshot file written every interval seconds, if a file is given.
+    """
+    def __init__(self, metrics: Metrics, metrics_def: dict):
+        """
+        :param metrics: the metrics
+        :param metrics_def: the section, with port, host, snapshot and interval
+        """
+        self.metrics = metrics
+        self.snapshot_file = metrics_def.get('snapshot')
+        self.interval = metrics_def.get('interval', 10)
+        self.stopped = threading.Event()
+        self.server: MetricsServer = None
+        self.writer: threading.Thread = None
+
+        if metrics_def.get('port') is not None:
+            self.server = MetricsServer((metrics_def.get('host', '127.0.0.1'), metrics_def['port']), MetricsHandler)
+            self.server.metrics = metrics
+            threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+            logger.info('metrics on http://{}:{}/metrics'.format(*self.server.server_address[:2]))
+        if self.snapshot_file:
+            self.writer = threading.Thread(target=self.write_snapshots, name='metrics-snapshot', daemon=True)
+            self.writer.start()
+
+    def write_snapshot(self):
+        """
+        Write the snapshot file, whole: a reader never sees half of one.
+        """
+        temporary = self.snapshot_file + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            json.dump(self.metrics.snapshot(), f, indent=1)
+        os.replace(temporary, self.snapshot_file)
+
+    def write_snapshots(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                logger.warning('could not write the metrics to {}: {}'.format(self.snapshot_file, e))
+
+    def stop(self):
+        """
+        Stop the endpoint and the snapshots, and write a last snapshot with the final numbers.
+        """
+        self.stopped.set()
+        if self.writer is not None:
+            self.writer.join()
+            self.write_snapshot()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
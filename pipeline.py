@@ -0,0 +1,90 @@
+# coding: utf-8
+"""
+File: pipeline.py
+
+Crawl stages connected by bounded queues, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import asyncio
+import logging
+from typing import Callable, Any, Dict, List
+
+
+logger = logging.getLogger('scr')
+
+
+class Stage:
+    """
+    A queue and the workers that take items from it.
+    """
+    def __init__(self, name: str, handler: Callable, workers: int, queue_size: int):
+        """
+        :param name: the name of the stage
+        :param handler: a coroutine function that handles one item and puts its results on later stages
+        :param workers: how many items the stage handles at the same time
+        :param queue_size: how many items may wait; a stage putting on a full queue waits
+        """
+        self.name, self.handler, self.workers = name, handler, workers
+        self.queue = asyncio.Queue(queue_size)
+        self.handled = 0
+
+
+class Pipeline:
+    """
+    Work flows from stage to stage as soon as it is found, instead of each stage waiting for the previous one to
+    finish. The queues are bounded, so a fast stage is held back by a slow one rather than piling up items in
+    memory. The stages must be added in order: an item may only be put on a later stage than the one handling it,
+    which is what lets the pipeline tell when it is done.
+    """
+    def __init__(self, queue_size: int=100):
+        self.queue_size = queue_size
+        self.stages: Dict[str, Stage] = {}
+
+    def add_stage(self, name: str, handler: Callable, workers: int=1):
+        self.stages[name] = Stage(name, handler, workers, self.queue_size)
+
+    async def put(self, name: str, item: Any):
+        """
+        Queue an item on a stage, waiting while the queue is full.
+        :param name: the stage
+        :param item: the item
+        """
+        await self.stages[name].queue.put(item)
+
+    def depths(self) -> Dict[str, int]:
+        """
+        :return: the number of items waiting, by stage
+        """
+        return {name: stage.queue.qsize() for name, stage in self.stages.items()}
+
+    async def run(self, seed: Callable):
+        """
+        Start the workers, put the first items on the stages and wait until every stage is empty.
+        :param seed: a coroutine function that puts the first items
+        """
+        workers: List[asyncio.Task] = [asyncio.ensure_future(self.work(stage))
+                                       for stage in self.stages.values() for _ in range(stage.workers)]
+        try:
+            await seed()
+            # once a stage is empty no earlier stage can fill it again, so the stages are waited for in order
+            for stage in self.stages.values():
+                await stage.queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        logger.debug('pipeline done: {}'.format(', '.join('{} {}'.format(stage.name, stage.handled)
+                                                          for stage in self.stages.values())))
+
+    async def work(self, stage: Stage):
+        while True:
+            item = await stage.queue.get()
+            try:
+                await stage.handler(item)
+            except Exception as e:
+                logger.error('{} stage failed on {}: {}'.format(stage.name, item, e))
+            finally:
+                stage.handled += 1
+                stage.queue.task_done()
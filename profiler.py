@@ -0,0 +1,195 @@
+# coding: utf-8
+"""
+File: profiler.py
+
+Profiling of the stages of a crawl with cProfile and tracemalloc, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+import linecache
+from typing import Callable, Dict, List, Tuple
+
+
+logger = logging.getLogger('scr')
+
+
+class StageProfiler:
+    """
+    Profiles the stages of a crawl, e.g. login, detail or download, from whichever threads they run in.
+
+    cProfile only sees the thread that enabled it, so each thread gets a profile of its own for each stage, and the
+    profiles of a stage are added together at the end. A stage called from within another is counted in the outer
+    one.
+
+    tracemalloc traces the whole process, so the allocations are told apart by the stage functions in their
+    tracebacks instead. The memory of each stage is looked at twice: at the highest it was seen while the stage was
+    running, looking every interval seconds, which shows what the stage holds while it runs, e.g. the parse trees,
+    and at the end, which shows what it left behind.
+    """
+    def __init__(self, directory: str, frames: int=32, top: int=20, interval: float=1.0):
+        """
+        :param directory: where the reports are written
+        :param frames: the frames tracemalloc keeps of each allocation; too few and the stage is cut off
+        :param top: the lines of each allocation report
+        :param interval: seconds between two looks at the memory
+        """
+        self.directory, self.frames, self.top, self.interval = directory, frames, top, interval
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.profiles: Dict[str, List[cProfile.Profile]] = {}
+        self.stage_lines: Dict[Tuple[str, int], str] = {}
+        self.running: Dict[str, int] = {}
+        self.peaks: Dict[str, Tuple[int, tracemalloc.Snapshot]] = {}
+        self.stopped = threading.Event()
+        self.watcher: threading.Thread = None
+
+    def start(self):
+        """
+        Start tracing the allocations.
+        """
+        tracemalloc.start(self.frames)
+        self.watcher = threading.Thread(target=self.watch, name='profiler', daemon=True)
+        self.watcher.start()
+
+    def watch(self):
+        while not self.stopped.wait(self.interval):
+            size = tracemalloc.get_traced_memory()[0]
+            with self.lock:
+                higher = [stage for stage, calls in self.running.items()
+                          if calls and size > self.peaks.get(stage, (0, None))[0]]
+            if higher:
+                snapshot = tracemalloc.take_snapshot()
+                with self.lock:
+                    self.peaks.update((stage, (size, snapshot)) for stage in higher)
+
+    def wrap(self, stage: str, function: Callable, code_function: Callable=None) -> Callable:
+        """
+        Profile a stage function.
+        :param stage: the stage
+        :param function: the function, e.g. a bound method, possibly already wrapped by something else
+        :param code_function: the plain function whose frames mark the allocations of the stage, if function is
+            a wrapper
+        :return: the wrapped function
+        """
+        code = getattr(code_function or function, '__code__', None)
+        if code is not None:
+            with self.lock:
+                self.stage_lines.update(((code.co_filename, line), stage) for _, _, line in code.co_lines() if line)
+
+        def profiled_function(*args, **kwargs):
+            profiles = getattr(self.local, 'profiles', None)
+            if profiles is None:
+                profiles = self.local.profiles = {}
+            if getattr(self.local, 'active', False):
+                return function(*args, **kwargs)
+            profile = profiles.get(stage)
+            if profile is None:
+                profile = profiles[stage] = cProfile.Profile()
+                with self.lock:
+                    self.profiles.setdefault(stage, []).append(profile)
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler holds the interpreter, as it can only have one at a time from Python 3.12
+                return function(*args, **kwargs)
+            self.local.active = True
+            with self.lock:
+                self.running[stage] = self.running.get(stage, 0) + 1
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.local.active = False
+                with self.lock:
+                    self.running[stage] -= 1
+        return profiled_function
+
+    def instrument(self, obj, stages: Dict[str, str]):
+        """
+        Profile the stage methods of an object, over whatever already wraps them, e.g. the metrics.
+        :param obj: e.g. a spider
+        :param stages: the stage of each method, by method name
+        """
+        for method, stage in stages.items():
+            setattr(obj, method, self.wrap(stage, getattr(obj, method), getattr(type(obj), method)))
+
+    def stage_of(self, traceback: tracemalloc.Traceback) -> str:
+        """
+        :return: the innermost stage in a traceback, or None if the allocation was made outside the stages
+        """
+        for frame in reversed(traceback):
+            stage = self.stage_lines.get((frame.filename, frame.lineno))
+            if stage is not None:
+                return stage
+        return None
+
+    def allocations(self, snapshot: tracemalloc.Snapshot, stage: str) -> List[Tuple[tracemalloc.Frame, int, int]]:
+        """
+        :return: the lines that allocated the memory a stage holds in a snapshot, as (frame, bytes, blocks), the
+            biggest first
+        """
+        lines: Dict[tracemalloc.Frame, List[int]] = {}
+        for trace in snapshot.traces:
+            if self.stage_of(trace.traceback) == stage:
+                line = lines.setdefault(trace.traceback[-1], [0, 0])
+                line[0] += trace.size
+                line[1] += 1
+        return sorted(((frame, size, count) for frame, (size, count) in lines.items()),
+                      key=lambda line: line[1], reverse=True)
+
+    def file_name(self, stage: str, suffix: str) -> str:
+        return os.path.join(self.directory, 'profile-{}{}'.format(stage.replace(' ', '-'), suffix))
+
+    def stop(self):
+        """
+        Stop profiling, and write for each stage its pstats file, profile-<stage>.pstats, and its top allocations,
+        profile-<stage>-allocations.txt.
+        """
+        self.stopped.set()
+        if self.watcher is not None:
+            self.watcher.join()
+        final = tracemalloc.take_snapshot()
+        final_size, peak_size = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        with self.lock:
+            profiles = {stage: list(stage_profiles) for stage, stage_profiles in self.profiles.items()}
+        for stage, stage_profiles in list(profiles.items()):
+            for profile in stage_profiles:
+                profile.create_stats()
+            stage_profiles = [profile for profile in stage_profiles if profile.stats]
+            if not stage_profiles:
+                del profiles[stage]
+                continue
+            stats = pstats.Stats(*stage_profiles)
+            stats.dump_stats(self.file_name(stage, '.pstats'))
+            logger.info('{}: {} calls, {:.2f}s in {} threads, profile in {}'.format(
+                stage, stats.total_calls, stats.total_tt, len(stage_profiles), self.file_name(stage, '.pstats')))
+
+        with self.lock:
+            peaks = dict(self.peaks)
+        for stage in sorted(set(profiles) | set(peaks)):
+            sections = [('at the end, {:.1f} MB traced, {:.1f} MB at the most'.format(final_size / 1e6,
+                                                                                       peak_size / 1e6),
+                         self.allocations(final, stage))]
+            if stage in peaks:
+                size, snapshot = peaks[stage]
+                sections.insert(0, ('at the highest seen while it ran, {:.1f} MB traced'.format(size / 1e6),
+                                    self.allocations(snapshot, stage)))
+            with open(self.file_name(stage, '-allocations.txt'), 'w', encoding='utf-8') as f:
+                f.write('allocations of the {} stage, written {}\n'.format(stage, time.strftime('%Y-%m-%d %H:%M:%S')))
+                for title, lines in sections:
+                    f.write('\n{}: {:.1f} kB held by the stage\n'.format(title, sum(line[1] for line in lines) / 1e3))
+                    for frame, size, count in lines[:self.top]:
+                        f.write('{:>10.1f} kB {:>8} blocks  {}:{}  {}\n'.format(
+                            size / 1e3, count, frame.filename, frame.lineno,
+                            linecache.getline(frame.filename, frame.lineno).strip()))
+        logger.info('profiles and allocation reports written to {}'.format(self.directory))
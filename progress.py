@@ -0,0 +1,60 @@
+# coding: utf-8
+"""
+File: progress.py
+
+Progress reporting from many threads, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import time
+import threading
+import logging
+from typing import Dict
+
+
+logger = logging.getLogger('scr')
+
+
+class Progress:
+    """
+    Counts the finished items by kind, from any thread, and logs where the work stands at most once every interval
+    seconds instead of a line per item.
+    """
+    def __init__(self, interval: float=5.0):
+        """
+        :param interval: the least time between two progress lines, in seconds
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.done: Dict[str, int] = {}
+        self.failed: Dict[str, int] = {}
+        self.started = self.logged = time.monotonic()
+
+    def add(self, kind: str, succeeded: bool=True):
+        """
+        Count a finished item.
+        :param kind: what the item was, e.g. 'picture'
+        :param succeeded: whether it succeeded
+        """
+        counts = self.done if succeeded else self.failed
+        with self.lock:
+            counts[kind] = counts.get(kind, 0) + 1
+            now = time.monotonic()
+            if now - self.logged < self.interval:
+                return
+            self.logged = now
+        logger.info(self.summary())
+
+    def summary(self) -> str:
+        """
+        :return: the counts so far, with the rate
+        """
+        with self.lock:
+            elapsed = time.monotonic() - self.started
+            kinds = sorted(set(self.done) | set(self.failed))
+            counts = ', '.join('{} {}'.format(self.done.get(kind, 0), kind) +
+                               (' ({} failed)'.format(self.failed[kind]) if kind in self.failed else '')
+                               for kind in kinds)
+            total = sum(self.done.values())
+        return '{} in {:.1f}s, {:.1f}/s'.format(counts or 'nothing', elapsed, total / elapsed if elapsed else 0)
@@ -0,0 +1,90 @@
+# coding: utf-8
+"""
+File: retry.py
+
+Retry policy and circuit breaker for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import time
+import random
+import threading
+import logging
+from typing import Optional
+from urllib.parse import urlsplit
+from helper import ScraperException
+
+
+logger = logging.getLogger('scr')
+
+
+class RetryPolicy:
+    """
+    How often and how patiently a request is repeated: up to attempts tries, each after an exponentially growing,
+    fully jittered pause, for connection errors, timeouts and the listed status codes.
+    """
+    def __init__(self, retry_def: dict):
+        """
+        :param retry_def: the retry section of the site definition
+        """
+        self.attempts = retry_def.get('attempts', 4)
+        self.backoff = retry_def.get('backoff', 0.5)
+        self.max_backoff = retry_def.get('max-backoff', 30)
+        self.statuses = frozenset(retry_def.get('statuses', (429, 500, 502, 503, 504)))
+        # if given, it overrides the connection timeouts for retried requests: seconds, or [connect, read]
+        timeout = retry_def.get('timeout')
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+
+    def delay(self, attempt: int, retry_after: Optional[str]=None) -> float:
+        """
+        :param attempt: the number of the attempt that just failed, from 0
+        :param retry_after: the Retry-After header of the response, if any; it is respected when it asks for more
+        :return: the pause before the next attempt
+        """
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        return delay
+
+
+class CircuitBreaker:
+    """
+    Stops the requests to a host after failures failures in a row. Once cool_off seconds have passed, one request
+    is let through; if it succeeds the host is open for business again, otherwise it waits for another cool-off.
+    """
+    def __init__(self, failures: int, cool_off: float):
+        self.failures, self.cool_off = failures, cool_off
+        self.lock = threading.Lock()
+        self.hosts = {}  # host: [failures in a row, time the circuit opened or None, trial in progress]
+
+    def check(self, url: str):
+        """
+        Raise an exception if the host of the url may not be contacted now.
+        :param url: the url about to be requested
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            state = self.hosts.setdefault(host, [0, None, False])
+            if state[1] is None:
+                return
+            if time.monotonic() - state[1] >= self.cool_off and not state[2]:
+                state[2] = True  # the trial request
+                return
+        raise ScraperException('CircuitBreaker.check', 'host {} is failing, not contacting it for now'.format(host))
+
+    def record(self, url: str, success: bool):
+        """
+        :param url: the url that was requested
+        :param success: whether the host answered properly
+        """
+        host = urlsplit(url).netloc
+        with self.lock:
+            state = self.hosts.setdefault(host, [0, None, False])
+            if success:
+                self.hosts[host] = [0, None, False]
+                return
+            state[0] += 1
+            if state[2] or (state[1] is None and state[0] >= self.failures):
+                state[1], state[2] = time.monotonic(), False
+                logger.warning('{} failed {} times in a row, pausing it for {}s'.format(host, state[0], self.cool_off))
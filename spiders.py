@@ -10,22 +10,275 @@ __author__ = 'Marko Čibej'
 
 import requests
 import re
+import copy
 import os
 import json
 import logging
+import datetime
+import hashlib
+import time
+import threading
 from http import cookiejar, HTTPStatus
-from bs4 import BeautifulSoup
+from contextlib import contextmanager
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from urllib.parse import urljoin, urlsplit, unquote
+from typing import Optional, Tuple, List, Union, TYPE_CHECKING
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util import make_headers
 from helper import SimpleCrypt, ScraperException
 from config import Configuration
+from extractors import RuleExtractor, get_extractor, start_worker, run_extractor
+from frontier import Frontier
+from compact import UrlCodec
+from index import IllustIndex
+from store import BlobStore
+from cache import HTTPCache, CachingAdapter
+from throttle import Throttle
+from retry import RetryPolicy, CircuitBreaker
+from connections import count_connections, connection_stats
+from progress import Progress
+from manga import MangaWork
+from metrics import Metrics, MetricsExporter
+from manifest import Manifest
+if TYPE_CHECKING:
+    from engine import AsyncEngine  # asyncio is only imported when one of the concurrent engines is used
+    from distributed import ShardQueue
 
 logger = logging.getLogger('scr')
 
 
 class Spider:
     session: requests.Session
+    chunk_size = 64 * 1024
+    store: BlobStore = None
+    cache: HTTPCache = None
+    throttle: Throttle = None
+    retry: RetryPolicy = None
+    breaker: CircuitBreaker = None
+    extractor = None
+    parser: ProcessPoolExecutor = None
+    timeout: Union[float, Tuple[float, float]] = None
+    metrics: Metrics = None
+    exporter: MetricsExporter = None
+    manifest: Manifest = None
+    frontier: Frontier = None
+    site_def: dict = None
+    STAGES = {}  # the stages of the crawl, by the methods that run them, for the metrics and the profiler
+    instruments = ()  # what wraps the stage methods, e.g. the metrics and the profiler, innermost first
 
     def __init__(self):
         self.session = requests.session()
+        self.local = threading.local()  # the sessions of the download threads
+        self.made_dirs = set()
+
+    def worker_session(self):
+        """
+        Give the calling thread a session of its own, which send() uses instead of the spider's. It has a copy of
+        the spider's headers and shares its cookie jar and adapters, which are thread-safe, and with them the
+        connection pools and the cache.
+        """
+        session = requests.Session()
+        session.headers = CaseInsensitiveDict(self.session.headers)
+        session.cookies = self.session.cookies
+        session.adapters = self.session.adapters.copy()
+        self.local.session = session
+
+    def make_dir(self, path):
+        """
+        Create a directory, unless this spider already has.
+        :param path: the directory
+        """
+        if path not in self.made_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.made_dirs.add(path)
+
+    def extract(self, method: str, content: bytes):
+        """
+        Read values from a page with the spider's extractor, in one of the parse processes if the spider has them.
+        The calling thread waits for the result, so the processes parse at the same time only the pages of different
+        threads, as with the threaded, async and pipeline engines; for a single thread they only add the cost of
+        sending the page over.
+        :param method: the extractor method, e.g. 'original_image'
+        :param content: the page
+        :return: what the method returns
+        """
+        if self.parser is None:
+            return getattr(self.extractor, method)(content)
+        return self.parser.submit(run_extractor, method, content).result()
+
+    def close(self):
+        """
+        Stop the parse processes and the metrics export, and finish the manifest, if any.
+        """
+        if self.parser is not None:
+            self.parser.shutdown()
+            self.parser = None
+        if self.manifest is not None:
+            self.manifest.close()
+            self.manifest = None
+        if self.exporter is not None:
+            self.exporter.stop()
+            self.exporter = None
+
+    def setup(self, site_def: dict):
+        """
+        Set up what every site has from its site definition: the session's headers and cookies, the connections,
+        and the blob store, retry policy, throttle, cache and manifest, if the definition has them.
+        :param site_def: the site definition
+        """
+        self.session.headers = CaseInsensitiveDict(site_def.get('headers', {}))
+        cookie_file = site_def.get('cookie-file', site_def['slug'] + '-cookies')
+        self.session.cookies = cookiejar.LWPCookieJar(cookie_file)
+        if os.path.exists(cookie_file):
+            try:
+                self.session.cookies.load(ignore_discard=True, ignore_expires=True)
+            except (cookiejar.LoadError, OSError) as e:
+                logger.warning('could not load the cookies from {}: {}'.format(cookie_file, e))
+
+        self.chunk_size = site_def.get('chunk-size', self.chunk_size)
+        if site_def.get('blob-store'):
+            self.store = BlobStore(site_def['blob-store'])
+        if site_def.get('retry'):
+            self.retry = RetryPolicy(site_def['retry'])
+            self.breaker = CircuitBreaker(site_def['retry'].get('breaker-failures', 5),
+                                          site_def['retry'].get('breaker-cool-off', 60))
+        if site_def.get('throttle'):
+            self.throttle = Throttle(site_def['throttle'])
+        if site_def.get('cache'):
+            self.cache = HTTPCache.from_definition(site_def['cache'])
+        if site_def.get('manifest'):
+            self.manifest = Manifest.from_definition(site_def['manifest'], site_def['slug'])
+        # the threaded engine's download and manga threads all reach for a connection at once
+        threads = site_def.get('download-threads', 8) + site_def.get('manga-threads', 4)
+        self.configure_connections(site_def.get('connection', {}), threads)
+        self.site_def = site_def
+
+    def setup_metrics(self, site_def: dict):
+        """
+        Time the spider's stages and export the metrics, if the site definition has a metrics section. Called last
+        by the spiders' constructors, once the parts the metrics are read from are there.
+        :param site_def: the site definition
+        """
+        if site_def.get('metrics'):
+            self.metrics = Metrics(site_def['metrics'].get('buckets', Metrics.BUCKETS))
+            self.instrument(self.metrics)
+            self.metrics.collect(self.collect_metrics)
+            self.exporter = MetricsExporter(self.metrics, site_def['metrics'])
+
+    def instrument(self, instrument):
+        """
+        Wrap the stage methods, over whatever wraps them already. The wrappers are bound to this spider, so the
+        copies made with copy() are wrapped again.
+        :param instrument: what wraps them, e.g. the metrics or a profiler, with an instrument(obj, stages) method
+        """
+        instrument.instrument(self, self.STAGES)
+        self.instruments += (instrument,)
+
+    def copy(self) -> 'Spider':
+        """
+        :return: a shallow copy of the spider, with its stage methods wrapped by the same instruments as this one's,
+            but on behalf of the copy
+        """
+        spider = copy.copy(self)
+        for method in self.STAGES:
+            vars(spider).pop(method, None)
+        for instrument in self.instruments:
+            instrument.instrument(spider, self.STAGES)
+        return spider
+
+    def configure_connections(self, connection_def: dict, threads: int=0):
+        """
+        Set up the session's connection pools, and the timeouts and headers that go with them, from the connection
+        section of the site definition. Each host listed under 'hosts' gets a pool of the given size in an adapter
+        of its own, the other hosts share one adapter. If the spider has a cache, the adapters answer from it.
+        :param connection_def: the section
+        :param threads: the most threads that may make requests at once; no pool is smaller, as the connections
+            beyond its size would be thrown away after each request
+        """
+        def adapter(pool_size: int) -> HTTPAdapter:
+            settings = {'pool_connections': connection_def.get('pools', 10), 'pool_maxsize': max(pool_size, threads)}
+            return count_connections(CachingAdapter(self.cache, **settings) if self.cache is not None
+                                     else HTTPAdapter(**settings))
+
+        shared = adapter(connection_def.get('pool-size', 10))
+        self.session.mount('http://', shared)
+        self.session.mount('https://', shared)
+        for host, pool_size in connection_def.get('hosts', {}).items():
+            host_adapter = adapter(pool_size)
+            self.session.mount('http://{}/'.format(host), host_adapter)
+            self.session.mount('https://{}/'.format(host), host_adapter)
+
+        timeout = connection_def.get('timeout')
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        # urllib3 offers br and zstd only when it can decode them
+        self.session.headers['Accept-Encoding'] = make_headers(accept_encoding=True)['accept-encoding'] \
+            if connection_def.get('compression', True) else 'identity'
+        if not connection_def.get('keep-alive', True):
+            self.session.headers['Connection'] = 'close'
+
+    def report(self):
+        """
+        Log what the blob store and the cache saved during the run, how the hosts were throttled and how well
+        the connections were reused.
+        """
+        if self.store is not None:
+            logger.info(self.store.report())
+        if self.cache is not None:
+            logger.info('cache: {hits} hits, {revalidated} revalidated, {misses} misses, {evicted} evicted'.format(
+                **self.cache.stats()))
+        if self.throttle is not None:
+            for host, counters in self.throttle.counters().items():
+                logger.info('{}: {requests} requests, {overloaded} overloaded, {errors} errors, {slow} slow, '
+                            'concurrency {limit}, {waited:.1f}s waiting'.format(host, **counters))
+        for host, stats in connection_stats(self.session.adapters.values()).items():
+            logger.info('{}: {requests} requests over {connections} connections'.format(host, **stats))
+
+    def collect_metrics(self):
+        """
+        The metrics kept by the parts of the spider, read when the metrics are exported: what the cache and the
+        blob store saved, how the hosts were throttled, how the connections were reused, and how much work of each
+        kind and state the frontier holds, for every target of the batch.
+        :return: (name, labels, value) triples
+        """
+        if self.cache is not None:
+            stats = self.cache.stats()
+            for result in ('hits', 'revalidated', 'misses', 'evicted'):
+                yield 'scrapers_cache_total', {'result': result}, stats[result]
+            yield 'scrapers_cache_bytes', {}, stats['size']
+        if self.store is not None:
+            with self.store.lock:
+                yield 'scrapers_store_files_total', {}, self.store.files
+                yield 'scrapers_store_blobs_total', {}, self.store.blobs
+                yield 'scrapers_store_bytes_total', {'bytes': 'logical'}, self.store.logical_bytes
+                yield 'scrapers_store_bytes_total', {'bytes': 'stored'}, self.store.stored_bytes
+        if self.throttle is not None:
+            for host, counters in self.throttle.counters().items():
+                for event in ('requests', 'overloaded', 'errors', 'slow'):
+                    yield 'scrapers_throttle_total', {'host': host, 'event': event}, counters[event]
+                yield 'scrapers_throttle_wait_seconds_total', {'host': host}, counters['waited']
+                yield 'scrapers_throttle_limit', {'host': host}, counters['limit']
+                yield 'scrapers_throttle_in_flight', {'host': host}, counters['in_flight']
+        for host, stats in connection_stats(self.session.adapters.values()).items():
+            yield 'scrapers_connections_total', {'host': host}, stats['connections']
+            yield 'scrapers_requests_total', {'host': host}, stats['requests']
+        if self.frontier is not None:
+            for target, kind, state, count in self.frontier.counts():
+                yield 'scrapers_frontier_items', {'target': target, 'kind': kind, 'state': state}, count
+
+    @contextmanager
+    def record_failure(self, kind, url):
+        """
+        Run a stage on an url so that, if it fails, the url is marked as failed in the frontier and the crawl goes
+        on. The failed urls are tried again by a later retry pass.
+        :param kind: the stage
+        :param url: the url
+        """
+        try:
+            yield
+        except Exception as e:
+            logger.warning('{} {} failed: {}'.format(kind, url, e))
+            self.frontier.mark(kind, url, Frontier.FAILED)
 
     def check_page(self, url):
         """
@@ -33,36 +286,344 @@ class Spider:
         :param url: the url to check
         :return: the HTTP status code
         """
-        return self.session.get(url, allow_redirects=False).status_code
+        return self.session.get(url, allow_redirects=False, timeout=self.timeout).status_code
 
+    def fetch(self, url, referer=None, headers=None, **kwargs) -> requests.Response:
+        """
+        Get an url with the session. The referer is sent with this request only, instead of being set on the
+        session, so that requests running in parallel don't overwrite each other's headers.
 
-class PixivSpider(Spider):
+        If the spider has a retry policy, connection errors, timeouts and the retryable status codes are retried
+        after a growing pause, and the circuit breaker refuses requests to a host that keeps failing.
+        :param url: the url to get
+        :param referer: the Referer header for this request, or None to use the session default
+        :param headers: any other headers for this request
+        :return: the response
+        """
+        headers = dict(headers or {})
+        if referer is not None:
+            headers['Referer'] = referer
+        if self.retry is None:
+            return self.send(url, headers, **kwargs)
+
+        if self.retry.timeout is not None:
+            kwargs.setdefault('timeout', self.retry.timeout)
+        attempt = 0
+        while True:
+            self.breaker.check(url)
+            try:
+                response = self.send(url, headers, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.breaker.record(url, False)
+                if attempt + 1 >= self.retry.attempts:
+                    raise
+                delay, reason = self.retry.delay(attempt), e
+            else:
+                if response.status_code not in self.retry.statuses:
+                    self.breaker.record(url, True)
+                    return response
+                self.breaker.record(url, False)
+                if attempt + 1 >= self.retry.attempts:
+                    return response
+                delay = self.retry.delay(attempt, response.headers.get('Retry-After'))
+                reason = response.status_code
+                response.close()
+            attempt += 1
+            if self.metrics is not None:
+                self.metrics.count('scrapers_retries_total', host=urlsplit(url).netloc)
+            logger.debug('{} failed ({}), attempt {} in {:.1f}s'.format(url, reason, attempt + 1, delay))
+            time.sleep(delay)
+
+    def send(self, url, headers: dict, **kwargs) -> requests.Response:
+        """
+        Make a single request. If the spider has a throttle, the request waits for its host's rate and concurrency
+        limits, and the response adjusts them. If it has metrics, the bytes of a page are counted; those of a
+        streamed download are counted as they are written.
+        :param url: the url to get
+        :param headers: the headers for this request
+        :return: the response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        session = getattr(self.local, 'session', self.session)
+        if self.throttle is None:
+            response = session.get(url, headers=headers or None, **kwargs)
+        else:
+            ticket = self.throttle.host(url).acquire()
+            try:
+                response = session.get(url, headers=headers or None, **kwargs)
+            except BaseException:
+                ticket.answer(None)
+                ticket.release()
+                raise
+            if not getattr(response, 'from_cache', False):
+                ticket.answer(response.status_code, response.headers.get('Retry-After'))
+            if kwargs.get('stream'):
+                # the connection stays busy until the body has been read
+                close = response.close
+                response.close = lambda: (close(), ticket.release())
+            else:
+                ticket.release()
+
+        if self.metrics is not None and not kwargs.get('stream'):
+            self.metrics.count('scrapers_page_bytes_total', len(response.content), host=urlsplit(url).netloc,
+                               source='cache' if getattr(response, 'from_cache', False) else 'network')
+        return response
+
+    def download(self, url, file_name, referer=None, record: dict=None) -> int:
+        """
+        Download an url to a file. If the spider has a retry policy, a download whose body breaks off is resumed
+        after a pause, up to the policy's number of attempts. If it has a manifest, the download is recorded in it.
+        :param url: the url to download
+        :param file_name: the target file
+        :param referer: the Referer header for this request
+        :param record: what the manifest records of the download besides the url, the file, its size and digest
+            and the timing, e.g. the illust id, rank and date
+        :return: the size of the file
+        """
+        started, attempt = time.time(), 0
+        while True:
+            try:
+                size, digest = self.download_once(url, file_name, referer)
+                break
+            except requests.exceptions.ChunkedEncodingError as e:
+                attempt += 1
+                if self.retry is None or attempt >= self.retry.attempts:
+                    raise
+                delay = self.retry.delay(attempt - 1)
+                if self.metrics is not None:
+                    self.metrics.count('scrapers_retries_total', host=urlsplit(url).netloc)
+                logger.debug('{} broke off ({}), resuming in {:.1f}s'.format(url, e, delay))
+                time.sleep(delay)
+        if self.manifest is not None:
+            self.manifest.record(**(record or {}), url=url, path=file_name, size=size, sha256=digest,
+                                 started=round(started, 3), seconds=round(time.time() - started, 3),
+                                 attempts=attempt + 1)
+        return size
+
+    def download_once(self, url, file_name, referer=None) -> Tuple[int, Optional[str]]:
+        """
+        Stream an url to a file, chunk_size bytes at a time. The body goes to file_name.part, which is renamed into
+        place once it is complete, so the target is either missing or whole. The sidecar file_name.part.json
+        records the expected length and the validators of the response; if the spider is interrupted, the next
+        attempt asks for the rest of the body with a Range request and appends it to the part. If the server
+        ignores the range, cannot satisfy it or the resource has changed, the whole body is fetched again.
+
+        If the spider has a blob store or a manifest, the body is hashed as it streams in; the complete file goes into
+        the store and is linked to the target.
+        :param url: the url to download
+        :param file_name: the target file
+        :param referer: the Referer header for this request
+        :return: the size of the file, and its SHA-256 digest if it was hashed
+        """
+        part_name, journal_name = file_name + '.part', file_name + '.part.json'
+        journal = self.read_journal(journal_name, url)
+        offset = os.path.getsize(part_name) if journal is not None and os.path.exists(part_name) else 0
+        digest = None
+        hashed = self.store is not None or self.manifest is not None
+
+        while True:
+            # ranges count encoded bytes, so ask for the body as it is stored
+            headers = {'Accept-Encoding': 'identity'}
+            if offset:
+                headers['Range'] = 'bytes={}-'.format(offset)
+                if journal.get('etag') or journal.get('last-modified'):
+                    headers['If-Range'] = journal.get('etag') or journal.get('last-modified')
+
+            with self.fetch(url, referer=referer, headers=headers, stream=True) as response:
+                if offset and response.status_code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE:
+                    if offset == journal.get('length'):
+                        break  # the part was complete, only the rename was missing
+                    logger.debug('{} cannot be resumed at {}, downloading it again'.format(url, offset))
+                    for name in (part_name, journal_name):
+                        if os.path.exists(name):
+                            os.unlink(name)
+                    offset, journal = 0, None
+                    continue
+                response.raise_for_status()
+
+                if offset and response.status_code == HTTPStatus.PARTIAL_CONTENT:
+                    if not self.resumes(journal, response, offset):
+                        logger.debug('{} has changed, downloading it again'.format(url))
+                        offset = 0
+                        continue
+                    mode = 'ab'
+                    digest = self.hash_file(part_name) if hashed else None
+                else:
+                    offset, mode = 0, 'wb'
+                    journal = self.write_journal(journal_name, url, response)
+                    digest = hashlib.sha256() if hashed else None
+
+                resumed_at = offset
+                try:
+                    with open(part_name, mode) as f:
+                        for chunk in response.iter_content(self.chunk_size):
+                            f.write(chunk)
+                            offset += len(chunk)
+                            if digest is not None:
+                                digest.update(chunk)
+                finally:
+                    if self.metrics is not None:
+                        self.metrics.count('scrapers_download_bytes_total', offset - resumed_at,
+                                           host=urlsplit(url).netloc)
+
+            if journal.get('length') is not None and offset != journal['length']:
+                raise ScraperException('Spider.download_once', 'got {} of {} bytes of {}'.format(
+                    offset, journal['length'], url))
+            break
+
+        if hashed and digest is None:
+            digest = self.hash_file(part_name)
+        if self.store is not None:
+            self.store.put(part_name, file_name, digest.hexdigest())
+        else:
+            os.replace(part_name, file_name)
+        os.unlink(journal_name)
+        return offset, digest.hexdigest() if digest is not None else None
+
+    def hash_file(self, file_name):
+        """
+        :param file_name: the file to hash
+        :return: a SHA-256 hash object fed with the contents of the file
+        """
+        digest = hashlib.sha256()
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                digest.update(chunk)
+        return digest
+
+    @staticmethod
+    def read_journal(journal_name, url) -> Optional[dict]:
+        """
+        Read the sidecar of a partial download.
+        :param journal_name: the sidecar file
+        :param url: the url being downloaded; a sidecar left by a different url is ignored
+        :return: the journal, or None if there is no usable one
+        """
+        try:
+            with open(journal_name, encoding='utf-8') as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return journal if isinstance(journal, dict) and journal.get('url') == url else None
+
+    @staticmethod
+    def write_journal(journal_name, url, response: requests.Response) -> dict:
+        """
+        Record what a full response promises, before its body is written to the part file.
+        :param journal_name: the sidecar file
+        :param url: the url being downloaded
+        :param response: the response, with only its headers read
+        :return: the journal
+        """
+        length = response.headers.get('Content-Length')
+        journal = {'url': url,
+                   'length': int(length) if length is not None and length.isdigit() else None,
+                   'etag': response.headers.get('ETag'),
+                   'last-modified': response.headers.get('Last-Modified')}
+        with open(journal_name, 'w', encoding='utf-8') as f:
+            json.dump(journal, f)
+        return journal
+
+    @staticmethod
+    def resumes(journal: dict, response: requests.Response, offset: int) -> bool:
+        """
+        Check that a partial response continues the part file: it must start where the part ends and come from
+        the same version of the resource.
+        :param journal: the sidecar of the part
+        :param response: the 206 response
+        :param offset: the size of the part
+        :return: True if the body can be appended
+        """
+        match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', response.headers.get('Content-Range', ''))
+        if match is None or int(match.group(1)) != offset:
+            return False
+        if match.group(2) != '*' and journal.get('length') not in (None, int(match.group(2))):
+            return False
+        for header, key in (('ETag', 'etag'), ('Last-Modified', 'last-modified')):
+            if journal.get(key) is not None and response.headers.get(header) not in (None, journal[key]):
+                return False
+        return True
 
-    prepare_url = set()
-    multipic_url = set()
-    next_pages_url = []
-    origin_url = {}
-    really_multipic_url = {}
+
+class PixivSpider(Spider):
+    """
+    Downloads the pictures of a Pixiv ranking. The work found along the way is kept in the frontier, by kind: the
+    ranking itself, the json pages of the ranking, the detail pages, the manga detail pages and the pictures and
+    manga pages to download.
+    """
+    REFERS = {'daily': 'day', 'weekly': 'week', 'monthly': 'month', 'male': 'male'}
+    STAGES = {'start_spider': 'ranking', 'parse_json': 'json page', 'on_spider': 'detail', 'parse_multipic': 'manga',
+              'download_pic': 'download', 'download_multipic': 'download'}
 
     def __init__(self, site_def: dict):
         super().__init__()
-
-        self.session.headers = site_def['headers']
-        self.session.cookies = cookiejar.LWPCookieJar(site_def['cookie-file'])
+        self.setup(site_def)
 
         self.params = site_def['params']
         self.data = site_def['data']
         self.rank = site_def['rank']
         self.refer = site_def['refer']
-        self.max_page = site_def['max-page'] + 1  # TODO: why +1?
-        self.begin_url = site_def['begin-url'].format(self.rank, self.refer, self.date)
-        self.site_def = site_def
+        self.date = site_def.get('date') or (datetime.date.today() - datetime.timedelta(days=1)).strftime('%Y%m%d')
+        self.max_page = site_def['max-page'] + 1  # range() upper bound, the pages are numbered from 1
+        self.begin_url = site_def['url']['begin-url'].format(self.rank, self.refer, self.date)
+        self.detail_url = site_def['url']['detail-url']
+        self.front_url = site_def['url']['front-url']
+        self.extractor = get_extractor(site_def.get('extractor', 'soup'))
+        if site_def.get('parse-workers'):
+            self.parser = ProcessPoolExecutor(site_def['parse-workers'], initializer=start_worker,
+                                              initargs=(site_def.get('extractor', 'soup'),))
+            # the processes are forked on the first call; do it now, before the engines start any threads
+            self.parser.submit(int).result()
+        self.incremental = site_def.get('incremental', False)
+        self.index = IllustIndex(site_def.get('index-file', site_def['slug'] + '-index.sqlite'))
+        # the pending detail and manga pages are kept in memory as their illust ids
+        codec = UrlCodec([self.detail_url, site_def['url'].get('manga-url')])
+        self.frontier = Frontier(site_def.get('frontier-file', site_def['slug'] + '-frontier.sqlite'),
+                                 '{}/{}'.format(self.rank, self.date), site_def.get('frontier-batch', 500), codec)
+        self.setup_metrics(site_def)
+
+    def for_target(self, rank: str, date: str) -> 'PixivSpider':
+        """
+        Get a spider for another ranking and date. It shares everything else with this one: the session and its
+        connections, the index, the store, the cache, the throttle, the parse processes and the frontier file.
+        :param rank: the rank, e.g. 'weekly'
+        :param date: the date, YYYYMMDD
+        :return: the spider
+        """
+        spider = self.copy()
+        spider.rank, spider.date = rank, date
+        spider.refer = self.REFERS.get(rank, self.refer)
+        spider.begin_url = self.site_def['url']['begin-url'].format(spider.rank, spider.refer, spider.date)
+        spider.frontier = self.frontier.for_target('{}/{}'.format(rank, date))
+        return spider
+
+    def for_targets(self, specs: List[str]) -> List['PixivSpider']:
+        """
+        Get a spider for each target of a batch.
+        :param specs: the targets, each as ranks:dates, with comma separated lists of ranks and of dates or ranges
+            of dates, e.g. daily,weekly:20181101-20181130,20181205
+        :return: the spiders, one per rank and date
+        """
+        spiders = []
+        for spec in specs:
+            ranks, _, dates = spec.partition(':')
+            if not dates:
+                raise ScraperException('PixivSpider.for_targets', 'target {} is not ranks:dates'.format(spec))
+            for date_range in dates.split(','):
+                first, _, last = date_range.partition('-')
+                try:
+                    day = datetime.datetime.strptime(first, '%Y%m%d').date()
+                    end = datetime.datetime.strptime(last or first, '%Y%m%d').date()
+                except ValueError:
+                    raise ScraperException('PixivSpider.for_targets', 'bad date in target {}'.format(spec))
+                while day <= end:
+                    spiders.extend(self.for_target(rank, day.strftime('%Y%m%d')) for rank in ranks.split(','))
+                    day += datetime.timedelta(days=1)
+        return spiders
 
     def get_postkey(self):
         r = self.session.get(self.site_def['url']['post-url'], params=self.params)
-        soup = BeautifulSoup(r.content, 'lxml')
-        post_key = soup.find_all('input')[0]['value']
-        self.data['post_key'] = post_key
+        self.data['post_key'] = self.extract('post_key', r.content)
 
     def check_login(self):
         """
@@ -82,96 +643,158 @@ class PixivSpider(Spider):
             self.get_postkey()
             self.data['pixiv_id'] = crypt.decrypt(self.site_def[account_name]['username'])
             self.data['password'] = crypt.decrypt(self.site_def[account_name]['password'])
-            post_data = self.session.post(self.site_def['post-url'], data=self.data)
+            self.session.post(self.site_def['url']['post-url'], data=self.data)
+            if not self.check_login():
+                logger.error('could not log into site {}'.format(self.site_def['slug']))
+                return False
             self.session.cookies.save(ignore_discard=True, ignore_expires=True)
 
             logger.info('logged into site {}'.format(self.site_def['slug']))
             return True
-        finally:
+        except (requests.RequestException, ScraperException) as e:
+            logger.error('could not log into site {}: {}'.format(self.site_def['slug'], e))
             return False
 
+    @staticmethod
+    def illust_id(url) -> int:
+        """
+        :param url: a detail or manga reader url
+        :return: the id of the illustration
+        """
+        return int(re.findall(r'\d{7,10}', url)[0])
+
+    def known(self, illust_id) -> bool:
+        """
+        In incremental mode, check whether an illustration was already downloaded, for this or any other target.
+        :param illust_id: the illustration id
+        :return: True if the illustration can be skipped
+        """
+        if not self.incremental or not self.index.has(illust_id):
+            return False
+        if self.metrics is not None:
+            self.metrics.count('scrapers_skipped_total', kind='illust')
+        return True
+
     def start_spider(self):
         """
-        Collect the initial page links for the spider to work on.
+        Collect the initial page links for the spider to work on. Nothing is done if the frontier shows that the
+        ranking was already read by an earlier run.
         """
-        self.session.headers = self.site_def['headers']
-        rank_list_info = self.session.get(self.begin_url)
-        rank_list_obj = BeautifulSoup(rank_list_info.content, 'lxml')
-        links = rank_list_obj.find_all('a','title')
-        verified_key = rank_list_obj.find('input', attrs={'name': 'tt'})['value']
+        if self.frontier.state('ranking', self.begin_url) == Frontier.PARSED:
+            logger.info('resuming {}'.format(self.begin_url))
+            return
+        rank_list_info = self.fetch(self.begin_url)
+        rank_list_info.raise_for_status()
+        links, verified_key = self.extract('ranking', rank_list_info.content)
         for link in links:
-            self.prepare_url.add(self.site_def['front-url'] + link['href'])
-        for page in range(2, self.max_page):
-            self.next_pages_url.append(self.site_def['ranking-url'].format(self.rank, str(page), verified_key))
+            illust_id = re.search(r'illust_id=(\d+)', link)
+            if illust_id is None or not self.known(illust_id.group(1)):
+                self.frontier.discover('detail', urljoin(self.front_url, link))
+        if verified_key is None:
+            logger.warning('{} is empty, the rest of the ranking is not read'.format(self.begin_url))
+        else:
+            for page in range(2, self.max_page):
+                next_page = self.site_def['url']['ranking-url'].format(self.rank, str(page), verified_key, self.date)
+                self.frontier.discover('page', next_page)
+        self.frontier.discover('ranking', self.begin_url)
+        self.frontier.mark('ranking', self.begin_url, Frontier.PARSED)
 
-    def parse_json(self, pages_url):
-        next_pages_info = self.session.get(pages_url)
+    def parse_json(self, pages_url) -> List[str]:
+        """
+        Collect the detail pages listed on a json page of the ranking.
+        :param pages_url: the json page
+        :return: the detail pages queued
+        """
+        next_pages_info = self.fetch(pages_url, referer=self.begin_url)
+        next_pages_info.raise_for_status()
         next_pages_json = json.loads(next_pages_info.text)
+        detail_urls = []
         for next_url in next_pages_json.get('contents'):
-            self.prepare_url.add(self.detail_url + str(next_url.get('illust_id')))
-
-    def on_spider(self, page_url):
-        self.start_headers['Referer'] = self.begin_url
-        self.session.headers = self.start_headers
-        detail_info = self.session.get(page_url)
-        detail_infoObj = BeautifulSoup(detail_info.content, 'lxml')
-        check_url = detail_infoObj.find('img', 'original-image')
-        if check_url != None:
-            download_url = detail_infoObj.find('img', 'original-image')['data-src']
-            self.origin_url[download_url] = page_url
-        elif check_url == None:
-            self.multipic_url.add(page_url)
-
-
-    def parse_multipic(self, page_url):
-        self.start_headers['Referer'] = self.begin_url
-        self.session.headers = self.start_headers
-        detail_info = self.session.get(page_url)
-        detail_infoObj = BeautifulSoup(detail_info.content, 'lxml')
-        really_url = self.multi_front_url + detail_infoObj.find('a', 'read-more js-click-trackable')['href']
-
-        self.start_headers['Referer'] = page_url
-        self.session.headers = self.start_headers
-        multipic_detail_info = self.session.get(really_url)
-        multipic_detail_infoObj = BeautifulSoup(multipic_detail_info.content, 'lxml')
-        self.really_multipic_url[really_url] = []
-        multipicUrlList = multipic_detail_infoObj.find_all('img', 'image')
+            if not self.known(next_url.get('illust_id')):
+                detail_urls.append(self.detail_url + str(next_url.get('illust_id')))
+                self.frontier.discover('detail', detail_urls[-1])
+        self.frontier.mark('page', pages_url, Frontier.PARSED)
+        return detail_urls
+
+    def on_spider(self, page_url) -> Optional[str]:
+        """
+        Look at a detail page and sort it: the picture of a single picture page is queued for download, a manga
+        page is queued to be followed to its reader.
+        :param page_url: the detail page
+        :return: the download url of the picture, or None if the page is a manga
+        """
+        detail_info = self.fetch(page_url, referer=self.begin_url)
+        detail_info.raise_for_status()  # e.g. a 429 after the last retry, which is not a manga
+        download_url = self.extract('original_image', detail_info.content)
+        if download_url is not None:
+            self.frontier.discover('picture', download_url, page_url)
+        else:
+            self.frontier.discover('manga', page_url)
+        self.frontier.mark('detail', page_url, Frontier.PARSED)
+        return download_url
+
+    def parse_multipic(self, page_url) -> Tuple[str, List[str]]:
+        """
+        Follow a manga detail page to its reader page and collect the urls of all the pages.
+        :param page_url: the detail page
+        :return: the reader url and the list of image urls
+        """
+        detail_info = self.fetch(page_url, referer=self.begin_url)
+        detail_info.raise_for_status()
+        really_url = urljoin(self.front_url, self.extract('reader_link', detail_info.content))
+
+        multipic_detail_info = self.fetch(really_url, referer=page_url)
+        multipic_detail_info.raise_for_status()
+        multipicUrlList = self.extract('manga_images', multipic_detail_info.content)
         for multipicUrl in multipicUrlList:
-            self.really_multipic_url[really_url].append(
-                multipicUrl['data-src'])
+            self.frontier.discover('manga-page', multipicUrl, really_url)
+        self.frontier.mark('manga', page_url, Frontier.PARSED)
+        return really_url, multipicUrlList
 
-    def download_pic(self, download_link, page_url, file_path = f'Picture/{setRankList}/{setDate}'):
-        if not os.path.exists(file_path):
-            os.makedirs(file_path)
+    def download_pic(self, download_link, page_url, file_path=None) -> bool:
+        if file_path is None:
+            file_path = os.path.join('Picture', self.rank, self.date)
+        self.make_dir(file_path)
         file_format = os.path.splitext(download_link)[1]
         file_name = re.findall(r'\d{7,10}', page_url)[0]
         file_all_name = file_name + file_format
         file_final_name = os.path.join(file_path, file_all_name)
-        self.start_headers['Referer'] = page_url
-        self.session.headers = self.start_headers
         try:
-            download_pic = self.session.get(download_link)
-            with open(file_final_name, 'wb') as f:
-                f.write(download_pic.content)
+            self.download(download_link, file_final_name, referer=page_url,
+                          record={'illust': int(file_name), 'rank': self.rank, 'date': self.date, 'kind': 'picture'})
+            self.frontier.mark('picture', download_link, Frontier.DOWNLOADED)
+            self.index.add(file_name, file_final_name)
+            return True
         except Exception as e:
-            print('Download Error!', e)
+            self.frontier.mark('picture', download_link, Frontier.FAILED)
+            logger.warning('download of {} failed: {}'.format(download_link, e))
+            return False
 
-    def download_multipic(self, download_link, page_url , file_path = f'Picture/multipic/{setRankList}/{setDate}'):
-        if not os.path.exists(file_path):
-            os.makedirs(file_path)
+    def download_multipic(self, download_link, page_url, file_path=None) -> bool:
+        if file_path is None:
+            file_path = os.path.join('Picture', 'multipic', self.rank, self.date)
+        self.make_dir(file_path)
         file_format = os.path.splitext(download_link)[1]
         file_name = re.findall(r'\d{7,10}_\w\d{1,2}', download_link)[0]
         file_all_name = file_name + file_format
         file_final_name = os.path.join(file_path, file_all_name)
-        self.start_headers['Referer'] = page_url
-        self.session.headers = self.start_headers
+        if self.incremental and self.index.has_page(file_name):
+            if self.metrics is not None:
+                self.metrics.count('scrapers_skipped_total', kind='manga-page')
+            self.frontier.mark('manga-page', download_link, Frontier.DOWNLOADED)
+            return True
+        illust_id, page = IllustIndex.page_key(file_name)
         try:
-            download_pic = self.session.get(download_link)
-            with open(file_final_name, 'wb') as f:
-                f.write(download_pic.content)
+            self.download(download_link, file_final_name, referer=page_url,
+                          record={'illust': illust_id, 'page': page, 'rank': self.rank, 'date': self.date,
+                                  'kind': 'manga-page'})
+            self.frontier.mark('manga-page', download_link, Frontier.DOWNLOADED)
+            self.index.add_page(file_name, file_final_name)
+            return True
         except Exception as e:
-            print('Download Error!', e)
-
+            self.frontier.mark('manga-page', download_link, Frontier.FAILED)
+            logger.warning('download of {} failed: {}'.format(download_link, e))
+            return False
 
     def main(self, multi=False):
         count = 0
@@ -179,56 +802,536 @@ class PixivSpider(Spider):
 
         self.start_spider()
 
-        for next_page in self.next_pages_url:
-            self.parse_json(next_page)
+        for next_page, _ in self.frontier.pending('page'):
+            with self.record_failure('page', next_page):
+                self.parse_json(next_page)
 
-        for url in self.prepare_url:
-            self.on_spider(url)
+        for url, _ in self.frontier.pending('detail'):
+            with self.record_failure('detail', url):
+                self.on_spider(url)
 
-        for downloadUrl, pageUrl in self.origin_url.items():
+        for downloadUrl, pageUrl in self.frontier.pending('picture'):
             count += 1
             self.download_pic(downloadUrl, pageUrl)
             logger.info(f'downloading {count} pictures')
 
         if multi:
-            for multiUrl in self.multipic_url:
-                self.parse_multipic(multiUrl)
+            for multiUrl, _ in self.frontier.pending('manga'):
+                with self.record_failure('manga', multiUrl):
+                    self.parse_multipic(multiUrl)
+
+            complete = {}
+            for multipicUrl, page_url in self.frontier.pending('manga-page'):
+                multi_count += 1
+                downloaded = self.download_multipic(multipicUrl, page_url)
+                complete[page_url] = complete.get(page_url, True) and downloaded
+                logger.info(f'downloading {multi_count} manga')
 
-            for page_url, multipic_urlList in self.really_multipic_url.items():
-                for multipicUrl in multipic_urlList:
-                    multi_count += 1
-                    self.download_multipic(multipicUrl, page_url)
-                    logger.info(f'downloading {multi_count} manga')
+            for page_url, downloaded in complete.items():
+                if downloaded:
+                    self.index.add(self.illust_id(page_url))
 
+        self.frontier.flush()
         logger.info(f'downloaded {count} pictures,{multi_count} manga')
+        self.report()
+
+    def main_threaded(self, multi=False):
+        """
+        main() with the downloads handed to a pool of 'download-threads' threads, each with a session of its own.
+        The pages are read as in main(). Progress is counted across the threads and logged every few seconds.
+        The files written are the same as with main().
+        :param multi: whether to follow manga as well
+        """
+        progress = Progress()
+
+        def succeeded(future) -> bool:
+            return future.exception() is None and future.result()
+
+        self.start_spider()
+
+        for next_page, _ in self.frontier.pending('page'):
+            with self.record_failure('page', next_page):
+                self.parse_json(next_page)
+
+        for url, _ in self.frontier.pending('detail'):
+            with self.record_failure('detail', url):
+                self.on_spider(url)
+
+        with ThreadPoolExecutor(self.site_def.get('download-threads', 8), thread_name_prefix='download',
+                                initializer=self.worker_session) as pool:
+            for download_url, page_url in self.frontier.pending('picture'):
+                pool.submit(self.download_pic, download_url, page_url) \
+                    .add_done_callback(lambda future: progress.add('picture', succeeded(future)))
+
+            if multi:
+                # the manga are read while the pictures download, and their pages are queued behind them
+                with ThreadPoolExecutor(self.site_def.get('manga-threads', 4), thread_name_prefix='manga',
+                                        initializer=self.worker_session) as readers:
+                    self.crawl_manga(readers, pool, progress)
+
+        self.frontier.flush()
+        logger.info('downloaded {}'.format(progress.summary()))
+        self.report()
+
+    def crawl_manga(self, readers: Executor, pages: Executor, progress: Progress=None) -> int:
+        """
+        Follow the manga in the frontier and download their pages. The reader pages of all the manga are read at
+        the same time, and each manga's pages start downloading as soon as its reader page is read, at most
+        'manga-window' of them at a time. A manga goes into the index once all its pages are downloaded. The pages
+        an earlier run left unfinished are downloaded as well.
+        :param readers: the threads that read the reader pages
+        :param pages: the threads that download the pages, possibly the same
+        :param progress: where to count the pages, if anywhere
+        :return: the number of manga downloaded whole
+        """
+        window = self.site_def.get('manga-window', 4)
+        works = []
+
+        def download(url, reader_url) -> bool:
+            downloaded = self.download_multipic(url, reader_url)
+            if progress is not None:
+                progress.add('manga page', downloaded)
+            return downloaded
+
+        def read(page_url) -> Optional[Tuple[str, List[str]]]:
+            with self.record_failure('manga', page_url):
+                return self.parse_multipic(page_url)
+
+        unfinished = {}
+        for url, reader_url in self.frontier.pending('manga-page'):
+            unfinished.setdefault(reader_url, []).append(url)
+        read_futures = [readers.submit(read, url) for url, _ in self.frontier.pending('manga')]
+        for reader_url, urls in unfinished.items():
+            works.append(MangaWork(reader_url, urls, download, pages, window))
+            works[-1].start()
+        for future in as_completed(read_futures):
+            if future.result() is not None:
+                works.append(MangaWork(*future.result(), download, pages, window))
+                works[-1].start()
+
+        complete = 0
+        for work in works:
+            if work.done.result():
+                self.index.add(self.illust_id(work.reader_url))
+                complete += 1
+        return complete
+
+    async def main_async(self, engine: 'AsyncEngine', multi=False):
+        """
+        The concurrent counterpart of main(). Each detail page is followed by its download as soon as it is
+        parsed, and the engine limits how many requests are in flight overall and per host. The files
+        written are the same as with main().
+        :param engine: the engine that runs the blocking stages
+        :param multi: whether to follow manga as well
+        """
+        import asyncio
+        counts = {'pictures': 0, 'manga': 0}
+
+        async def picture(download_url, page_url):
+            await engine.call(download_url, self.download_pic, download_url, page_url)
+            counts['pictures'] += 1
+            logger.info(f'downloading {counts["pictures"]} pictures')
+
+        async def manga_page(download_url, page_url):
+            downloaded = await engine.call(download_url, self.download_multipic, download_url, page_url)
+            counts['manga'] += 1
+            logger.info(f'downloading {counts["manga"]} manga')
+            return downloaded
+
+        async def manga(really_url, manga_urls):
+            window = asyncio.Semaphore(self.site_def.get('manga-window', 4))
+
+            async def in_window(url):
+                async with window:
+                    return await manga_page(url, really_url)
+
+            if all(await asyncio.gather(*(in_window(url) for url in manga_urls))):
+                self.index.add(self.illust_id(really_url))
+
+        async def json_page(url):
+            with self.record_failure('page', url):
+                await engine.call(url, self.parse_json, url)
+
+        async def manga_detail(page_url):
+            with self.record_failure('manga', page_url):
+                return await engine.call(page_url, self.parse_multipic, page_url)
+
+        async def detail(page_url):
+            # only the detail page itself fails here, the downloads and the manga mark their own failures
+            parsed = False
+            with self.record_failure('detail', page_url):
+                download_url = await engine.call(page_url, self.on_spider, page_url)
+                parsed = True
+            if not parsed:
+                return
+            if download_url is not None:
+                await picture(download_url, page_url)
+            elif multi:
+                found = await manga_detail(page_url)
+                if found is not None:
+                    await manga(*found)
+
+        await engine.call(self.begin_url, self.start_spider)
+        await asyncio.gather(*(json_page(url) for url, _ in self.frontier.pending('page')))
+        await asyncio.gather(*(detail(url) for url, _ in self.frontier.pending('detail')))
+
+        # whatever an earlier, interrupted run had found but not finished
+        await asyncio.gather(*(picture(url, page_url) for url, page_url in self.frontier.pending('picture')))
+        if multi:
+            await asyncio.gather(*(manga_detail(url) for url, _ in self.frontier.pending('manga')))
+            unfinished = {}
+            for url, really_url in self.frontier.pending('manga-page'):
+                unfinished.setdefault(really_url, []).append(url)
+            await asyncio.gather(*(manga(really_url, urls) for really_url, urls in unfinished.items()))
+
+        self.frontier.flush()
+
+        logger.info(f'downloaded {counts["pictures"]} pictures,{counts["manga"]} manga')
+        self.report()
+
+    async def main_pipeline(self, engine: 'AsyncEngine', multi=False):
+        """
+        The crawl as a pipeline: json pages, detail pages, manga, downloads and the bookkeeping after them are
+        stages with their own workers, connected by bounded queues, so that pictures are downloaded while the
+        ranking is still being read. The files written are the same as with main().
+        :param engine: the engine that runs the blocking stages
+        :param multi: whether to follow manga as well
+        """
+        from pipeline import Pipeline
+        settings = self.site_def.get('pipeline', {})
+        pipeline = Pipeline(settings.get('queue-size', 100))
+        counts = {'picture': 0, 'manga-page': 0}
+        manga_left = {}  # reader url: [pages still to download, whether all so far succeeded]
+
+        async def page(url):
+            with self.record_failure('page', url):
+                for detail_url in await engine.call(url, self.parse_json, url):
+                    await pipeline.put('detail', detail_url)
+
+        async def detail(page_url):
+            parsed = False
+            with self.record_failure('detail', page_url):
+                download_url = await engine.call(page_url, self.on_spider, page_url)
+                parsed = True
+            if not parsed:
+                return
+            if download_url is not None:
+                await pipeline.put('download', ('picture', download_url, page_url))
+            elif multi:
+                await pipeline.put('manga', page_url)
+
+        async def manga(page_url):
+            with self.record_failure('manga', page_url):
+                really_url, manga_urls = await engine.call(page_url, self.parse_multipic, page_url)
+                await manga_pages(really_url, manga_urls)
+
+        async def manga_pages(really_url, manga_urls):
+            if not manga_urls:
+                self.index.add(self.illust_id(really_url))
+                return
+            manga_left[really_url] = [len(manga_urls), True]
+            for url in manga_urls:
+                await pipeline.put('download', ('manga-page', url, really_url))
+
+        async def download(item):
+            kind, url, referer = item
+            function = self.download_pic if kind == 'picture' else self.download_multipic
+            downloaded = await engine.call(url, function, url, referer)
+            await pipeline.put('post', (kind, referer, downloaded))
 
+        async def post(item):
+            kind, referer, downloaded = item
+            counts[kind] += 1
+            logger.info(f'downloading {counts["picture"]} pictures, {counts["manga-page"]} manga')
+            if kind == 'manga-page':
+                left = manga_left[referer]
+                left[0], left[1] = left[0] - 1, left[1] and downloaded
+                if left[0] == 0:
+                    del manga_left[referer]
+                    if left[1]:
+                        self.index.add(self.illust_id(referer))
 
-class OpenClipartSpider(Spider):
+        async def seed():
+            await engine.call(self.begin_url, self.start_spider)
+            # what is in the frontier now: this run's first page and whatever an earlier run left unfinished
+            queued = {kind: self.frontier.pending(kind)
+                      for kind in ('page', 'detail', 'manga', 'picture', 'manga-page')}
+            for url, _ in queued['page']:
+                await pipeline.put('page', url)
+            for url, _ in queued['detail']:
+                await pipeline.put('detail', url)
+            for url, page_url in queued['picture']:
+                await pipeline.put('download', ('picture', url, page_url))
+            if multi:
+                for url, _ in queued['manga']:
+                    await pipeline.put('manga', url)
+                unfinished = {}
+                for url, really_url in queued['manga-page']:
+                    unfinished.setdefault(really_url, []).append(url)
+                for really_url, urls in unfinished.items():
+                    await manga_pages(really_url, urls)
+
+        def queue_depths():
+            for stage, depth in pipeline.depths().items():
+                yield 'scrapers_queue_depth', {'target': self.frontier.target, 'stage': stage}, depth
+
+        workers = settings.get('workers', {})
+        pipeline.add_stage('page', page, workers.get('page', 2))
+        pipeline.add_stage('detail', detail, workers.get('detail', 4))
+        pipeline.add_stage('manga', manga, workers.get('manga', 2))
+        pipeline.add_stage('download', download, workers.get('download', 8))
+        pipeline.add_stage('post', post, 1)
+        if self.metrics is not None:
+            self.metrics.collect(queue_depths)
+        try:
+            await pipeline.run(seed)
+        finally:
+            if self.metrics is not None:
+                self.metrics.forget(queue_depths)
+
+        self.frontier.flush()
+        logger.info(f'downloaded {counts["picture"]} pictures,{counts["manga-page"]} manga')
+        self.report()
+
+    def enumerate_work(self, queue: 'ShardQueue') -> int:
+        """
+        The coordinator's part of a distributed crawl: read the ranking and its json pages, and queue the detail
+        pages found for the workers.
+        :param queue: the work queue
+        :return: how many detail pages were queued
+        """
+        self.start_spider()
+        for next_page, _ in self.frontier.pending('page'):
+            with self.record_failure('page', next_page):
+                self.parse_json(next_page)
+        queued = queue.put([(self.frontier.target, self.illust_id(url), url)
+                            for url, _ in self.frontier.pending('detail')])
+        self.frontier.flush()
+        logger.info('{}: queued {} works'.format(self.frontier.target, queued))
+        return queued
+
+    def crawl_work(self, page_url, multi=False) -> bool:
+        """
+        The workers' part of a distributed crawl: a detail page, and the picture or the manga pages it leads to.
+        :param page_url: the detail page
+        :param multi: whether to follow manga as well
+        :return: whether everything was downloaded
+        """
+        download_url = self.on_spider(page_url)
+        if download_url is not None:
+            return self.download_pic(download_url, page_url)
+        if not multi:
+            return True
+        really_url, manga_urls = self.parse_multipic(page_url)
+        window = self.site_def.get('manga-window', 4)
+        with ThreadPoolExecutor(window, thread_name_prefix='manga', initializer=self.worker_session) as pool:
+            downloaded = MangaWork(really_url, manga_urls, self.download_multipic, pool, window).start().result()
+        if downloaded:
+            self.index.add(self.illust_id(really_url))
+        return downloaded
+
+    def work(self, queue: 'ShardQueue', worker: str, multi=False):
+        """
+        Run as a worker of a distributed crawl: lease a shard, crawl its detail pages, each with a spider for its
+        target, and ask for the next, until the coordinator has queued everything and nothing is pending. While a
+        shard is being crawled, a thread renews its lease; if it is lost anyway, e.g. after a long pause, the shard
+        is left to its new holder.
+        :param queue: the work queue, or a proxy for the coordinator's
+        :param worker: the name of this worker
+        :param multi: whether to follow manga as well
+        """
+        from distributed import ShardQueue, open_queue
+        distributed_def = self.site_def.get('distributed', {})
+        poll, lease = distributed_def.get('poll', 2), distributed_def.get('lease', 60)
+        progress = Progress()
+        spiders = {}
+
+        def heartbeat(shard: int, done: threading.Event):
+            # the queue file is shared by the threads of the worker, but a proxy is not to be
+            renewals = queue if isinstance(queue, ShardQueue) else open_queue(distributed_def)
+            while not done.wait(lease / 3):
+                if not renewals.renew(shard, worker):
+                    return
+
+        while True:
+            shard = queue.lease(worker)
+            if shard is None:
+                if queue.finished():
+                    break
+                time.sleep(poll)
+                continue
+
+            done = threading.Event()
+            threading.Thread(target=heartbeat, args=(shard, done), name='heartbeat', daemon=True).start()
+            try:
+                for target, url in queue.items(shard):
+                    if target not in spiders:
+                        spiders[target] = self.for_target(*target.split('/'))
+                    try:
+                        succeeded = spiders[target].crawl_work(url, multi)
+                    except Exception as e:
+                        logger.warning('{} failed: {}'.format(url, e))
+                        succeeded = False
+                    if not queue.finish(shard, worker, target, url, succeeded):
+                        logger.warning('{} lost shard {}'.format(worker, shard))
+                        break
+                    progress.add('work', succeeded)
+                else:
+                    queue.release(shard, worker)
+            finally:
+                done.set()
+
+        for spider in spiders.values():
+            spider.frontier.flush()
+        logger.info('{} done: {}'.format(worker, progress.summary()))
+        self.report()
+
+
+class RuleSpider(Spider):
     """
+    Downloads the assets of a site described by the rules of its site definition, so that a site is added with
+    configuration alone. The crawl starts from the urls of the start section, by kind of page; each page is read
+    with the rules of its kind, see RuleExtractor, and the links it has are followed to the pages of their kinds,
+    e.g. the next listing page or the detail pages, at most max-pages pages of a kind in a run. The assets found
+    are then downloaded into the site's directory, each named by the last part of its url.
 
+    The pages and the assets are kept in the frontier, as with Pixiv, so an interrupted crawl picks up where it
+    stopped. The sites are crawled without logging in.
     """
+    STAGES = {'parse_page': 'page', 'download_asset': 'download'}
+
     def __init__(self, site_def: dict):
         super().__init__()
+        self.setup(site_def)
 
-        self.session.headers = site_def['headers']
-        self.session.cookies = cookiejar.LWPCookieJar(site_def['cookie-file'])
+        self.rules = RuleExtractor(site_def['pages'])
+        self.start = site_def.get('start', {})
+        unknown = set(self.start) - set(self.rules.kinds)
+        if unknown:
+            raise ScraperException('RuleSpider', 'the start urls of {} have no rules'.format(', '.join(unknown)))
+        self.max_pages = site_def.get('max-pages', {})
+        self.directory = site_def.get('directory', os.path.join('Picture', site_def['slug']))
+        self.frontier = Frontier(site_def.get('frontier-file', site_def['slug'] + '-frontier.sqlite'),
+                                 site_def['slug'], site_def.get('frontier-batch', 500))
+        self.setup_metrics(site_def)
 
-        self.params = site_def['params']
-        self.data = site_def['data']
-        self.site_def = site_def
+    def for_targets(self, specs: List[str]) -> List['RuleSpider']:
+        raise ScraperException('RuleSpider.for_targets', 'the sites crawled by rules have a single target')
+
+    def check_login(self) -> bool:
+        return True
+
+    def login(self, crypt: SimpleCrypt, account_name='account') -> bool:
+        return True
+
+    def parse_page(self, kind: str, url: str) -> bool:
+        """
+        Read a page and record the pages and the assets it links to.
+        :param kind: the kind of the page
+        :param url: the url of the page
+        :return: True
+        """
+        response = self.fetch(url)
+        response.raise_for_status()
+        links, assets = self.rules.extract(kind, response.content)
+        for link_kind, link_urls in links.items():
+            for link_url in link_urls:
+                self.frontier.discover(link_kind, urljoin(response.url, link_url), url)
+        for asset_url in assets:
+            self.frontier.discover('asset', urljoin(response.url, asset_url), url)
+        self.frontier.mark(kind, url, Frontier.PARSED)
+        logger.debug('{} {}: {} links, {} assets'.format(
+            kind, url, sum(len(link_urls) for link_urls in links.values()), len(assets)))
+        return True
+
+    def asset_file(self, url: str) -> str:
+        name = unquote(os.path.basename(urlsplit(url).path))
+        return os.path.join(self.directory, name or hashlib.md5(url.encode()).hexdigest())
+
+    def download_asset(self, url: str, page_url: str) -> bool:
+        """
+        Download an asset, unless its file is there already.
+        :param url: the url of the asset
+        :param page_url: the page it was found on, the referer
+        :return: whether the asset is downloaded
+        """
+        file_name = self.asset_file(url)
+        self.make_dir(self.directory)
+        try:
+            if not os.path.exists(file_name):
+                self.download(url, file_name, referer=page_url,
+                              record={'site': self.site_def['slug'], 'kind': 'asset', 'referer': page_url})
+        except Exception as e:
+            logger.warning('asset {} failed: {}'.format(url, e))
+            self.frontier.mark('asset', url, Frontier.FAILED)
+            return False
+        self.frontier.mark('asset', url, Frontier.DOWNLOADED)
+        return True
+
+    def read_pages(self):
+        """
+        Read the pages, from the start urls, until no kind has pages left to read or may read more.
+        """
+        for kind, urls in self.start.items():
+            for url in [urls] if isinstance(urls, str) else urls:
+                self.frontier.discover(kind, url)
+        read = dict.fromkeys(self.rules.kinds, 0)
+        found = True
+        while found:
+            found = False
+            for kind in self.rules.kinds:
+                for url, _ in self.frontier.pending(kind):
+                    if kind in self.max_pages and read[kind] >= self.max_pages[kind]:
+                        break
+                    found = True
+                    read[kind] += 1
+                    with self.record_failure(kind, url):
+                        self.parse_page(kind, url)
+        logger.info('read {}'.format(', '.join('{} {} pages'.format(count, kind) for kind, count in read.items())))
+
+    def main(self, multi=False):
+        """
+        Read the pages, then download the assets one after the other.
+        :param multi: not used, the rules say what to follow
+        """
+        progress = Progress()
+        self.read_pages()
+        for url, page_url in self.frontier.pending('asset'):
+            progress.add('asset', self.download_asset(url, page_url))
+        self.frontier.flush()
+        logger.info('downloaded {}'.format(progress.summary()))
+        self.report()
+
+    def main_threaded(self, multi=False):
+        """
+        main() with the downloads handed to a pool of 'download-threads' threads, each with a session of its own.
+        :param multi: not used, the rules say what to follow
+        """
+        progress = Progress()
+        self.read_pages()
+        with ThreadPoolExecutor(self.site_def.get('download-threads', 8), thread_name_prefix='download',
+                                initializer=self.worker_session) as pool:
+            for url, page_url in self.frontier.pending('asset'):
+                pool.submit(self.download_asset, url, page_url) \
+                    .add_done_callback(lambda future: progress.add('asset', future.result()))
+        self.frontier.flush()
+        logger.info('downloaded {}'.format(progress.summary()))
+        self.report()
+
+
+SPIDERS = {'pixiv': PixivSpider, 'rules': RuleSpider}
 
 
 def get_spider(conf: Configuration, site: str) -> Spider:
     """
-    Return the appropriate spider for the site.
+    Return the appropriate spider for the site: the one named by the spider setting of its site definition, or
+    else the one named like the site. A site with a pages section and no spider of its own is crawled by its rules.
     :param conf: the Configuration object
     :param site: the slug name of the site
     :return: an instance of the appropriate spider, or None
     """
     site_def = conf.get_site(site)  # don't handle the exception, let it propagate
-    if site == 'pixiv':
-        return PixivSpider(site_def)
-    elif site == 'openclipart':
-        return OpenClipartSpider(site_def)
-    else:
-        raise ScraperException('get_spider', 'No spider for site {}'.format(site))
\ No newline at end of file
+    name = site_def.get('spider') or (site if site in SPIDERS or 'pages' not in site_def else 'rules')
+    if name not in SPIDERS:
+        raise ScraperException('get_spider', 'No spider for site {}'.format(site))
+    return SPIDERS[name](site_def)
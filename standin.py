@@ -0,0 +1,200 @@
+# coding: utf-8
+"""
+File: standin.py
+
+A local stand-in for Pixiv, serving synthetic pages and images, for the benchmarks of the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import json
+import time
+import hashlib
+import threading
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from typing import Dict
+
+
+def filler(blocks: int) -> str:
+    """
+    The markup around the interesting parts of a page: navigation, tag lists, comments and inline scripts, in about
+    the proportions of a real Pixiv page.
+    :param blocks: how many blocks of it, each about 1.5kB
+    """
+    return ''.join('<div class="section-{0}"><ul class="tags">{1}</ul>'
+                   '<p class="caption">Some caption text, <b>with</b> <a href="/tags/{0}">a tag</a> in it.</p>'
+                   '<script>var data{0} = {{"id": {0}, "values": [{2}]}};</script></div>'
+                   .format(i, ''.join('<li class="tag"><a href="/search?word={}">tag</a></li>'.format(j)
+                                      for j in range(20)), ', '.join(str(j) for j in range(40)))
+                   for i in range(blocks))
+
+
+def page(body: str, blocks: int=60) -> bytes:
+    """
+    :param body: the interesting part
+    :param blocks: the amount of filler around it
+    :return: a whole page
+    """
+    return ('<!DOCTYPE html><html><head><title>sample</title></head><body>{}{}{}</body></html>'
+            .format(filler(blocks // 2), body, filler(blocks // 2)).encode())
+
+
+def ranking_body(illust_ids) -> str:
+    return ''.join('<section class="ranking-item"><div class="ranking-image-item"><a href="/member_illust.php'
+                   '?mode=medium&amp;illust_id={0}" class="work"><img src="/c/240x480/{0}.jpg"></a></div>'
+                   '<h2><a href="/member_illust.php?mode=medium&amp;illust_id={0}" class="title">Title {0}</a>'
+                   '</h2></section>'.format(illust_id) for illust_id in illust_ids)
+
+
+def detail_body(image_url: str) -> str:
+    return ('<div class="works_display"><img class="original-image" data-src="{}"></div>'.format(image_url))
+
+
+def manga_detail_body(illust_id: int) -> str:
+    return ('<a href="member_illust.php?mode=manga&amp;illust_id={}" class="read-more js-click-trackable">'
+            'Read more</a>'.format(illust_id))
+
+
+def reader_body(image_urls) -> str:
+    return ''.join('<div class="item-container"><img class="image ui-scroll-view" data-src="{}"></div>'.format(url)
+                   for url in image_urls)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server: 'StandIn'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        server = self.server
+        time.sleep(server.latency)
+        if server.throttled():
+            self.reply('throttled', b'too many requests', code=HTTPStatus.TOO_MANY_REQUESTS,
+                       headers={'Retry-After': server.retry_after} if server.retry_after is not None else None)
+        elif url.path == '/ranking.php' and 'format' in query:
+            first = (int(query.get('p', 1)) - 1) * server.per_page
+            contents = [{'illust_id': illust_id} for illust_id in server.ids[first:first + server.per_page]]
+            self.reply('json', json.dumps({'contents': contents}).encode(), 'application/json')
+        elif url.path == '/ranking.php':
+            self.reply('ranking', page(ranking_body(server.ids[:server.per_page]) +
+                                       '<input type="hidden" name="tt" value="fedcba9876543210">', server.blocks))
+        elif url.path == '/member_illust.php' and query.get('mode') == 'manga':
+            illust_id = int(query['illust_id'])
+            self.reply('reader', page(reader_body('{}img/{}_p{}.jpg'.format(server.base, illust_id, i)
+                                                  for i in range(server.manga_pages)), server.blocks))
+        elif url.path == '/member_illust.php':
+            illust_id = int(query['illust_id'])
+            if server.is_manga(illust_id):
+                body = manga_detail_body(illust_id)
+            else:
+                body = detail_body('{}img/{}_p0.png'.format(server.base, illust_id))
+            self.reply('detail', page(body, server.blocks))
+        elif url.path.startswith('/img/'):
+            self.image(url.path)
+        elif url.path == '/setting_user.php':
+            self.reply('other', b'ok')
+        else:
+            self.reply('other', b'not found', code=HTTPStatus.NOT_FOUND)
+
+    def image(self, path: str):
+        """
+        Serve an image: distinct bytes for every path, always the same for the same path, with an ETag and ranges.
+        """
+        seed = hashlib.sha256(path.encode()).digest()
+        body = (seed * (self.server.image_size // len(seed) + 1))[:self.server.image_size]
+        headers = {'ETag': '"{}"'.format(seed.hex()[:16])}
+        requested = self.headers.get('Range', '')
+        if requested.startswith('bytes=') and requested.endswith('-') and \
+                self.headers.get('If-Range', headers['ETag']) == headers['ETag']:
+            start = int(requested[6:-1])
+            if start >= len(body):
+                return self.reply('image', b'', code=HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                                  headers={'Content-Range': 'bytes */{}'.format(len(body))})
+            headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))
+            return self.reply('image', body[start:], 'image/png', HTTPStatus.PARTIAL_CONTENT, headers)
+        self.reply('image', body, 'image/png', headers=headers)
+
+    def reply(self, kind: str, body: bytes, content_type: str='text/html', code: int=HTTPStatus.OK,
+              headers: Dict[str, str]=None):
+        self.server.count(kind, len(body))  # before the client can have the response, so that it sees the counts
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StandIn(ThreadingHTTPServer):
+    """
+    Serves a ranking of pages * per_page works on 127.0.0.1: the first ranking page as HTML, the others as json,
+    a detail page for each work, a reader page for each manga and the images. Every manga_every-th work is a
+    manga of manga_pages pages. Each response waits latency seconds first, and counts its bytes by kind. Every
+    throttle_every-th request is answered 429 Too Many Requests instead, with a Retry-After of retry_after if it is
+    given, as a server that is overloaded or limits the rate of its clients would.
+    """
+    daemon_threads = True
+
+    def __init__(self, pages: int=3, per_page: int=50, manga_every: int=4, manga_pages: int=3,
+                 image_size: int=200000, latency: float=0.0, blocks: int=60, throttle_every: int=0,
+                 retry_after: str=None):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.pages, self.per_page = pages, per_page
+        self.manga_every, self.manga_pages = manga_every, manga_pages
+        self.image_size, self.latency, self.blocks = image_size, latency, blocks
+        self.throttle_every, self.retry_after = throttle_every, retry_after
+        self.received = 0
+        self.ids = [70000000 + i for i in range(pages * per_page)]
+        self.base = 'http://127.0.0.1:{}/'.format(self.server_port)
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.bytes: Dict[str, int] = {}
+        self.thread: threading.Thread = None
+
+    def is_manga(self, illust_id: int) -> bool:
+        return bool(self.manga_every) and illust_id % self.manga_every == 0
+
+    def throttled(self) -> bool:
+        """
+        :return: whether to answer this request with 429
+        """
+        with self.lock:
+            self.received += 1
+            return bool(self.throttle_every) and self.received % self.throttle_every == 0
+
+    def count(self, kind: str, size: int):
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+            self.bytes[kind] = self.bytes.get(kind, 0) + size
+
+    def start(self) -> 'StandIn':
+        self.thread = threading.Thread(target=self.serve_forever, name='standin', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def site_def(self, site_def: dict) -> dict:
+        """
+        :param site_def: a Pixiv site definition, e.g. from config.yaml
+        :return: a copy of it with the urls pointing at the stand-in and max-page matching its ranking
+        """
+        site_def = dict(site_def, **{'max-page': self.pages})
+        site_def['headers'] = dict(site_def.get('headers', {}), Referer=self.base)
+        site_def['url'] = dict(site_def.get('url', {}), **{
+            'front-url': self.base,
+            'detail-url': self.base + 'member_illust.php?mode=medium&illust_id=',
+            'manga-url': self.base + 'member_illust.php?mode=manga&illust_id=',
+            'user-settings': self.base + 'setting_user.php',
+            'ranking-url': self.base + 'ranking.php?mode={}&p={}&format=json&tt={}&date={}',
+            'begin-url': self.base + 'ranking.php?mode={}&ref=rn-h-{}-3&date={}'})
+        return site_def
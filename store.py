@@ -0,0 +1,82 @@
+# coding: utf-8
+"""
+File: store.py
+
+Content-addressed file storage for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import shutil
+import threading
+import logging
+
+
+logger = logging.getLogger('scr')
+
+
+class BlobStore:
+    """
+    Keeps each distinct file once, under its SHA-256 digest, and hardlinks it to wherever the spider wants it. A
+    picture that appears in many rankings then takes its disk space, and its write, only once.
+    """
+    def __init__(self, root: str):
+        """
+        :param root: the directory of the store, best on the same file system as the downloads
+        """
+        self.root = root
+        self.lock = threading.Lock()
+        self.files = 0
+        self.blobs = 0
+        self.logical_bytes = 0
+        self.stored_bytes = 0
+
+    def blob_name(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put(self, file_name: str, target: str, digest: str):
+        """
+        Move a complete file into the store, unless its content is there already, and link it to the target.
+        :param file_name: the downloaded file, it is consumed
+        :param target: where the content should appear
+        :param digest: the hex SHA-256 digest of the file
+        """
+        blob = self.blob_name(digest)
+        size = os.path.getsize(file_name)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        if os.path.exists(blob):
+            os.unlink(file_name)
+            new = False
+        else:
+            os.replace(file_name, blob)
+            new = True
+
+        link_name = target + '.link'
+        if os.path.exists(link_name):
+            os.unlink(link_name)
+        try:
+            os.link(blob, link_name)
+        except OSError:
+            # a different file system, or one without hardlinks
+            shutil.copyfile(blob, link_name)
+        os.replace(link_name, target)
+
+        with self.lock:
+            self.files += 1
+            self.logical_bytes += size
+            if new:
+                self.blobs += 1
+                self.stored_bytes += size
+
+    def report(self) -> str:
+        """
+        :return: a summary of what the store saved during this run
+        """
+        with self.lock:
+            if self.stored_bytes:
+                ratio = self.logical_bytes / self.stored_bytes
+            else:
+                ratio = float('inf') if self.logical_bytes else 1.0
+            return 'stored {} files as {} blobs, {} of {} bytes written, dedup ratio {:.2f}'.format(
+                self.files, self.blobs, self.stored_bytes, self.logical_bytes, ratio)
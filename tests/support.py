@@ -0,0 +1,56 @@
+# coding: utf-8
+"""
+File: support.py
+
+What the tests share: the package on the path, a Pixiv stand-in and a site definition for it, for the scrapers
+package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from config import Configuration  # noqa: E402
+from standin import StandIn  # noqa: E402
+
+
+def site_def(server: StandIn, **settings) -> dict:
+    """
+    :param server: the stand-in
+    :param settings: settings to add or replace
+    :return: the Pixiv site definition of config.yaml, pointed at the stand-in and writing its files to the
+        current directory, without the parts that would measure the settings instead of the spider
+    """
+    definition = server.site_def(Configuration(os.path.join(ROOT, 'config.yaml')).get_site('pixiv'))
+    for key in ('throttle', 'cache', 'metrics', 'blob-store', 'manifest', 'targets', 'date'):
+        definition.pop(key, None)
+    definition.update({'cookie-file': 'cookies', 'frontier-file': 'frontier.sqlite', 'index-file': 'index.sqlite',
+                       'incremental': False, 'parse-workers': 0, 'extractor': 'lxml'})
+    definition.update(settings)
+    return definition
+
+
+class StandInTest(unittest.TestCase):
+    """
+    A test with a stand-in of its own, in a temporary directory.
+    """
+    standin = {'pages': 1, 'per_page': 6, 'manga_every': 0, 'image_size': 4000}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='scrapers-test-')
+        self.here = os.getcwd()
+        os.chdir(self.directory)
+        self.server = StandIn(**self.standin).start()
+
+    def tearDown(self):
+        self.server.stop()
+        os.chdir(self.here)
+        shutil.rmtree(self.directory, ignore_errors=True)
@@ -0,0 +1,75 @@
+# coding: utf-8
+"""
+File: test_distributed.py
+
+Tests of the distributed crawl, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import unittest
+from xmlrpc.client import ProtocolError
+import support
+from distributed import ShardQueue, serve_queue, open_queue
+from profiler import StageProfiler
+from frontier import Frontier
+from spiders import PixivSpider
+
+
+class WorkerTest(support.StandInTest):
+    def test_profiled_worker_over_two_targets(self):
+        site_def = support.site_def(self.server, distributed={'queue-file': 'queue.sqlite', 'poll': 0.1})
+        coordinator = PixivSpider(site_def)
+        queue = ShardQueue('queue.sqlite', 8)
+        queue.open()
+        for target in coordinator.for_targets(['daily,weekly:20181105']):
+            target.enumerate_work(queue)
+        queue.close()
+        coordinator.close()
+
+        worker = PixivSpider(dict(site_def, **{'frontier-file': ':memory:'}))
+        profiler = StageProfiler(self.directory)
+        profiler.start()
+        worker.instrument(profiler)
+        try:
+            worker.work(queue, 'worker')
+        finally:
+            profiler.stop()
+            worker.close()
+
+        self.assertTrue(queue.finished())
+        pictures = sorted('{}.png'.format(illust_id) for illust_id in self.server.ids)
+        self.assertEqual(sorted(os.listdir('Picture')), ['daily', 'weekly'])
+        for rank in ('daily', 'weekly'):
+            self.assertEqual(os.listdir(os.path.join('Picture', rank)), ['20181105'])
+            self.assertEqual(sorted(os.listdir(os.path.join('Picture', rank, '20181105'))), pictures)
+        marked = {(target, kind, state): count for target, kind, state, count in worker.frontier.counts()}
+        for target in ('daily/20181105', 'weekly/20181105'):
+            self.assertEqual(marked.get((target, 'picture', Frontier.DOWNLOADED)), len(pictures))
+        self.assertNotIn(worker.frontier.target, {target for target, _, _ in marked})
+        for stage in ('detail', 'download'):
+            self.assertTrue(os.path.exists(profiler.file_name(stage, '.pstats')))
+
+
+class ServedQueueTest(support.StandInTest):
+    def test_token(self):
+        queue = ShardQueue('queue.sqlite', 8)
+        server = serve_queue(queue, '0', 'secret')
+        try:
+            host, port = server.server_address[:2]
+            self.assertEqual(host, '127.0.0.1')
+            url = 'http://127.0.0.1:{}/'.format(port)
+            self.assertFalse(open_queue({'queue-url': url, 'token': 'secret'}).finished())
+            for token in (None, 'guess'):
+                with self.subTest(token=token), self.assertRaises(ProtocolError) as raised:
+                    open_queue({'queue-url': url, 'token': token}).lease('intruder')
+                self.assertEqual(raised.exception.errcode, 403)
+            self.assertEqual(queue.counts()['leased'], 0)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+# coding: utf-8
+"""
+File: test_download.py
+
+Tests of the resumable downloads, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import json
+import hashlib
+import unittest
+import requests
+import support
+from spiders import PixivSpider
+from frontier import Frontier
+
+
+class DownloadTest(support.StandInTest):
+    def setUp(self):
+        super().setUp()
+        self.spider = PixivSpider(support.site_def(self.server))
+        self.path = '/img/70000001_p0.png'
+        self.url = self.server.base + self.path[1:]
+        seed = hashlib.sha256(self.path.encode()).digest()
+        self.body = (seed * (self.server.image_size // len(seed) + 1))[:self.server.image_size]
+        self.etag = '"{}"'.format(seed.hex()[:16])
+
+    def tearDown(self):
+        self.spider.close()
+        super().tearDown()
+
+    def leave_part(self, size: int, **journal):
+        """
+        Leave what an interrupted download would have: the first size bytes in the part, and its journal.
+        """
+        with open('image.png.part', 'wb') as f:
+            f.write(self.body[:size])
+        with open('image.png.part.json', 'w', encoding='utf-8') as f:
+            json.dump(dict({'url': self.url, 'length': len(self.body), 'etag': self.etag, 'last-modified': None},
+                           **journal), f)
+
+    def assert_downloaded(self, requested: int, sent: int):
+        """
+        :param requested: the image requests the stand-in should have had
+        :param sent: the image bytes it should have sent
+        """
+        with open('image.png', 'rb') as f:
+            self.assertEqual(f.read(), self.body)
+        self.assertFalse(os.path.exists('image.png.part'))
+        self.assertFalse(os.path.exists('image.png.part.json'))
+        self.assertEqual(self.server.requests.get('image'), requested)
+        self.assertEqual(self.server.bytes.get('image'), sent)
+
+    def test_whole(self):
+        self.assertEqual(self.spider.download(self.url, 'image.png'), len(self.body))
+        self.assert_downloaded(1, len(self.body))
+
+    def test_resumed(self):
+        self.leave_part(1000)
+        self.assertEqual(self.spider.download(self.url, 'image.png'), len(self.body))
+        self.assert_downloaded(1, len(self.body) - 1000)
+
+    def test_changed(self):
+        self.leave_part(1000, etag='"another-version"')
+        self.assertEqual(self.spider.download(self.url, 'image.png'), len(self.body))
+        self.assert_downloaded(1, len(self.body))
+
+    def test_complete_part(self):
+        self.leave_part(len(self.body))
+        self.assertEqual(self.spider.download(self.url, 'image.png'), len(self.body))
+        self.assert_downloaded(1, 0)
+
+    def test_unsatisfiable(self):
+        # the part is as long as the body, but the journal does not say how long that is
+        self.leave_part(len(self.body), length=None)
+        self.assertEqual(self.spider.download(self.url, 'image.png'), len(self.body))
+        self.assert_downloaded(2, len(self.body))
+
+    def test_not_found(self):
+        with self.assertRaises(requests.HTTPError):
+            self.spider.download(self.server.base + 'img-missing/70000001_p0.png', 'image.png')
+        self.assertEqual([name for name in os.listdir('.') if name.startswith('image.png')], [])
+        self.assertEqual(self.server.requests.get('image'), None)
+
+    def test_throttled_detail(self):
+        # the retries run out on a 429, which must not pass for a detail page without a picture, i.e. a manga
+        spider = PixivSpider(support.site_def(self.server, retry={'attempts': 2, 'backoff': 0.01},
+                                              **{'frontier-file': 'throttled.sqlite'}))
+        self.server.throttle_every = 1
+        detail_url = spider.detail_url + '70000001'
+        spider.frontier.discover('detail', detail_url)
+        try:
+            with spider.record_failure('detail', detail_url):
+                spider.on_spider(detail_url)
+            spider.frontier.flush()
+            self.assertEqual(spider.frontier.state('detail', detail_url), Frontier.FAILED)
+            self.assertEqual(list(spider.frontier.pending('manga')), [])
+            self.assertEqual(self.server.requests.get('throttled'), 2)
+        finally:
+            spider.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# coding: utf-8
+"""
+File: test_extractors.py
+
+Tests of the page extractors, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import unittest
+import support  # noqa: F401
+from extractors import EXTRACTORS
+from helper import ScraperException
+from standin import page, ranking_body
+
+
+EMPTY = (b'', b'  ', b'<html></html>', page(''))
+NO_TT = page(ranking_body([70000000, 70000001]))
+
+
+class ExtractorTest(unittest.TestCase):
+    """
+    Every extractor reads the same from the same page, and fails the same where there is nothing to read.
+    """
+    def test_empty(self):
+        for name, cls in EXTRACTORS.items():
+            for content in EMPTY:
+                with self.subTest(extractor=name, content=content[:20]):
+                    extractor = cls()
+                    self.assertEqual(extractor.ranking(content), ([], None))
+                    self.assertIsNone(extractor.original_image(content))
+                    self.assertEqual(extractor.manga_images(content), [])
+                    for method in ('post_key', 'reader_link'):
+                        with self.assertRaises(ScraperException):
+                            getattr(extractor, method)(content)
+
+    def test_no_tt(self):
+        # links to the detail pages, but not the key to the json pages after them
+        for name, cls in EXTRACTORS.items():
+            with self.subTest(extractor=name), self.assertRaises(ScraperException):
+                cls().ranking(NO_TT)
+
+    def test_ranking(self):
+        content = NO_TT.replace(b'</body>', b'<input type="hidden" name="tt" value="0123"></body>')
+        for name, cls in EXTRACTORS.items():
+            with self.subTest(extractor=name):
+                self.assertEqual(cls().ranking(content), (
+                    ['/member_illust.php?mode=medium&illust_id=70000000',
+                     '/member_illust.php?mode=medium&illust_id=70000001'], '0123'))
+
+
+if __name__ == '__main__':
+    unittest.main()
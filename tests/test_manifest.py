@@ -0,0 +1,59 @@
+# coding: utf-8
+"""
+File: test_manifest.py
+
+Tests of the manifest of the downloads, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import support  # noqa: F401, puts the package on the path
+from manifest import Manifest, ManifestIndex, read_manifest
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='scrapers-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, name: str, compress: bool) -> Manifest:
+        manifest = Manifest(self.directory, name, compress)
+        for illust_id in range(5):
+            manifest.record(illust=illust_id, rank='daily', date='2018110{}'.format(illust_id % 2), path=None)
+        manifest.close()
+        return manifest
+
+    def test_written_and_found(self):
+        for compress in (False, True):
+            manifest = self.write('run-{}'.format(compress), compress)
+            records = list(read_manifest(manifest.file_name))
+            self.assertEqual([record['illust'] for record in records], list(range(5)))
+            self.assertNotIn('path', records[0])
+        index = ManifestIndex(os.path.join(self.directory, 'manifest-index.sqlite'))
+        self.assertEqual([record['illust'] for record in index.find(illust_id=3)], [3, 3])
+        self.assertEqual(len(index.find(date='20181101', rank='daily')), 4)
+        self.assertEqual(index.find(rank='weekly'), [])
+        index.close()
+
+    def test_same_name(self):
+        first, second = Manifest(self.directory, 'run'), Manifest(self.directory, 'run')
+        self.assertNotEqual(first.file_name, second.file_name)
+        first.close()
+        second.close()
+
+    def test_bad_record_skipped(self):
+        manifest = Manifest(self.directory, 'run')
+        manifest.record(illust=1, started=object())  # not json, logged and left out
+        manifest.record(illust=2)
+        manifest.close()
+        self.assertEqual([record['illust'] for record in read_manifest(manifest.file_name)], [2])
+        self.assertEqual(manifest.written, 1)
+
+if __name__ == '__main__':
+    unittest.main()
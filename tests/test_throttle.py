@@ -0,0 +1,87 @@
+# coding: utf-8
+"""
+File: test_throttle.py
+
+Tests of the per-host throttle against a stand-in that answers 429, for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import time
+import threading
+import unittest
+from http import HTTPStatus
+import support
+from spiders import PixivSpider
+
+
+class ThrottleTest(support.StandInTest):
+    standin = dict(support.StandInTest.standin, throttle_every=2, retry_after='1')
+    # fast enough that only the answers of the host limit it, and blind to the noise of local latencies
+    host_def = {'rate': 1000, 'burst': 1000, 'concurrency': 4, 'min-concurrency': 1, 'max-concurrency': 8,
+                'latency-factor': 1000}
+
+    def setUp(self):
+        super().setUp()
+        self.spider = PixivSpider(support.site_def(self.server, throttle={'default': self.host_def}))
+        self.url = self.server.base + 'img/70000000_p0.png'
+        self.host = self.spider.throttle.host(self.url)
+
+    def tearDown(self):
+        self.spider.close()
+        super().tearDown()
+
+    def send(self) -> int:
+        return self.spider.send(self.url, {}).status_code
+
+    def test_backs_off_and_recovers(self):
+        self.assertEqual(self.send(), HTTPStatus.OK)
+        grown = self.host.limit
+        self.assertGreater(grown, self.host_def['concurrency'])
+        self.assertEqual(self.send(), HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertAlmostEqual(self.host.limit, grown / 2)
+        self.assertLess(int(self.host.limit), self.host_def['concurrency'])
+
+        # the host asked for a second without requests
+        started = time.monotonic()
+        self.assertEqual(self.send(), HTTPStatus.OK)
+        self.assertGreaterEqual(time.monotonic() - started, 0.9)
+
+        self.server.throttle_every = 0
+        backed_off = self.host.limit
+        for _ in range(20):
+            self.assertEqual(self.send(), HTTPStatus.OK)
+        self.assertGreaterEqual(self.host.limit, self.host_def['concurrency'])
+        self.assertLessEqual(self.host.limit, self.host_def['max-concurrency'])
+        self.assertGreater(self.host.limit, backed_off)
+
+        counters = self.spider.throttle.counters()[self.host.name]
+        self.assertEqual(counters['requests'], 23)
+        self.assertEqual(counters['overloaded'], 1)
+        self.assertEqual(counters['decreases'], 1)
+        self.assertEqual(counters['increases'], 22)
+        self.assertEqual(counters['in_flight'], 0)
+
+    def test_floor(self):
+        self.server.throttle_every, self.server.retry_after = 1, None
+        for _ in range(6):
+            self.assertEqual(self.send(), HTTPStatus.TOO_MANY_REQUESTS)
+        self.assertEqual(self.host.limit, self.host_def['min-concurrency'])
+        counters = self.spider.throttle.counters()[self.host.name]
+        self.assertEqual(counters['overloaded'], 6)
+        self.assertLess(counters['decreases'], 6)  # none once it is at the floor
+        self.assertLess(counters['waited'], 0.5)  # without Retry-After the rate is not paused
+
+        # one request at a time: the second waits for the first to be released
+        first = self.host.acquire()
+        second = threading.Thread(target=lambda: self.host.acquire().release())
+        second.start()
+        second.join(0.3)
+        self.assertTrue(second.is_alive())
+        first.release()
+        second.join(5)
+        self.assertFalse(second.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
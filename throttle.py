@@ -0,0 +1,201 @@
+# coding: utf-8
+"""
+File: throttle.py
+
+Per-host rate limiting and adaptive concurrency for the scrapers package.
+"""
+__author__ = 'Marko Čibej'
+
+
+import time
+import threading
+import logging
+from http import HTTPStatus
+from typing import Optional
+from urllib.parse import urlsplit
+
+
+logger = logging.getLogger('scr')
+
+
+class TokenBucket:
+    """
+    Lets through rate requests per second on average, with bursts of up to burst requests.
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate, self.burst = rate, burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """
+        Take a token, waiting for one if there are none.
+        :return: the time spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+            waited += delay
+
+    def pause(self, seconds: float):
+        """
+        Hand out no tokens for a while, e.g. because the server asked for it with Retry-After.
+        :param seconds: how long
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Ticket:
+    """
+    One request's claim on a host: it is answered once, when the response or the error arrives, and released once,
+    when the connection is free again.
+    """
+    def __init__(self, host: 'HostThrottle'):
+        self.host = host
+        self.started = time.monotonic()
+        self.answered = self.released = False
+
+    def answer(self, status: Optional[int], retry_after: Optional[str]=None):
+        """
+        :param status: the HTTP status, or None if the request failed
+        :param retry_after: the Retry-After header, if any
+        """
+        if not self.answered:
+            self.answered = True
+            self.host.feedback(status, time.monotonic() - self.started, retry_after)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.host.release()
+
+
+class HostThrottle:
+    """
+    The limits for one host: a token bucket for the request rate, and a concurrency limit that grows additively
+    while the host answers well and shrinks multiplicatively when it answers 429 or 503, fails, or becomes slow.
+    """
+    OVERLOADED = (HTTPStatus.TOO_MANY_REQUESTS, HTTPStatus.SERVICE_UNAVAILABLE)
+
+    def __init__(self, name: str, host_def: dict):
+        """
+        :param name: the host
+        :param host_def: the settings of the host, from the throttle section of the site definition
+        """
+        self.name = name
+        self.bucket = TokenBucket(host_def.get('rate', 5), host_def.get('burst', 10))
+        self.min_limit = host_def.get('min-concurrency', 1)
+        self.max_limit = host_def.get('max-concurrency', 16)
+        self.limit = float(host_def.get('concurrency', 4))
+        self.increase = host_def.get('increase', 1.0)
+        self.decrease = host_def.get('decrease', 0.5)
+        self.latency_factor = host_def.get('latency-factor', 3.0)
+        self.latency: float = None  # the long-term average
+        self.recent_latency: float = None  # the short-term average
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.counters = {'requests': 0, 'overloaded': 0, 'errors': 0, 'slow': 0,
+                         'increases': 0, 'decreases': 0, 'waited': 0.0}
+
+    def acquire(self) -> Ticket:
+        """
+        Wait until the concurrency limit and the rate allow another request.
+        :return: the ticket of the request
+        """
+        started = time.monotonic()
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+        self.bucket.take()
+        with self.condition:
+            self.counters['requests'] += 1
+            self.counters['waited'] += time.monotonic() - started
+        return Ticket(self)
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify()
+
+    def feedback(self, status: Optional[int], latency: float, retry_after: Optional[str]):
+        """
+        Adjust the concurrency limit to how the host answered.
+        :param status: the HTTP status, or None if the request failed
+        :param latency: the time until the response headers arrived
+        :param retry_after: the Retry-After header, if any
+        """
+        if retry_after is not None and retry_after.isdigit():
+            self.bucket.pause(int(retry_after))
+        with self.condition:
+            if status in self.OVERLOADED:
+                self.counters['overloaded'] += 1
+                healthy = False
+            elif status is None:
+                self.counters['errors'] += 1
+                healthy = False
+            else:
+                # a single slow response is noise, the recent average rising well above the long-term one is not
+                if self.latency is None:
+                    self.latency = self.recent_latency = latency
+                self.latency = 0.98 * self.latency + 0.02 * latency
+                self.recent_latency = 0.7 * self.recent_latency + 0.3 * latency
+                healthy = self.recent_latency <= self.latency_factor * self.latency
+                if not healthy:
+                    self.counters['slow'] += 1
+
+            if healthy:
+                # grows by increase for every limit's worth of healthy responses, as in TCP congestion avoidance
+                if self.limit < self.max_limit:
+                    self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+                    self.counters['increases'] += 1
+            elif self.limit > self.min_limit:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self.counters['decreases'] += 1
+                logger.debug('{}: backing off to {} requests at a time'.format(self.name, int(self.limit)))
+            self.condition.notify_all()
+
+
+class Throttle:
+    """
+    The host throttles of a spider, created as the hosts are first seen. The throttle section of the site
+    definition holds the settings by host name, with 'default' for the hosts not listed.
+    """
+    def __init__(self, throttle_def: dict):
+        self.throttle_def = throttle_def
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, url: str) -> HostThrottle:
+        """
+        :param url: an url
+        :return: the throttle of the url's host
+        """
+        name = urlsplit(url).netloc
+        with self.lock:
+            if name not in self.hosts:
+                self.hosts[name] = HostThrottle(name, self.throttle_def.get(name, self.throttle_def.get('default', {})))
+            return self.hosts[name]
+
+    def counters(self) -> dict:
+        """
+        :return: the counters of every host, with its current concurrency limit and the requests in flight
+        """
+        with self.lock:
+            hosts = list(self.hosts.values())
+        counters = {}
+        for host in hosts:
+            with host.condition:
+                counters[host.name] = dict(host.counters, limit=int(host.limit), in_flight=host.in_flight)
+        return counters